@@ -0,0 +1,246 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional
+
+import GPy
+import numpy as np
+
+from gpsynth.audio_output import WavFile
+from gpsynth.synthesizer import GPSynth, big_sweep, fast_normal_from_cholesky, kernel_for_string, \
+    make_cov_cholesky, weighted_loudness
+
+# name -> function(quick) returning the list of (parameter description, setup) pairs.
+# A setup prepares the inputs and returns the function to be timed. The setups
+# of benchmarks that write files get a temporary directory, which is removed
+# after the case.
+benchmarks = {}
+writing_files = set()
+
+
+def benchmark(name: str, writes_files: bool = False) -> Callable:
+    """Registers a benchmark.
+
+    :param name: The name of the benchmark.
+    :param writes_files: Pass a temporary directory to the setups?
+    :return: The decorator.
+    """
+    def register(cases: Callable) -> Callable:
+        benchmarks[name] = cases
+        if writes_files:
+            writing_files.add(name)
+        return cases
+    return register
+
+
+def _xs(samples: int) -> np.ndarray:
+    return (np.arange(samples) * 2. * np.pi / samples)[:, None]
+
+
+@benchmark('covariance')
+def covariance_cases(quick: bool) -> list:
+    kernels = ['RBF'] if quick else ['RBF', 'Matern32', 'StdPeriodic', 'PeriodicExponential']
+    sizes = [256] if quick else [512, 2206]
+    return [(f'{k}-n{n}', lambda k=k, n=n: lambda: kernel_for_string(k, 0.5).K(_xs(n), _xs(n)))
+            for k in kernels for n in sizes]
+
+
+@benchmark('factorization')
+def factorization_cases(quick: bool) -> list:
+    kernels = ['RBF'] if quick else ['RBF', 'Exponential', 'Matern52', 'StdPeriodic', 'PeriodicMatern32']
+    sizes = [256] if quick else [512, 1024, 2206]
+
+    def setup(k, n):
+        cov = kernel_for_string(k, 0.5).K(_xs(n), _xs(n))
+        return lambda: GPy.util.linalg.jitchol(cov)
+
+    cases = [(f'jitchol-{k}-n{n}', lambda k=k, n=n: setup(k, n)) for k in kernels for n in sizes]
+    if not quick:
+        cases += [(f'make_cov_cholesky-{k}', lambda k=k: lambda: make_cov_cholesky(kernel_for_string(k, 0.5)))
+                  for k in kernels]
+    return cases
+
+
+@benchmark('gram_grid')
+def gram_grid_cases(quick: bool) -> list:
+    from gpsynth.gram import grid_choleskys
+
+    kernels = ['Matern32'] if quick else ['RBF', 'Matern32', 'StdPeriodic', 'PeriodicMatern32']
+    lengthscales = np.geomspace(0.01, np.pi, 2 if quick else 4)
+    cases = []
+    for k in kernels:
+        cases.append((f'per-setting-{k}-{lengthscales.size}ls',
+                      lambda k=k: lambda: [make_cov_cholesky(kernel_for_string(k, l)) for l in lengthscales]))
+        cases.append((f'grid-{k}-{lengthscales.size}ls', lambda k=k: lambda: list(grid_choleskys(k, lengthscales))))
+    return cases
+
+
+@benchmark('sampling')
+def sampling_cases(quick: bool) -> list:
+    kernels = ['RBF'] if quick else ['RBF', 'Exponential', 'OU']
+
+    def setup(k):
+        cholesky = make_cov_cholesky(kernel_for_string(k, 0.5))
+        rng = np.random.default_rng(0)
+        return lambda: fast_normal_from_cholesky(cholesky, rng)
+
+    return [(f'draw-{k}', lambda k=k: setup(k)) for k in kernels]
+
+
+@benchmark('weighted_loudness')
+def weighted_loudness_cases(quick: bool) -> list:
+    wavetable = np.random.default_rng(0).standard_normal(2205)
+    return [('n2205', lambda: lambda: weighted_loudness(wavetable, mult_freq=263. / 20.))]
+
+
+@benchmark('note')
+def note_cases(quick: bool) -> list:
+    duration = 0.1 if quick else 1.
+
+    def setup():
+        synth = GPSynth(kernel_for_string('RBF', 0.5), None, None, 2)
+        return lambda: synth.note(60, duration)
+
+    return [(f'{duration}s', setup)]
+
+
+@benchmark('wav_writing', writes_files=True)
+def wav_writing_cases(quick: bool) -> list:
+    samples = np.sin(np.arange(44100 if not quick else 4410) * 0.1).astype(np.float32)
+
+    def setup(directory):
+        def write():
+            wav = WavFile(os.path.join(directory, 'benchmark.wav'))
+            wav.write_samples(samples)
+            wav.close()
+        return write
+
+    return [(f'{samples.size}samples', setup)]
+
+
+@benchmark('analyze_sound')
+def analyze_sound_cases(quick: bool) -> list:
+    from ui.analyze_sound import extract_features  # requires librosa
+
+    seconds = 2 if quick else 30
+    y = np.random.default_rng(0).uniform(-0.5, 0.5, seconds * 22050).astype(np.float32)
+    return [(f'{seconds}s', lambda: lambda: extract_features(y, 22050))]
+
+
+@benchmark('big_sweep', writes_files=True)
+def big_sweep_cases(quick: bool) -> list:
+    kernels = ['RBF', 'Matern32']
+
+    def setup(directory):
+        return lambda: big_sweep(kernels, directory, ls_subdivisions=2, n_wavetables=1, seed=0, n_combinations=2)
+
+    return [('2kernels-2ls-2combinations', setup)]
+
+
+def run_benchmarks(names: Optional[List[str]] = None, repeats: int = 5, quick: bool = False) -> Dict[str, dict]:
+    """Runs the benchmarks. Benchmarks whose dependencies are missing are
+    skipped.
+
+    :param names: The benchmarks to run, all if None.
+    :param repeats: The number of timed repetitions per case.
+    :param quick: Use small sizes, e.g. for testing the harness.
+    :return: The timings in seconds per case, e.g. results['note/1.0s']['median'].
+    """
+    results = {}
+    for name in names or list(benchmarks):
+        try:
+            cases = benchmarks[name](quick)
+        except ImportError as e:
+            print(f'{name}: skipped ({e})')
+            continue
+        for description, setup in cases:
+            with tempfile.TemporaryDirectory(prefix='gpsynth_benchmark_') as directory:
+                fn = setup(directory) if name in writing_files else setup()
+                fn()  # warm up caches and lazy imports
+                timings = []
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    fn()
+                    timings.append(time.perf_counter() - start)
+            key = f'{name}/{description}'
+            results[key] = {
+                'min': min(timings),
+                'median': float(np.median(timings)),
+                'mean': float(np.mean(timings)),
+                'repeats': repeats,
+            }
+            print(f'{key}: median {results[key]["median"] * 1000.:.2f} ms')
+    return results
+
+
+def save_results(results: Dict[str, dict], path: str) -> None:
+    """Saves the results as JSON together with the commit and the platform.
+
+    :param results: The results of run_benchmarks.
+    :param path: Path of the JSON file.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                universal_newlines=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    report = {
+        'commit': commit,
+        'date': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'results': results,
+    }
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=4)
+
+
+def compare(baseline_path: str, results: Dict[str, dict], tolerance: float = 0.2) -> List[str]:
+    """Compares results to a baseline saved with save_results.
+
+    :param baseline_path: Path of the baseline JSON file.
+    :param results: The results of run_benchmarks.
+    :param tolerance: The relative slowdown of the median that is accepted.
+    :return: A description of every regression.
+    """
+    with open(baseline_path, 'r') as f:
+        baseline = json.load(f)['results']
+
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        ratio = result['median'] / baseline[key]['median']
+        if ratio > 1. + tolerance:
+            regressions.append(f'{key}: {ratio:.2f}x slower')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the stages of Gaussian Process Synthesis')
+    parser.add_argument('names', nargs='*', help=f'the benchmarks to run, any of {", ".join(benchmarks)}')
+    parser.add_argument('--out', type=str, default=None, help='save the results to this JSON file')
+    parser.add_argument('--compare', type=str, default=None, help='a JSON file with baseline results')
+    parser.add_argument('--repeats', type=int, default=5, help='the number of timed repetitions')
+    parser.add_argument('--quick', action='store_true', help='use small sizes')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.names, args.repeats, args.quick)
+    if args.out is not None:
+        save_results(results, args.out)
+    if args.compare is not None:
+        regressions = compare(args.compare, results)
+        for regression in regressions:
+            print('Regression:', regression)
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,57 +1,48 @@
 import os
-import time
+from typing import Union
 
-import GPy
 import numpy as np
-from tqdm import tqdm
 
 import gpsynth.config as config
-from gpsynth.audio_output import WavFile, RealtimeAudio
-from gpsynth.synthesizer import GPSynth, kernel_for_string
+from benchmark import run_benchmarks, save_results
+from gpsynth.audio_output import WavFile
+from gpsynth.gram import grid_choleskys
+from gpsynth.synthesizer import band_limit, render_wavetable, wavetables_from_cholesky
 
 
-def make_continuous_discontinuous(directory: str) -> None:
+def make_continuous_discontinuous(directory: str, rng: Union[None, int, np.random.Generator] = None) -> None:
     """Create WAV files with and without enforcing continuity.
 
+    The factors of all length-scales are computed as one batch by
+    grid_choleskys and the notes are rendered directly from the drawn tables.
+
     :param directory: Directory where the results are saved.
+    :param rng: The random number generator or a seed.
     :return: None
     """
-
-    for setting in [True, False]:
-        print('Good continuation:', setting)
-        config.GOOD_CONTINUATION_REGRESSION = setting
-        path = os.path.join(directory, f'good_continuation={config.GOOD_CONTINUATION_REGRESSION}.wav')
-        out_wav = WavFile(path)
-        ls_start = 0.01
-        ls_end = 1.
-        l_vals = np.geomspace(ls_start, ls_end, 10)
-        for l_idx, lengthscale in enumerate(l_vals):
-            k = kernel_for_string('RBF', lengthscale=lengthscale)
-            print('l =', lengthscale)
-            gpsynth = GPSynth(k, None, out_wav, n_wavetables=1)
-            gpsynth.note(60, 1.)
-
-
-def speed_test(n_wavetables=1000):
-    """How long does it take to compute the wavetables."""
-
-    start = time.time()
-    kernel = GPy.kern.RBF(input_dim=1, lengthscale=1.0)
-    gpsynth = GPSynth(kernel, out_rt=None, out_wav=None, n_wavetables=n_wavetables, waveshaping=False)
-    end = time.time()
-    print('Time elapsed (saved Cholesky decomposition)', end - start)
-
-    start = time.time()
-    for i in tqdm(range(n_wavetables)):
-        kernel = GPy.kern.RBF(input_dim=1, lengthscale=1.0)
-        gpsynth = GPSynth(kernel, out_rt=None, out_wav=None, n_wavetables=1, waveshaping=False)
-    end = time.time()
-    print('Time elapsed (full computation)', end - start)
+    rng = np.random.default_rng(rng)
+    previous = config.good_continuation_regression
+    try:
+        for setting in [True, False]:
+            print('Good continuation:', setting)
+            config.good_continuation_regression = setting
+            path = os.path.join(directory, f'good_continuation={config.good_continuation_regression}.wav')
+            out_wav = WavFile(path)
+            ls_start = 0.01
+            ls_end = 1.
+            l_vals = np.geomspace(ls_start, ls_end, 10)
+            for choleskys in grid_choleskys('RBF', l_vals):
+                for cholesky in choleskys:
+                    wavetable = band_limit(wavetables_from_cholesky(cholesky, 1, rng, label='RBF')[0], 60)
+                    out_wav.write_samples(render_wavetable(wavetable, 60, 0, 44100, 44100))  # note(60, 1.)
+            out_wav.close()
+    finally:
+        config.good_continuation_regression = previous
 
 
 def main(directory: str):
     make_continuous_discontinuous(directory)
-    speed_test()
+    save_results(run_benchmarks(), os.path.join(directory, 'benchmark.json'))
 
 
 if __name__ == '__main__':
@@ -1,68 +1,119 @@
+import hashlib
+import json
 import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
 
 import numpy as np
 import GPy
+import matplotlib
+matplotlib.use('Agg')  # the figures are only saved, also by worker processes without a display
 from matplotlib import pyplot as plt
 from scipy.io import wavfile
 
 import evaluate
+from gpsynth.anchors import cholesky_downdate
+from gpsynth.synthesizer import jitchol, kernel_key, kernel_label
 
 colors = ['g', 'k', 'b']
 linestyles = ['-', ':', '-.', '--']
 
+X = np.linspace(0., 10., 500)[:, None]  # the inputs of the sample plots
+CENTER = 250  # the index of the input the regression plots pass through
+INDEX_NAME = 'figures.json'  # the inputs of the rendered figures, see main
 
-def plot_samples(k: GPy.kern.Kern, directory: str) -> None:
-    """Plots samples from a kernel.
+_factors = {}  # type: Dict[tuple, np.ndarray]
 
-    :param k: The kernel from which to draw samples
-    :return: None
+
+def sample_cholesky(k: GPy.kern.Kern, conditioned: bool = False) -> np.ndarray:
+    """The Cholesky decomposition of the covariance of a kernel on X. It is
+    cached, and the conditioned one is a rank-one downdate of the prior one,
+    so that the figures of a kernel factorize its covariance once, see plot_kernel.
+
+    :param k: The kernel.
+    :param conditioned: Condition the samples on passing through 0 at X[CENTER]?
+    :return: The Cholesky decomposition.
+    """
+    key = (kernel_key(k), conditioned)
+    if key not in _factors:
+        if not conditioned:
+            _factors[key] = jitchol(k.K(X, X), kernel_label(k))
+        else:
+            # the noiseless posterior covariance K - k k^T / k(x, x), with the jitter of GPy's regression
+            k_x = k.K(X, X[CENTER:CENTER + 1])[:, 0]
+            upper = np.array(sample_cholesky(k).T)
+            cholesky_downdate(upper, k_x / np.sqrt(k_x[CENTER] + 1e-8))
+            _factors[key] = upper.T
+    return _factors[key]
+
+
+def sample_path(k: GPy.kern.Kern, directory: str, prefix: str = 'samples') -> str:
+    """The path of the figure of a kernel.
+
+    :param k: The kernel.
+    :param directory: The output directory.
+    :param prefix: 'samples' or 'regression'.
+    :return: The path of the PDF file.
     """
+    ls = f'l{k.lengthscale[0]}'.replace('.', '_')
+    return os.path.join(directory, f"{prefix}_{k.name}_{ls}.pdf")
 
-    X = np.linspace(0., 10., 500)
-    X = X[:, None]
-    mu = np.zeros(500)
-    C = k.K(X, X)
-    Z = np.random.multivariate_normal(mu, C, 20)
+
+def _plot_draws(Z: np.ndarray, path: str) -> None:
     fig, ax = plt.subplots(1, 1)
 
-    for i in range(3):
+    for i in range(Z.shape[0]):
         c = colors[i]
         ls = linestyles[i]
         ax.plot(X[:], Z[i, :], color=c, linestyle=ls)
 
-    ls = f'l{k.lengthscale[0]}'.replace('.', '_')
-    path = os.path.join(directory, f"samples_{k.name}_{ls}.pdf")
-    plt.savefig(path, bbox_inches='tight')
+    fig.savefig(path, bbox_inches='tight')
+    plt.close(fig)
 
 
-def plot_samples_with_regression(k: GPy.kern, directory: str) -> None:
-    """Plots samples forced to pass through the same point at the center.
+def plot_samples(k: GPy.kern.Kern, directory: str, rng: Union[None, int, np.random.Generator] = None) -> None:
+    """Plots samples from a kernel.
 
     :param k: The kernel from which to draw samples
+    :param directory: The output directory.
+    :param rng: The random number generator or a seed.
     :return: None
     """
+    rng = np.random.default_rng(rng)
+    Z = (sample_cholesky(k) @ rng.standard_normal((X.shape[0], 3))).T  # only the plotted samples
+    _plot_draws(Z, sample_path(k, directory))
 
-    X = np.linspace(0., 10., 500)
-    X = X[:, None]
-    X_regress = np.array([X[250]])
-    Y_regress = np.array([0.])[:, None]
-    m = GPy.models.GPRegression(X_regress, Y_regress, k)
-    m.Gaussian_noise = 0.0
-    mean, cov = m.predict_noiseless(X, full_cov=True)
-    mean = mean[:, 0]
 
-    Z = np.random.multivariate_normal(mean, cov, 20)
+def plot_samples_with_regression(k: GPy.kern.Kern, directory: str,
+                                 rng: Union[None, int, np.random.Generator] = None) -> None:
+    """Plots samples forced to pass through the same point at the center.
 
-    fig, ax = plt.subplots(1, 1)
+    :param k: The kernel from which to draw samples
+    :param directory: The output directory.
+    :param rng: The random number generator or a seed.
+    :return: None
+    """
+    rng = np.random.default_rng(rng)
+    Z = (sample_cholesky(k, conditioned=True) @ rng.standard_normal((X.shape[0], 3))).T  # the mean is 0
+    _plot_draws(Z, sample_path(k, directory, 'regression'))
 
-    for i in range(3):
-        c = colors[i]
-        ls = linestyles[i]
-        ax.plot(X[:], Z[i, :], color=c, linestyle=ls)
 
-    ls = f'l{k.lengthscale[0]}'.replace('.', '_')
-    path = os.path.join(directory, f"regression_{k.name}_{ls}.pdf")
-    plt.savefig(path, bbox_inches='tight')
+def plot_kernel(k: GPy.kern.Kern, directory: str, kinds: Sequence[str],
+                rng: Union[None, int, np.random.Generator] = None) -> None:
+    """Plots the figures of a kernel. They share the factor of its covariance,
+    so they are rendered together, e.g. by one worker process.
+
+    :param k: The kernel.
+    :param directory: The output directory.
+    :param kinds: 'samples' (plot_samples) and/or 'regression' (plot_samples_with_regression).
+    :param rng: The seed of the samples of every figure. A generator would be shared by them.
+    :return: None
+    """
+    for kind in kinds:
+        if kind == 'samples':
+            plot_samples(k, directory, rng)
+        else:
+            plot_samples_with_regression(k, directory, rng)
 
 
 def plot_spectrogram(wav_path: str, out_path: str) -> None:
@@ -82,35 +133,92 @@ def plot_spectrogram(wav_path: str, out_path: str) -> None:
     fig.tight_layout()
 
     fig.savefig(out_path)
+    plt.close(fig)
+
+
+def _file_hash(path: str) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
 
 
-def main(directory: str):
-    k = GPy.kern.RBF(input_dim=1, lengthscale=1.)
-    plot_samples(k, directory)
-    k = GPy.kern.Exponential(input_dim=1, lengthscale=1.)
-    plot_samples(k, directory)
-    k = GPy.kern.Matern32(input_dim=1, lengthscale=1.)
-    plot_samples(k, directory)
-    k = GPy.kern.Matern52(input_dim=1, lengthscale=1.)
-    plot_samples(k, directory)
+def _run(jobs: List[Tuple[Callable, tuple]], executor: Optional[ProcessPoolExecutor]) -> None:
+    if executor is None:
+        for function, args in jobs:
+            function(*args)
+    else:
+        for future in [executor.submit(function, *args) for function, args in jobs]:
+            future.result()
 
-    k = GPy.kern.RBF(input_dim=1, lengthscale=0.2)
-    plot_samples(k, directory)
-    k = GPy.kern.RBF(input_dim=1, lengthscale=1.0)
-    plot_samples(k, directory)
-    k = GPy.kern.RBF(input_dim=1, lengthscale=5.0)
-    plot_samples(k, directory)
 
-    plot_samples_with_regression(k, directory)
+def main(directory: str, processes: Optional[int] = None, force: bool = False, seed: int = 0) -> List[str]:
+    """Renders the figures of the paper. They are rendered in parallel and
+    only if they are missing or their inputs changed since the last run, e.g.
+    the kernel, the seed, the WAV file of a spectrogram or this script.
+
+    :param directory: The output directory.
+    :param processes: The number of processes rendering the figures, the
+        number of CPUs if None. 1 renders them in this process.
+    :param force: Render all figures, even the unchanged ones.
+    :param seed: The seed of the samples.
+    :return: The paths of the rendered figures.
+    """
+    index_path = os.path.join(directory, INDEX_NAME)
+    index = {}  # type: Dict[str, str]
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+    source = _file_hash(__file__)  # changes of the plotting code change all figures
+    inputs = {}  # type: Dict[str, str]
+
+    def outdated(path: str, description: str) -> bool:
+        inputs[path] = hashlib.sha1((description + source).encode()).hexdigest()
+        return force or not os.path.exists(path) or index.get(os.path.basename(path)) != inputs[path]
+
+    kernels = [(GPy.kern.RBF(input_dim=1, lengthscale=1.), ['samples']),
+               (GPy.kern.Exponential(input_dim=1, lengthscale=1.), ['samples']),
+               (GPy.kern.Matern32(input_dim=1, lengthscale=1.), ['samples']),
+               (GPy.kern.Matern52(input_dim=1, lengthscale=1.), ['samples']),
+               (GPy.kern.RBF(input_dim=1, lengthscale=0.2), ['samples']),
+               (GPy.kern.RBF(input_dim=1, lengthscale=5.0), ['samples', 'regression'])]
+    rendered = []
+    jobs = []
+    for k, kinds in kernels:
+        paths = {kind: sample_path(k, directory, kind) for kind in kinds}
+        kinds = [kind for kind in kinds if outdated(paths[kind], repr((kernel_key(k), seed)))]
+        if kinds:
+            jobs.append((plot_kernel, (k, directory, kinds, seed)))  # one job per kernel, see sample_cholesky
+            rendered += [paths[kind] for kind in kinds]
 
     wav_path_good = os.path.join(directory, 'good_continuation=True.wav')
     wav_path_bad = os.path.join(directory, 'good_continuation=False.wav')
-    if not os.path.exists(wav_path_good):
-        assert not os.path.exists(wav_path_bad)  # don't overwrite existing file
-        evaluate.make_continuous_discontinuous(directory)  # generates the WAV files
-
-    plot_spectrogram(wav_path_good, os.path.join(directory, 'good_continuation.pdf'))
-    plot_spectrogram(wav_path_bad, os.path.join(directory, 'bad_continuation.pdf'))
+    executor = None if processes == 1 else ProcessPoolExecutor(max_workers=processes)
+    try:
+        wav_future = None
+        if not os.path.exists(wav_path_good):
+            assert not os.path.exists(wav_path_bad)  # don't overwrite existing file
+            if executor is None:
+                evaluate.make_continuous_discontinuous(directory)  # generates the WAV files
+            else:  # while the samples are plotted
+                wav_future = executor.submit(evaluate.make_continuous_discontinuous, directory)
+        _run(jobs, executor)
+        if wav_future is not None:
+            wav_future.result()
+
+        jobs = []
+        for wav_path, out_name in [(wav_path_good, 'good_continuation.pdf'), (wav_path_bad, 'bad_continuation.pdf')]:
+            out_path = os.path.join(directory, out_name)
+            if outdated(out_path, _file_hash(wav_path)):
+                jobs.append((plot_spectrogram, (wav_path, out_path)))
+                rendered.append(out_path)
+        _run(jobs, executor)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    index.update({os.path.basename(path): inputs[path] for path in rendered})
+    with open(index_path, 'w') as f:
+        json.dump(index, f, indent=4)
+    return rendered
 
 
 if __name__ == '__main__':
@@ -1,2 +1,18 @@
-from gpsynth.audio_output import WavFile, RealtimeAudio
-from gpsynth.synthesizer import GPSynth, kernel_for_string, all_kernels
\ No newline at end of file
+# The submodules are imported on first access, so that importing gpsynth does
+# not load GPy, scipy, matplotlib or pyaudio.
+_exports = {
+    'WavFile': 'gpsynth.audio_output',
+    'RealtimeAudio': 'gpsynth.audio_output',
+    'GPSynth': 'gpsynth.synthesizer',
+    'kernel_for_string': 'gpsynth.synthesizer',
+    'all_kernels': 'gpsynth.synthesizer',
+}
+
+__all__ = list(_exports)
+
+
+def __getattr__(name):
+    if name not in _exports:
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    import importlib
+    return getattr(importlib.import_module(_exports[name]), name)
@@ -0,0 +1,24 @@
+import importlib
+from types import ModuleType
+
+
+class LazyModule:
+    """Stands in for a module that is only imported when one of its
+    attributes is used for the first time. Heavy or optional dependencies
+    thus do not slow down (or break) importing gpsynth."""
+
+    def __init__(self, name: str):
+        """Prepares the lazy module.
+
+        :param name: The full name of the module, e.g. 'scipy.signal'.
+        """
+        self._name = name
+
+    def _load(self) -> ModuleType:
+        return importlib.import_module(self._name)
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+    def __repr__(self) -> str:
+        return f'<lazy module {self._name!r}>'
@@ -0,0 +1,189 @@
+from __future__ import annotations
+
+from typing import List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+import gpsynth.config as config
+import gpsynth.metrics as metrics
+from gpsynth._lazy import LazyModule
+from gpsynth.synthesizer import is_periodic, jitchol, kernel_label
+
+GPy = LazyModule('GPy')
+linalg = LazyModule('scipy.linalg')
+
+
+class AnchoredSampler:
+    """Samples wavetables that pass through anchor points (x, y).
+
+    The posterior is updated incrementally: adding an anchor is a rank-one
+    downdate of the Cholesky decomposition of the posterior covariance on the
+    wavetable grid, O(n^2) instead of the O(n^3) of factorizing it again.
+
+    Internally, the anchors are kept as the Cholesky decomposition C of their
+    prior covariance. The grid holds U = K(grid, anchors) C^-T, so that the
+    posterior covariance is K(grid, grid) - U U^T and the posterior mean is
+    U w with w = C^-1 y.
+    """
+
+    def __init__(self, kernel: GPy.kern.Kern, anchors: Sequence[Tuple[float, float]] = (),
+                 waveshaping: bool = False, continuation: bool = True):
+        """Factorizes the prior covariance and adds the anchors.
+
+        :param kernel: The kernel.
+        :param anchors: The (x, y) pairs. For wavetables, x is the phase in
+            [0, 2 pi]. For waveshaping, x is the input in [-1, 1].
+        :param waveshaping: Should waveshaping be used?
+        :param continuation: Start the wavetable at zero and, unless the
+            kernel is periodic or config.good_continuation_regression is
+            False, end it at zero like make_cov_cholesky.
+        """
+        self.kernel = kernel
+        self.label = kernel_label(kernel)
+        samples = 44100 / 20
+        if not waveshaping:
+            self.xs = np.arange(samples + 1) * 2. * np.pi / samples
+        else:
+            self.xs = np.sin(np.arange(samples) * 2. * np.pi / samples)
+
+        with metrics.timer('covariance', kernel=self.label):
+            cov = kernel.K(self.xs[:, None], self.xs[:, None])
+        self.upper = np.ascontiguousarray(jitchol(cov, self.label).T)  # the rows are the columns of L
+        self.floor = 1e-12 * np.max(np.abs(np.diag(self.upper))) ** 2  # of all downdates, see cholesky_downdate
+        self.mean = np.zeros(self.xs.size)
+        self.anchors = []  # type: List[Tuple[float, float]]
+        self.anchor_cholesky = np.zeros((0, 0))  # C
+        self.grid_factor = np.zeros((self.xs.size, 0))  # U
+        self.weights = np.zeros(0)  # w
+
+        if continuation and not waveshaping:
+            self.add_anchor(self.xs[0], 0.)
+            if not is_periodic(kernel) and config.good_continuation_regression:
+                self.add_anchor(self.xs[-1], 0.)
+        for x, y in anchors:
+            self.add_anchor(x, y)
+
+    def add_anchor(self, x: float, y: float) -> None:
+        """Constrains the samples to pass through (x, y).
+
+        :param x: The phase (or the input for waveshaping).
+        :param y: The value of the samples at x.
+        """
+        with metrics.timer('anchor_update', kernel=self.label):
+            x_ = np.array([[x]], dtype=float)
+            if self.anchors:
+                k_ax = self.kernel.K(np.array(self.anchors)[:, :1], x_)[:, 0]
+                c = linalg.solve_triangular(self.anchor_cholesky, k_ax, lower=True)
+            else:
+                c = np.zeros(0)
+            variance = self.kernel.K(x_, x_)[0, 0] - c @ c
+            if variance <= 1e-10 * self.kernel.K(x_, x_)[0, 0]:
+                raise ValueError(f'The value at x={x} is already determined by the other anchors.')
+            d = np.sqrt(variance)
+
+            u = (self.kernel.K(self.xs[:, None], x_)[:, 0] - self.grid_factor @ c) / d
+            w = (y - c @ self.weights) / d
+
+            m = len(self.anchors)
+            anchor_cholesky = np.zeros((m + 1, m + 1))
+            anchor_cholesky[:m, :m] = self.anchor_cholesky
+            anchor_cholesky[m, :m] = c
+            anchor_cholesky[m, m] = d
+            self.anchor_cholesky = anchor_cholesky
+            self.grid_factor = np.column_stack((self.grid_factor, u))
+            self.weights = np.append(self.weights, w)
+            self.mean = self.mean + u * w
+            self.anchors.append((float(x), float(y)))
+            cholesky_downdate(self.upper, u, self.floor)
+
+    @property
+    def cholesky(self) -> np.ndarray:
+        """The lower Cholesky decomposition of the posterior covariance on the grid."""
+        return self.upper.T.astype(config.dtype)
+
+    def sample(self, n: int = 1, rng: Union[None, int, np.random.Generator] = None,
+               peak: Optional[float] = None) -> List[np.ndarray]:
+        """Draws wavetables through the anchors. They are neither loudness
+        normalized nor scaled, which would move the anchors.
+
+        :param n: The number of wavetables.
+        :param rng: The random number generator or a seed.
+        :param peak: If not None, draws whose absolute value exceeds the peak
+            are rejected and drawn again, e.g. 0.9 like draw_normalized.
+            Without a peak, the draws may exceed [-1, 1] for kernels with a
+            large variance.
+        :return: A list of wavetables.
+        :raises ValueError: If a wavetable within the peak was not found within
+            config.max_draw_attempts candidates, e.g. because an anchor exceeds it.
+        """
+        rng = np.random.default_rng(rng)
+        if peak is None:
+            draws = self.mean + rng.standard_normal((n, self.xs.size)) @ self.upper
+            return [draw[:-1].astype(config.dtype) for draw in draws]
+
+        accepted = []  # type: List[np.ndarray]
+        drawn = 0
+        while len(accepted) < n:
+            if drawn >= n * config.max_draw_attempts:
+                raise ValueError(f'Only {len(accepted)} of {n} wavetables through the anchors stayed within the '
+                                 f'peak {peak} in {drawn} attempts.')
+            batch = min(n - len(accepted), config.max_draw_batch)
+            candidates = self.mean + rng.standard_normal((batch, self.xs.size)) @ self.upper
+            drawn += batch
+            within = np.max(np.abs(candidates), axis=1) <= peak
+            metrics.count('draws_total', batch, kernel=self.label)
+            metrics.count('draws_rejected_total', int(batch - np.sum(within)), kernel=self.label)
+            accepted.extend(candidates[within])
+        return [draw[:-1].astype(config.dtype) for draw in accepted[:n]]
+
+
+def cholesky_downdate(upper: np.ndarray, x: np.ndarray, floor: Optional[float] = None) -> None:
+    """Rank-one downdate of a Cholesky decomposition in place, such that
+    afterwards upper^T upper = (before) upper^T upper - x x^T.
+
+    Where the downdated matrix is (numerically) singular, e.g. at an anchor,
+    its diagonal is set to a small positive jitter and the rest of the row to
+    zero. As the downdated matrix is positive semi-definite, nothing of x
+    remains for the following rows then. Such rows are left alone by later
+    downdates.
+
+    :param upper: The upper triangular decomposition (the transposed lower one).
+    :param x: The vector of the downdate.
+    :param floor: The squared jitter, 1e-12 times the largest squared
+        diagonal element if None. Successive downdates of a decomposition must
+        use the same floor, so that they recognize the singular rows.
+    """
+    x = np.array(x, dtype=float)
+    if floor is None:
+        floor = 1e-12 * np.max(np.abs(np.diag(upper))) ** 2
+    jitter = np.sqrt(floor)
+    for k in range(x.size):
+        r_kk = upper[k, k]
+        if r_kk <= jitter:  # singular since an earlier downdate, so x[k] vanishes as well
+            continue
+        r_squared = r_kk ** 2 - x[k] ** 2
+        if r_squared <= floor:  # dividing by r would amplify the rounding errors
+            upper[k, k] = jitter
+            upper[k, k + 1:] = 0.
+            return
+        r = np.sqrt(r_squared)
+        c = r / r_kk
+        s = x[k] / r_kk
+        upper[k, k] = r
+        upper[k, k + 1:] = (upper[k, k + 1:] - s * x[k + 1:]) / c
+        x[k + 1:] = c * x[k + 1:] - s * upper[k, k + 1:]
+
+
+def conditioned_wavetables(kernel: GPy.kern.Kern, anchors: Sequence[Tuple[float, float]], n: int = 17,
+                           rng: Union[None, int, np.random.Generator] = None,
+                           waveshaping: bool = False) -> List[np.ndarray]:
+    """Draws wavetables that pass through the anchor points.
+
+    :param kernel: The kernel.
+    :param anchors: The (x, y) pairs, see AnchoredSampler.
+    :param n: The number of wavetables.
+    :param rng: The random number generator or a seed.
+    :param waveshaping: Should waveshaping be used?
+    :return: A list of wavetables, see AnchoredSampler.sample.
+    """
+    return AnchoredSampler(kernel, anchors, waveshaping).sample(n, rng)
@@ -1,29 +1,39 @@
 import wave
-import struct
 import datetime
 import math
+import struct
+from typing import Optional
 
-import pyaudio
 import numpy as np
 
+import gpsynth.metrics as metrics
+
 
 class RealtimeAudio:
     """Real-time audio output"""
 
-    def __init__(self):
+    def __init__(self, channels: int = 1):
+        """Opens the audio stream.
+
+        :param channels: The number of channels, e.g. 2 for stereo.
+        """
+        import pyaudio  # only needed for real-time output
+
+        self.channels = channels
         self.pyaudio = pyaudio.PyAudio()
         fs = 44100  # sampling rate, Hz, must be integer
-        self.stream = self.pyaudio.open(format=pyaudio.paInt16, channels=1, rate=fs, output=True)
+        self.stream = self.pyaudio.open(format=pyaudio.paInt16, channels=channels, rate=fs, output=True)
 
     def write_samples(self, samples: np.ndarray) -> None:
         """Plays the samples immediately.
 
-        :param samples: The samples should be between -1. and 1.
+        :param samples: The samples should be between -1. and 1., see interleave.
         :return: None
         """
 
-        samples = (samples * (2 ** 15)).astype(np.int16)
-        self.stream.write(samples.tostring())
+        samples = (np.clip(interleave(samples, self.channels), -1., 1.) * (2 ** 15 - 1)).astype(np.int16)
+        metrics.count('audio_bytes_played_total', samples.nbytes)
+        self.stream.write(samples.tobytes())
 
     def close(self):
         """Stops the audio stream."""
@@ -36,14 +46,17 @@ class RealtimeAudio:
 class WavFile:
     """Save output to WAV file"""
 
-    def __init__(self, path: str):
+    def __init__(self, path: str, channels: int = 1):
         """Prepares to save the audio as WAV file.
 
         :param path: Path where the WAV file is created.
+        :param channels: The number of channels, e.g. 2 for stereo.
         """
 
+        self.channels = channels
         self.wav_file = wave.open(path, 'w')
-        self.wav_file.setparams((1, 2, 44100, 0, 'NONE', 'not compressed'))  # mono, 16 bits, 44100 Hz
+        self.wav_file.setparams((channels, 2, 44100, 0, 'NONE', 'not compressed'))  # 16 bits, 44100 Hz
+        self.samples_written = 0  # per channel
 
     def close(self):
         """Closes the WAV file."""
@@ -53,14 +66,85 @@ class WavFile:
     def write_samples(self, samples: np.ndarray) -> None:  # sample is a float in the range [-1, +1]
         """Writes the sample into the WAV file.
 
-        :param samples: The samples should be between -1. and 1.
+        :param samples: The samples should be between -1. and 1., see interleave.
         :return: None
         """
 
-        for i in range(samples.size):
-            sample = samples[i]
-            audio_sample = int(sample * (math.pow(2, 15) - 1))
-            self.wav_file.writeframesraw(struct.pack("<h", audio_sample))
+        with metrics.timer('wav_write'):
+            audio_samples = (interleave(samples, self.channels) * (math.pow(2, 15) - 1)).astype('<i2')
+            self.wav_file.writeframesraw(audio_samples.tobytes())
+        self.samples_written += audio_samples.shape[0]
+        metrics.count('wav_bytes_written_total', audio_samples.nbytes)
+
+
+def interleave(samples: np.ndarray, channels: int) -> np.ndarray:
+    """Brings samples into the layout of an output with the number of channels.
+
+    :param samples: Mono samples, which are played on all channels, or samples
+        with shape (samples, channels).
+    :param channels: The number of channels of the output.
+    :return: The samples with shape (samples, channels).
+    """
+    samples = np.asarray(samples)
+    if samples.ndim == 1:
+        return np.repeat(samples[:, None], channels, axis=1)
+    if samples.shape[1] == channels:
+        return samples
+    if channels == 1:
+        return samples.mean(axis=1, keepdims=True)
+    raise ValueError(f'Samples with {samples.shape[1]} channels cannot be written to {channels} channels.')
+
+
+def read_wav(path: str) -> np.ndarray:
+    """Reads a 16 bit WAV file, e.g. a saved wavetable.
+
+    :param path: Path of the WAV file.
+    :return: The samples between -1. and 1., with shape (samples, channels)
+        if the file has more than one channel.
+    """
+    with wave.open(path, 'r') as wav_file:
+        frames = wav_file.readframes(wav_file.getnframes())
+        channels = wav_file.getnchannels()
+    samples = np.frombuffer(frames, dtype='<i2') / (math.pow(2, 15) - 1)
+    return samples if channels == 1 else samples.reshape(-1, channels)
+
+
+def wav_header(n_samples: int) -> bytes:
+    """Makes the header of a mono 16 bit WAV file at 44.1 kHz, like the ones
+    of WavFile.
+
+    :param n_samples: The number of samples that follow the header.
+    :return: The header.
+    """
+    data_size = 2 * n_samples
+    return b'RIFF' + struct.pack('<I', 36 + data_size) + b'WAVEfmt ' + \
+        struct.pack('<IHHIIHH', 16, 1, 1, 44100, 2 * 44100, 2, 16) + b'data' + struct.pack('<I', data_size)
+
+
+def wav_segment_bytes(path: str, offset: int, count: int, start: int = 0, stop: Optional[int] = None) -> bytes:
+    """Reads a byte range of the WAV file that a segment of a longer WAV file
+    would be, e.g. of a single note in c.wav. Only the requested part is read.
+
+    :param path: Path of the mono 16 bit WAV file.
+    :param offset: The first sample of the segment.
+    :param count: The number of samples of the segment.
+    :param start: The first byte of the range.
+    :param stop: The byte after the range, the end of the segment file if None.
+    :return: The bytes.
+    """
+    header = wav_header(count)
+    size = len(header) + 2 * count
+    stop = size if stop is None else min(stop, size)
+    result = header[start:stop]
+    first = max(start - len(header), 0) // 2  # samples of the segment
+    last = (max(stop - len(header), 0) + 1) // 2
+    if last > first:
+        with wave.open(path, 'r') as wav_file:
+            wav_file.setpos(offset + first)
+            data = wav_file.readframes(last - first)
+        skip = max(start - len(header), 0) - 2 * first  # an odd start splits a sample
+        result += data[skip:skip + stop - max(start, len(header))]
+    return result
 
 
 def main():
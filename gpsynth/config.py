@@ -2,3 +2,36 @@
 # sample of a wavetable to be close. Regression is not used when using periodic
 # kernels or when doing waveshaping (regardless of the configuration).
 good_continuation_regression = True
+
+# Number of settings whose wavetables are cached by make_wavetables when they
+# are generated with an integer seed.
+wavetable_cache_size = 64
+
+# Precision of the stored Cholesky factors, the wavetables and the rendered
+# audio, 'float32' or 'float64'. The covariance is always factorized in double
+# precision for stability. Single precision halves the memory and the cost of
+# every draw, which is inaudible in the 16 bit output.
+dtype = 'float32'
+
+# Draws that would clip are rejected. After this many rejected candidates for
+# one wavetable, the best candidate is limited instead, see clipping_fallback.
+max_draw_attempts = 100
+
+# How a draw that still clips after max_draw_attempts is limited: 'rescale'
+# scales it down, 'softclip' saturates the peaks.
+clipping_fallback = 'rescale'
+
+# The maximal number of candidates drawn with one matrix product.
+max_draw_batch = 32
+
+# Number of Cholesky factors kept in memory by cached_cholesky. A factor takes
+# about 20 MB in single precision.
+factor_cache_size = 16
+
+# If not None, cached_cholesky also stores the factors in this directory, which
+# can be shared by several processes, e.g. the workers of synth_service.
+factor_cache_dir = None
+
+# Number of length-scales whose covariances are stacked and factorized together
+# by grid_choleskys. Every one takes about 40 MB in double precision.
+gram_batch_size = 4
@@ -0,0 +1,289 @@
+import argparse
+import functools
+import io
+import json
+import lzma
+import math
+import os
+import wave
+import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import gpsynth.metrics as metrics
+from gpsynth.audio_output import WavFile
+
+# Compressed exports of big_sweep. 'flac' writes every wavetable (and c.wav)
+# as FLAC file, which needs the optional soundfile package. 'bank' writes all
+# wavetables and the notes of c.wav into a single samples.bank, a zip file
+# with one member per setting. Its tables are quantized like the WAV files and
+# delta encoded before they are compressed, as the smooth tables have much
+# smaller differences than values, and compressed with LZMA. Both are
+# converted back to the WAV files of a normal export with to_wav, e.g. for
+# Max/MSP.
+
+formats = ['wav', 'flac', 'bank']
+BANK_NAME = 'samples.bank'
+NOTES = 'c.wav'  # the entry of the bank holding the notes
+NOTES_CHUNK = 1 << 20  # the notes are compressed in chunks of this many samples, in parallel
+
+
+def quantize(samples: np.ndarray) -> np.ndarray:
+    """Converts samples to 16 bit integers exactly like WavFile.
+
+    :param samples: The samples between -1. and 1.
+    :return: The integer samples.
+    """
+    return (np.asarray(samples) * (math.pow(2, 15) - 1)).astype('<i2')
+
+
+def delta_encode(samples: np.ndarray, order: int) -> np.ndarray:
+    """Takes the differences of successive integer samples along the last
+    axis, order times. The int16 arithmetic wraps around, which delta_decode
+    undoes exactly.
+
+    :param samples: The integer samples.
+    :param order: The number of differences, 0 keeps the samples.
+    :return: The differences with the same shape.
+    """
+    for _ in range(order):
+        samples = np.diff(samples, axis=-1, prepend=np.zeros(samples.shape[:-1] + (1,), dtype=samples.dtype))
+    return samples
+
+
+def delta_decode(deltas: np.ndarray, order: int) -> np.ndarray:
+    """Inverts delta_encode.
+
+    :param deltas: The differences.
+    :param order: The number of differences.
+    :return: The integer samples.
+    """
+    for _ in range(order):
+        deltas = np.cumsum(deltas, axis=-1, dtype=deltas.dtype)
+    return deltas
+
+
+def encode_block(samples: np.ndarray, orders: Iterable[int] = (0, 1, 2)) -> Tuple[bytes, int]:
+    """Compresses integer samples with the delta order that compresses best.
+
+    :param samples: The integer samples, e.g. the tables of a setting.
+    :param orders: The delta orders that are tried.
+    :return: The compressed bytes and the delta order.
+    """
+    encoded = []
+    for order in orders:
+        buffer = io.BytesIO()
+        np.save(buffer, delta_encode(samples, order))
+        encoded.append((lzma.compress(buffer.getvalue()), order))
+    return min(encoded, key=lambda e: len(e[0]))
+
+
+def decode_block(data: bytes, order: int) -> np.ndarray:
+    """Inverts encode_block.
+
+    :param data: The compressed bytes.
+    :param order: The delta order.
+    :return: The integer samples.
+    """
+    return delta_decode(np.load(io.BytesIO(lzma.decompress(data))), order)
+
+
+def _write_flac(path: str, samples: np.ndarray) -> None:
+    import soundfile  # only needed for FLAC
+    samples = samples if samples.dtype == np.int16 else quantize(samples)
+    soundfile.write(path, samples, 44100, subtype='PCM_16')
+
+
+def _write_wav(path: str, samples: np.ndarray) -> None:
+    wav_file = WavFile(path)
+    wav_file.write_samples(samples)
+    wav_file.close()
+
+
+def _write_pcm(path: str, samples: np.ndarray) -> None:
+    # writes 16 bit integers as they are, converting them to floats first could change them
+    with wave.open(path, 'w') as wav_file:
+        wav_file.setparams((1, 2, 44100, 0, 'NONE', 'not compressed'))  # like WavFile
+        wav_file.writeframesraw(np.asarray(samples, dtype='<i2').tobytes())
+
+
+class WavetableExporter:
+    """Writes the wavetables of a sweep to samples/ (or samples.bank) in a
+    thread pool, so the encoding and compression of many settings overlap.
+    """
+
+    def __init__(self, path: str, export_format: str = 'wav', max_workers: Optional[int] = None):
+        """Prepares the export.
+
+        :param path: The directory of the sweep.
+        :param export_format: 'wav', 'flac' or 'bank', see above.
+        :param max_workers: The number of encoding threads, see ThreadPoolExecutor.
+        """
+        if export_format not in formats:
+            raise ValueError(f'Unknown export format {export_format}, use one of {formats}.')
+        self.path = path
+        self.export_format = export_format
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='export')
+        self.futures = []  # type: List[Tuple[str, Future]]
+        if export_format != 'bank':
+            os.makedirs(os.path.join(path, 'samples'), exist_ok=True)
+
+    def save(self, filename_prefix: str, wavetables: Sequence[np.ndarray]) -> None:
+        """Exports the wavetables of a setting, like GPSynth.save_wavetables.
+
+        :param filename_prefix: The prefix of the filenames, see wavetable_prefix.
+        :param wavetables: The wavetables.
+        """
+        wavetables = [np.array(wavetable) for wavetable in wavetables]  # the caller may reuse its arrays
+        if self.export_format == 'bank':
+            self.futures.append((filename_prefix, self.executor.submit(self._encode, wavetables)))
+            return
+        write = _write_flac if self.export_format == 'flac' else _write_wav
+        for i, wavetable in enumerate(wavetables):
+            location = os.path.join(self.path, 'samples', filename_prefix + f'{i:02d}.{self.export_format}')
+            self.futures.append((location, self.executor.submit(write, location, wavetable)))
+
+    @staticmethod
+    def _encode(wavetables: List[np.ndarray]) -> Tuple[bytes, int, int, int]:
+        with metrics.timer('export_encode'):
+            data, order = encode_block(quantize(np.stack(wavetables)))
+        return data, order, len(wavetables), wavetables[0].shape[0]
+
+    def close(self) -> None:
+        """Waits for the export and compresses c.wav, if the sweep wrote one."""
+        notes_path = os.path.join(self.path, 'c.wav')
+        has_notes = self.export_format != 'wav' and os.path.exists(notes_path)
+        if has_notes:
+            with wave.open(notes_path, 'r') as wav_file:
+                notes = np.frombuffer(wav_file.readframes(wav_file.getnframes()), dtype='<i2')
+        if has_notes and self.export_format == 'flac':
+            self.futures.append(('c.flac', self.executor.submit(_write_flac, os.path.join(self.path, 'c.flac'),
+                                                                notes)))
+        if has_notes and self.export_format == 'bank':
+            for start in range(0, notes.size, NOTES_CHUNK):
+                chunk = notes[start:start + NOTES_CHUNK]
+                # the notes are not smooth enough for deltas to help
+                self.futures.append((f'{NOTES}.{start // NOTES_CHUNK:04d}', self.executor.submit(
+                    lambda c: encode_block(c, orders=(0,)) + (1, c.size), chunk)))
+
+        if self.export_format == 'bank':
+            index = {}
+            with zipfile.ZipFile(os.path.join(self.path, BANK_NAME), 'w', zipfile.ZIP_STORED) as bank:
+                for name, future in self.futures:
+                    data, order, n, size = future.result()
+                    bank.writestr(name, data)
+                    index[name] = {'order': order, 'n': n, 'size': size}
+                bank.writestr('index.json', json.dumps(index))
+        else:
+            for _, future in self.futures:
+                future.result()
+        self.executor.shutdown()
+        self.futures = []
+        if has_notes:
+            os.remove(notes_path)
+
+
+class WavetableBank:
+    """Reads a samples.bank. The tables of a setting are only decompressed
+    when one of them is accessed, and the last few settings are kept.
+    """
+
+    def __init__(self, path: str):
+        """Opens the bank.
+
+        :param path: The bank file, or the directory of the sweep.
+        """
+        if os.path.isdir(path):
+            path = os.path.join(path, BANK_NAME)
+        self.zip_file = zipfile.ZipFile(path, 'r')
+        self.index = json.loads(self.zip_file.read('index.json'))
+        self.names = [prefix + f'{i:02d}.wav' for prefix, entry in self.index.items()
+                      if not prefix.startswith(NOTES) for i in range(entry['n'])]
+        self._decode = functools.lru_cache(maxsize=16)(self._decode_member)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.names)
+
+    def _decode_member(self, name: str) -> np.ndarray:
+        with metrics.timer('export_decode'):
+            return decode_block(self.zip_file.read(name), self.index[name]['order'])
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        """Returns a wavetable.
+
+        :param name: The name of the WAV file the wavetable would have in
+            samples/, e.g. 'RBF_l003_n02.wav'.
+        :return: The samples between -1. and 1., like read_wav.
+        """
+        return self.pcm(name) / (math.pow(2, 15) - 1)
+
+    def pcm(self, name: str) -> np.ndarray:
+        """Returns a wavetable as 16 bit integers, as stored in its WAV file.
+
+        :param name: The name of the WAV file, see __getitem__.
+        :return: The integer samples.
+        """
+        prefix, number = name[:-len('00.wav')], int(name[-len('00.wav'):-len('.wav')])
+        if prefix not in self.index or number >= self.index[prefix]['n']:
+            raise KeyError(name)
+        return self._decode(prefix)[number]
+
+    def notes(self) -> Optional[np.ndarray]:
+        """The notes of c.wav as 16 bit integers, or None if the bank has none."""
+        chunks = sorted(name for name in self.index if name.startswith(NOTES))
+        if not chunks:
+            return None
+        return np.concatenate([decode_block(self.zip_file.read(name), self.index[name]['order']) for name in chunks])
+
+    def close(self) -> None:
+        """Closes the bank."""
+        self.zip_file.close()
+
+
+def to_wav(path: str) -> int:
+    """Converts a compressed export back to the WAV files of a normal one:
+    samples/*.wav and c.wav.
+
+    :param path: The directory of the sweep.
+    :return: The number of written wavetables.
+    """
+    samples_dir = os.path.join(path, 'samples')
+    os.makedirs(samples_dir, exist_ok=True)
+    written = 0
+    if os.path.exists(os.path.join(path, BANK_NAME)):
+        bank = WavetableBank(path)
+        for name in bank:
+            _write_pcm(os.path.join(samples_dir, name), bank.pcm(name))
+            written += 1
+        notes = bank.notes()
+        if notes is not None:
+            _write_pcm(os.path.join(path, 'c.wav'), notes)
+        bank.close()
+
+    conversions = [(os.path.join(samples_dir, f), os.path.join(samples_dir, f[:-len('.flac')] + '.wav'))
+                   for f in sorted(os.listdir(samples_dir)) if f.endswith('.flac')]
+    written += len(conversions)
+    if os.path.exists(os.path.join(path, 'c.flac')):
+        conversions.append((os.path.join(path, 'c.flac'), os.path.join(path, 'c.wav')))
+    if conversions:
+        import soundfile  # only needed for FLAC
+        for flac_path, wav_path in conversions:
+            samples, _ = soundfile.read(flac_path, dtype='int16')
+            _write_pcm(wav_path, samples)
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert a compressed export back to WAV files')
+    parser.add_argument('path', type=str, help='the directory of the sweep')
+    args = parser.parse_args()
+    print(f'{to_wav(args.path)} wavetables written to {os.path.join(args.path, "samples")}')
+
+
+if __name__ == '__main__':
+    main()
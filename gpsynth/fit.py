@@ -0,0 +1,161 @@
+from __future__ import annotations
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Sequence, Union
+
+import numpy as np
+
+from gpsynth._lazy import LazyModule
+from gpsynth.synthesizer import all_kernels, kernel_for_string
+
+GPy = LazyModule('GPy')
+signal = LazyModule('scipy.signal')
+wavfile = LazyModule('scipy.io.wavfile')
+
+
+def load_target(target: Union[str, np.ndarray], n_points: int = 128) -> np.ndarray:
+    """Loads a single-cycle waveform and decimates it for fitting.
+
+    :param target: Path of a WAV file holding one cycle, or the samples.
+    :param n_points: The number of points the cycle is resampled to.
+    :return: The resampled cycle with zero mean and unit variance.
+    """
+    if isinstance(target, str):
+        _, target = wavfile.read(target)
+        if target.ndim > 1:
+            target = target[:, 0]
+    y = signal.resample(np.asarray(target, dtype=float), n_points)  # the cycle is periodic, so FFT resampling fits
+    y = y - np.mean(y)
+    return y / (np.std(y) + 1e-12)
+
+
+def profile_log_likelihoods(kernel_name: str, y: np.ndarray, lengthscales: np.ndarray,
+                            nugget: float = 1e-6) -> np.ndarray:
+    """Evaluates the log marginal likelihood of the target for many
+    length-scales at once. The signal variance is profiled out analytically,
+    so only the shape of the covariance matters.
+
+    :param kernel_name: The name of the kernel.
+    :param y: The decimated target from load_target.
+    :param lengthscales: The length-scales to evaluate.
+    :param nugget: Relative jitter added to the diagonal for stability.
+    :return: The log likelihoods, one per length-scale.
+    """
+    n = y.size
+    xs = (np.arange(n) * 2. * np.pi / n)[:, None]
+    covs = np.stack([kernel_for_string(kernel_name, lengthscale).K(xs, xs) for lengthscale in lengthscales])
+    covs = covs + np.eye(n) * nugget * np.mean(np.diagonal(covs, axis1=1, axis2=2), axis=1)[:, None, None]
+
+    log_likelihoods = np.full(len(lengthscales), -np.inf)
+    try:
+        choleskys = np.linalg.cholesky(covs)
+        valid = np.ones(len(lengthscales), dtype=bool)
+    except np.linalg.LinAlgError:
+        # factorize one by one to find the ones that are not positive definite
+        choleskys = np.zeros_like(covs)
+        valid = np.zeros(len(lengthscales), dtype=bool)
+        for i, cov in enumerate(covs):
+            try:
+                choleskys[i] = np.linalg.cholesky(cov)
+                valid[i] = True
+            except np.linalg.LinAlgError:
+                pass
+
+    alphas = np.linalg.solve(choleskys[valid], np.broadcast_to(y[:, None], (int(valid.sum()), n, 1)))[..., 0]
+    quadratic = np.sum(alphas ** 2, axis=1)
+    log_det = 2. * np.sum(np.log(np.diagonal(choleskys[valid], axis1=1, axis2=2)), axis=1)
+    scale = quadratic / n  # the maximum likelihood signal variance
+    log_likelihoods[valid] = -0.5 * (n * np.log(scale) + log_det + n + n * np.log(2. * np.pi))
+    return log_likelihoods
+
+
+def fit_kernel(kernel_name: str, y: np.ndarray, lengthscales: Optional[np.ndarray] = None,
+               n_starts: int = 3, refine: bool = True) -> dict:
+    """Fits the length-scale of a kernel to the target.
+
+    The likelihood is evaluated on a grid of length-scales first. The best
+    grid points are then refined by optimizing the GPy model.
+
+    :param kernel_name: The name of the kernel.
+    :param y: The decimated target from load_target.
+    :param lengthscales: The grid of length-scales, the one of big_sweep if None.
+    :param n_starts: The number of best grid points the optimization starts from.
+    :param refine: Optimize with GPy after the grid search?
+    :return: The kernel name, the length-scale and the log likelihood. If
+        refined, also the variance, and the log likelihood is the one of the
+        GPy model with these parameters and a noise variance of 1e-6. All
+        other parameters of the kernel keep their defaults.
+    """
+    if lengthscales is None:
+        lengthscales = np.geomspace(0.01, np.pi, 16)
+    log_likelihoods = profile_log_likelihoods(kernel_name, y, lengthscales)
+    best = int(np.argmax(log_likelihoods))
+    result = {'kernel': kernel_name, 'lengthscale': float(lengthscales[best]),
+              'log_likelihood': float(log_likelihoods[best])}
+    if not refine or not np.isfinite(log_likelihoods[best]):
+        return result
+
+    xs = (np.arange(y.size) * 2. * np.pi / y.size)[:, None]
+    best_refined = -np.inf  # ranked among themselves, as the grid uses a relative nugget
+    for start in np.argsort(log_likelihoods)[::-1][:n_starts]:
+        kernel = kernel_for_string(kernel_name, lengthscales[start])
+        for parameter in kernel.flattened_parameters:  # e.g. the period or the power of RatQuad
+            if parameter.name not in ('lengthscale', 'variance'):
+                parameter.fix()
+        model = GPy.models.GPRegression(xs, y[:, None], kernel)
+        model.Gaussian_noise.variance = 1e-6
+        model.Gaussian_noise.variance.fix()
+        try:
+            model.optimize(max_iters=200)
+        except np.linalg.LinAlgError:
+            continue
+        log_likelihood = float(model.log_likelihood())
+        if log_likelihood > best_refined:
+            best_refined = log_likelihood
+            if hasattr(kernel, 'lengthscale'):
+                result['lengthscale'] = float(kernel.lengthscale[0])
+            result['variance'] = float(kernel.variance[0])
+            result['log_likelihood'] = log_likelihood
+    return result
+
+
+def fit_kernels(target: Union[str, np.ndarray], kernel_names: Sequence[str] = tuple(all_kernels),
+                n_points: int = 128, n_starts: int = 3, refine: bool = True,
+                processes: Optional[int] = None) -> List[dict]:
+    """Finds the kernels and length-scales that explain a target waveform best.
+
+    :param target: Path of a WAV file holding one cycle, or the samples.
+    :param kernel_names: The candidate kernels.
+    :param n_points: The number of points the cycle is decimated to.
+    :param n_starts: The number of starts of the optimization per kernel.
+    :param refine: Optimize with GPy after the grid search?
+    :param processes: The number of processes fitting the kernels in
+        parallel, the number of CPUs if None. 1 fits in this process.
+    :return: The fits of every kernel, best first, see fit_kernel.
+    """
+    y = load_target(target, n_points)
+    args = [(name, y, None, n_starts, refine) for name in kernel_names]
+    if processes == 1:
+        results = [fit_kernel(*a) for a in args]
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            results = list(executor.map(fit_kernel, *zip(*args)))
+    return sorted(results, key=lambda r: r['log_likelihood'], reverse=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fit kernels to a single-cycle waveform')
+    parser.add_argument('target', type=str, help='WAV file holding one cycle of the target waveform')
+    parser.add_argument('--top', type=int, default=5, help='the number of candidates that are printed')
+    parser.add_argument('--points', type=int, default=128, help='the number of points the cycle is decimated to')
+    parser.add_argument('--no-refine', action='store_true', help='only search the grid of length-scales')
+    args = parser.parse_args()
+
+    for result in fit_kernels(args.target, n_points=args.points, refine=not args.no_refine)[:args.top]:
+        print(f'{result["kernel"]:20s} lengthscale={result["lengthscale"]:.4f} '
+              f'log likelihood={result["log_likelihood"]:.2f}')
+
+
+if __name__ == '__main__':
+    main()
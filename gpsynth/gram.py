@@ -0,0 +1,133 @@
+from __future__ import annotations
+
+import functools
+from typing import Callable, Dict, Iterator, Optional, Sequence, Tuple
+
+import numpy as np
+
+import gpsynth.config as config
+import gpsynth.metrics as metrics
+from gpsynth._lazy import LazyModule
+from gpsynth.synthesizer import is_periodic, jitchol, kernel_for_string
+
+GPy = LazyModule('GPy')
+
+# Closed forms of the kernels of kernel_for_string that depend on the distance
+# d only, as functions of (d, lengthscale). They match GPy with the variances
+# used by kernel_for_string.
+stationary_kernels = {
+    'RBF': lambda d, l: np.exp(-0.5 * (d / l) ** 2),
+    'ExpQuad': lambda d, l: np.exp(-0.5 * (d / l) ** 2),
+    'Exponential': lambda d, l: np.exp(-d / l),
+    'OU': lambda d, l: np.exp(-d / l),
+    'Matern32': lambda d, l: (1. + np.sqrt(3.) * d / l) * np.exp(-np.sqrt(3.) * d / l),
+    'Matern52': lambda d, l: (1. + np.sqrt(5.) * d / l + 5. / 3. * (d / l) ** 2) * np.exp(-np.sqrt(5.) * d / l),
+    'RatQuad': lambda d, l: (1. + 0.5 * (d / l) ** 2) ** -2.,
+    'StdPeriodic': lambda d, l: np.exp(-0.5 * (np.sin(d / 2.) / l) ** 2),  # period 2 pi
+}  # type: Dict[str, Callable[[np.ndarray, np.ndarray], np.ndarray]]
+
+
+def grid_xs(waveshaping: bool = False) -> np.ndarray:
+    """The inputs of the covariance, see make_cov_cholesky and
+    make_cov_cholesky_waveshaping.
+
+    :param waveshaping: Should waveshaping be used?
+    :return: The inputs.
+    """
+    samples = 44100 / 20
+    if not waveshaping:
+        return np.arange(samples + 1) * 2. * np.pi / samples
+    return np.sin(np.arange(samples) * 2. * np.pi / samples)
+
+
+@functools.lru_cache(maxsize=2)
+def distance_table(waveshaping: bool = False) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """The pairwise distances of grid_xs, computed once per grid.
+
+    The wavetable grid is uniform, so there are only n distinct distances and
+    a stationary kernel only has to be evaluated at those. The waveshaping
+    grid is not, there the distance matrix itself is returned.
+
+    :param waveshaping: Should waveshaping be used?
+    :return: The distinct distances and the matrix of their indices, such
+        that distances[index] is the distance matrix. The index is None if
+        the distances are the matrix.
+    """
+    xs = grid_xs(waveshaping)
+    if not waveshaping:
+        i = np.arange(xs.size)
+        return xs - xs[0], np.abs(i[:, None] - i[None, :])
+    return np.abs(xs[:, None] - xs[None, :]), None
+
+
+def gram_stack(kernel_name: str, lengthscales: Sequence[float], waveshaping: bool = False) -> np.ndarray:
+    """Computes the covariance matrices of a kernel on the wavetable (or
+    waveshaping) grid for several length-scales.
+
+    Stationary kernels are evaluated with one NumPy expression over the
+    distances of the grid, the others with GPy.
+
+    :param kernel_name: The name of the kernel, see kernel_for_string.
+    :param lengthscales: The length-scales.
+    :param waveshaping: Should waveshaping be used?
+    :return: The covariances with shape (length-scales, n, n).
+    """
+    if kernel_name in stationary_kernels:
+        distances, index = distance_table(waveshaping)
+        lengthscales = np.asarray(lengthscales, dtype=float).reshape((-1,) + (1,) * distances.ndim)
+        covs = stationary_kernels[kernel_name](distances[None], lengthscales)
+        return covs if index is None else covs[:, index]
+    xs = grid_xs(waveshaping)[:, None]
+    return np.stack([kernel_for_string(kernel_name, lengthscale).K(xs, xs) for lengthscale in lengthscales])
+
+
+def condition_on_endpoints(covs: np.ndarray, both: bool) -> np.ndarray:
+    """Conditions the covariances on the wavetable being zero at the start
+    (and at the end), like the regression in make_cov_cholesky.
+
+    :param covs: The prior covariances with shape (settings, n, n).
+    :param both: Also condition on the end?
+    :return: The posterior covariances.
+    """
+    idx = [0, covs.shape[1] - 1] if both else [0]
+    k_xX = covs[:, :, idx]
+    k_XX = covs[:, idx][:, :, idx] + np.eye(len(idx)) * 1e-8  # the jitter of GPy's exact inference
+    return covs - k_xX @ np.linalg.solve(k_XX, np.swapaxes(k_xX, 1, 2))
+
+
+def grid_choleskys(kernel_name: str, lengthscales: Sequence[float], waveshaping: bool = False,
+                   batch_size: int = None) -> Iterator[np.ndarray]:
+    """Computes the Cholesky decompositions of make_cov_cholesky (or
+    make_cov_cholesky_waveshaping) for a kernel and several length-scales.
+
+    The distances of the grid are computed once and the covariances of a
+    batch of length-scales are evaluated and conditioned as stacks, instead of
+    a GPy regression per setting. The factors are stacked as well, so they can be
+    passed to sample_grid.
+
+    :param kernel_name: The name of the kernel, see kernel_for_string.
+    :param lengthscales: The length-scales.
+    :param waveshaping: Should waveshaping be used?
+    :param batch_size: The number of length-scales per batch,
+        config.gram_batch_size if None.
+    :return: The Cholesky decompositions in batches with shape
+        (length-scales, n, n), in the order of the length-scales.
+    """
+    batch_size = batch_size or config.gram_batch_size
+    conditioned = not waveshaping
+    if conditioned:
+        # all kernels of one name are periodic or not, regardless of the length-scale
+        both = not is_periodic(kernel_for_string(kernel_name)) and config.good_continuation_regression
+
+    for start in range(0, len(lengthscales), batch_size):
+        batch = lengthscales[start:start + batch_size]
+        with metrics.timer('covariance', kernel=kernel_name):
+            covs = gram_stack(kernel_name, batch, waveshaping)
+            if conditioned:
+                covs = condition_on_endpoints(covs, both)
+        # LAPACK factorizes a stack one matrix at a time anyway, so factorizing
+        # them separately costs nothing and only retries the ones needing jitter
+        choleskys = np.empty(covs.shape, dtype=config.dtype)
+        for i, cov in enumerate(covs):
+            choleskys[i] = jitchol(cov, kernel_name)
+        yield choleskys
@@ -0,0 +1,295 @@
+import json
+import os
+import socket
+import threading
+import time
+import wave
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+import gpsynth.metrics as metrics
+from gpsynth.audio_output import WavFile
+from gpsynth.similarity import SimilarityIndex
+from gpsynth.synthesizer import GPSynth, kernel_for_score_entry, make_seeds, sweep_settings, wavetable_prefix
+
+# A job queue in a directory, which can be shared by workers on several hosts:
+#
+#   queue.json      the parameters of the sweep
+#   pending/        the jobs that nobody works on, one JSON file each
+#   claimed/        the jobs that a worker works on
+#   done/           the results of the finished jobs
+#
+# A worker claims a job by renaming it from pending/ to claimed/, which is
+# atomic, so only one worker gets it. While the worker is busy, it renews its
+# lease by touching the claimed file. Claims whose lease expired, e.g. because
+# the worker died, are moved back to pending/. Jobs must give the same result
+# when they are done twice, which can happen if a worker only stalls.
+
+Handler = Callable[[dict, str], dict]
+
+
+def _tmp_path(path: str) -> str:
+    # files are written next to their destination and renamed, so readers never see a partial file
+    return f'{path}.{socket.gethostname()}-{os.getpid()}.tmp'
+
+
+def _write_json(path: str, data) -> None:
+    tmp_path = _tmp_path(path)
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=4)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path: str):
+    with open(path) as f:
+        return json.load(f)
+
+
+def enqueue(job_dir: str, jobs: List[dict], parameters: Optional[dict] = None) -> None:
+    """Creates a job queue.
+
+    :param job_dir: The directory of the queue, it is created if needed.
+    :param jobs: The jobs, they are passed to the handler of the workers.
+    :param parameters: Parameters shared by all jobs, saved as queue.json.
+    """
+    for name in ['pending', 'claimed', 'done']:
+        os.makedirs(os.path.join(job_dir, name), exist_ok=True)
+    _write_json(os.path.join(job_dir, 'queue.json'), dict(parameters or {}, n_jobs=len(jobs)))
+    for i, job in enumerate(jobs):
+        _write_json(os.path.join(job_dir, 'pending', f'{i:06d}.json'), dict(job, id=i))
+
+
+def claim(job_dir: str) -> Optional[str]:
+    """Claims the next pending job.
+
+    :param job_dir: The directory of the queue.
+    :return: The file name of the job, or None if no job is pending.
+    """
+    for name in sorted(os.listdir(os.path.join(job_dir, 'pending'))):
+        claimed = os.path.join(job_dir, 'claimed', name)
+        try:
+            os.rename(os.path.join(job_dir, 'pending', name), claimed)
+        except FileNotFoundError:  # another worker was faster
+            continue
+        os.utime(claimed)  # the lease starts now, renaming keeps the time of the pending file
+        if os.path.exists(os.path.join(job_dir, 'done', name)):  # finished after its lease expired
+            _remove(claimed)
+            continue
+        return name
+    return None
+
+
+def release_expired(job_dir: str, lease: float) -> int:
+    """Moves the claimed jobs whose lease expired back to pending.
+
+    :param job_dir: The directory of the queue.
+    :param lease: The time in seconds after which a claim expires, unless it is renewed.
+    :return: The number of released jobs.
+    """
+    released = 0
+    now = time.time()
+    for name in os.listdir(os.path.join(job_dir, 'claimed')):
+        claimed = os.path.join(job_dir, 'claimed', name)
+        try:
+            if now - os.path.getmtime(claimed) < lease:
+                continue
+            os.rename(claimed, os.path.join(job_dir, 'pending', name))
+        except FileNotFoundError:  # finished or released by another worker
+            continue
+        released += 1
+        metrics.count('jobs_released_total')
+    return released
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _renew(path: str, interval: float, stop: threading.Event) -> None:
+    while not stop.wait(interval):
+        try:
+            os.utime(path)
+        except FileNotFoundError:  # released, the job will be done again
+            return
+
+
+def run_worker(job_dir: str, handler: Handler, lease: float = 600., poll: float = 1.,
+               max_jobs: Optional[int] = None) -> int:
+    """Works on the jobs of a queue until all are done.
+
+    :param job_dir: The directory of the queue.
+    :param handler: Is called with a job and the directory of the queue and
+        returns the result of the job, which must be JSON serializable. If it
+        raises an exception, the job is done with the error instead of a
+        result, so that it does not stop one worker after the other.
+    :param lease: The time in seconds after which the claim of a worker that
+        stopped renewing it expires.
+    :param poll: The time in seconds between checks while other workers hold
+        the remaining jobs.
+    :param max_jobs: Stop after this many jobs if not None.
+    :return: The number of jobs done by this worker.
+    """
+    worker = f'{socket.gethostname()}-{os.getpid()}'
+    n_done = 0
+    while max_jobs is None or n_done < max_jobs:
+        name = claim(job_dir)
+        if name is None:
+            if release_expired(job_dir, lease) > 0:
+                continue
+            if not os.listdir(os.path.join(job_dir, 'claimed')):
+                break
+            time.sleep(poll)
+            continue
+
+        claimed = os.path.join(job_dir, 'claimed', name)
+        stop = threading.Event()
+        renewal = threading.Thread(target=_renew, args=(claimed, lease / 3., stop), daemon=True)
+        renewal.start()
+        try:
+            job = _read_json(claimed)
+            try:
+                with metrics.timer('job'):
+                    record = {'result': handler(job, job_dir)}
+            except Exception as e:  # the job would fail again, e.g. a covariance that is not positive definite
+                metrics.count('jobs_failed_total')
+                record = {'error': f'{type(e).__name__}: {e}'}
+            _write_json(os.path.join(job_dir, 'done', name), dict(record, id=job['id'], worker=worker))
+        finally:
+            stop.set()
+            renewal.join()
+        _remove(claimed)
+        metrics.count('jobs_done_total')
+        n_done += 1
+    return n_done
+
+
+def results(job_dir: str, skip_failed: bool = False) -> List[Optional[dict]]:
+    """The results of all jobs of a queue.
+
+    :param job_dir: The directory of the queue.
+    :param skip_failed: Return None for the failed jobs, see failures,
+        instead of raising a RuntimeError.
+    :return: The results in the order of the jobs.
+    """
+    n_jobs = _read_json(os.path.join(job_dir, 'queue.json'))['n_jobs']
+    names = [f'{i:06d}.json' for i in range(n_jobs)]
+    missing = [name for name in names if not os.path.exists(os.path.join(job_dir, 'done', name))]
+    if missing:
+        raise RuntimeError(f'{len(missing)} of {n_jobs} jobs are not done yet, e.g. {missing[0]}.')
+    records = [_read_json(os.path.join(job_dir, 'done', name)) for name in names]
+    failed = [record for record in records if 'error' in record]
+    if failed and not skip_failed:
+        raise RuntimeError(f'{len(failed)} of {n_jobs} jobs failed, e.g. job {failed[0]["id"]}: '
+                           f'{failed[0]["error"]}')
+    return [record.get('result') for record in records]
+
+
+def failures(job_dir: str) -> Dict[int, str]:
+    """The errors of the failed jobs of a queue.
+
+    :param job_dir: The directory of the queue.
+    :return: The errors by the number of the job.
+    """
+    records = [_read_json(os.path.join(job_dir, 'done', name))
+               for name in sorted(os.listdir(os.path.join(job_dir, 'done'))) if name.endswith('.json')]
+    return {record['id']: record['error'] for record in records if 'error' in record}
+
+
+def enqueue_sweep(job_dir: str, all_kernels: List[str], ls_subdivisions: int = 16, n_wavetables: int = 7,
+                  seed: Optional[int] = None, common_seeds: bool = False, n_combinations: int = 1000) -> None:
+    """Creates a job queue with the settings of big_sweep, see render_setting
+    and merge_sweep.
+
+    The tables of a job are drawn from a generator seeded with the seed and
+    the number of the job, so the result does not depend on the worker.
+
+    :param job_dir: The directory of the queue.
+    :param all_kernels: The list of all kernels.
+    :param ls_subdivisions: Number of length-scale subdivisions.
+    :param n_wavetables: The number of (randomized) wavetables per setting.
+    :param seed: Makes the sweep reproducible if not None.
+    :param common_seeds: Should all settings share the same seed matrix?
+    :param n_combinations: The number of random combinations of two kernels.
+    """
+    if seed is None:
+        seed = int(np.random.SeedSequence().entropy % 2 ** 63)
+    settings = sweep_settings(all_kernels, ls_subdivisions, seed, n_combinations)
+    enqueue(job_dir, [{'setting': setting} for setting in settings],
+            {'n_wavetables': n_wavetables, 'seed': seed, 'common_seeds': common_seeds})
+
+
+def render_setting(job: dict, job_dir: str) -> dict:
+    """Draws the wavetables of a setting of enqueue_sweep into samples/ and
+    renders its note into notes/.
+
+    :param job: The job.
+    :param job_dir: The directory of the queue.
+    :return: The entry of the setting in the score, without the timing.
+    """
+    parameters = _read_json(os.path.join(job_dir, 'queue.json'))
+    setting = job['setting']
+    seeds = make_seeds(parameters['n_wavetables'], parameters['seed']) if parameters['common_seeds'] else None
+    rng = np.random.default_rng([parameters['seed'], job['id']])
+
+    notes_dir = os.path.join(job_dir, 'notes')
+    samples_dir = os.path.join(job_dir, 'samples')
+    for directory in [notes_dir, samples_dir]:
+        os.makedirs(directory, exist_ok=True)  # workers start at the same time
+    note_path = os.path.join(notes_dir, f'{job["id"]:06d}.wav')
+    out_wav = WavFile(_tmp_path(note_path))
+    synth = GPSynth(kernel_for_score_entry(setting), out_rt=None, out_wav=out_wav,
+                    n_wavetables=parameters['n_wavetables'], waveshaping=setting['waveshaping'], rng=rng, seeds=seeds)
+    synth.note(60, 1.)
+    out_wav.close()
+    os.replace(_tmp_path(note_path), note_path)
+    for i, wavetable in enumerate(synth.wavetables):
+        # like the note, so a worker that dies leaves no truncated tables
+        location = os.path.join(samples_dir, wavetable_prefix(setting) + f'{i:02d}.wav')
+        wav_file = WavFile(_tmp_path(location))
+        wav_file.write_samples(wavetable)
+        wav_file.close()
+        os.replace(_tmp_path(location), location)
+    return dict(setting, n_wavetables=len(synth.wavetables))
+
+
+def merge_sweep(job_dir: str, path: Optional[str] = None) -> List[dict]:
+    """Assembles the results of a finished sweep queue like the output of
+    big_sweep: c.wav, score.json and similarity.npz. Failed jobs are
+    reported and left out.
+
+    :param job_dir: The directory of the queue.
+    :param path: The output directory, the directory of the queue if None.
+        The wavetables stay in samples/ of the queue.
+    :return: The score.
+    """
+    path = job_dir if path is None else path
+    entries = results(job_dir, skip_failed=True)
+    for i, error in failures(job_dir).items():
+        print(f'job {i} failed and is left out: {error}')
+    score = []
+    with wave.open(os.path.join(path, 'c.wav'), 'w') as out_long:
+        out_long.setparams((1, 2, 44100, 0, 'NONE', 'not compressed'))  # like WavFile
+        sample_offset = 0
+        for i, entry in enumerate(entries):
+            if entry is None:
+                continue
+            with wave.open(os.path.join(job_dir, 'notes', f'{i:06d}.wav'), 'r') as note:
+                sample_count = note.getnframes()
+                out_long.writeframesraw(note.readframes(sample_count))
+            entry = dict(entry)
+            del entry['n_wavetables']
+            score.append(dict(entry, time=float(len(score)), note=0, sample_offset=sample_offset,
+                              sample_count=sample_count))
+            sample_offset += sample_count
+
+    with open(os.path.join(path, 'score.json'), 'w') as f:
+        json.dump(score, f, indent=4)
+
+    index = SimilarityIndex()
+    index.update_from_directory(os.path.join(job_dir, 'samples'))
+    index.save(os.path.join(path, 'similarity.npz'))
+    return score
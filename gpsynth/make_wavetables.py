@@ -1,22 +1,73 @@
 import argparse
 import datetime as dt
 import os
+import socket
 
-from gpsynth.synthesizer import big_sweep, all_kernels
 
-parser = argparse.ArgumentParser(description='Generate wavetables with Gaussian Processes')
-parser.add_argument('path', metavar='path', type=str, nargs='?', default=None,
-                    help='the parent directory, where the result is stored')
-parser.add_argument('--lsdiv', metavar='N', type=int, required=False, default=16,
-                    help='the number of lengthscale subdivisions')
-parser.add_argument('--wavetables', metavar='N', type=int, required=False, default=7,
-                    help='the number of (randomized) wavetables per setting of kernel and lengthscale')
-args = parser.parse_args()
+def main():
+    parser = argparse.ArgumentParser(description='Generate wavetables with Gaussian Processes')
+    parser.add_argument('path', metavar='path', type=str, nargs='?', default=None,
+                        help='the parent directory, where the result is stored')
+    parser.add_argument('--lsdiv', metavar='N', type=int, required=False, default=16,
+                        help='the number of lengthscale subdivisions')
+    parser.add_argument('--wavetables', metavar='N', type=int, required=False, default=7,
+                        help='the number of (randomized) wavetables per setting of kernel and lengthscale')
+    parser.add_argument('--seed', metavar='N', type=int, required=False, default=None,
+                        help='makes the sweep reproducible')
+    parser.add_argument('--common-seeds', action='store_true',
+                        help='draw the n-th table of every setting with the same random numbers')
+    parser.add_argument('--metrics', action='store_true',
+                        help='save timings and counters of the pipeline to metrics.json and metrics.prom')
+    parser.add_argument('--format', type=str, choices=['wav', 'flac', 'bank'], default='wav',
+                        help='save the wavetables as WAV files, FLAC files (needs soundfile) or one compressed '
+                             'bank, see gpsynth.export')
+    parser.add_argument('--prune', metavar='SIMILARITY', type=float, nargs='?', const=0.9995, default=None,
+                        help='skip settings that sound like an earlier one and list them as its aliases in the score '
+                             '(default similarity: 0.9995)')
+    queue = parser.add_mutually_exclusive_group()
+    queue.add_argument('--enqueue', action='store_true',
+                       help='only write the settings as a job queue to path, instead of running the sweep')
+    queue.add_argument('--worker', action='store_true',
+                       help='work on the jobs of the queue in path, several workers may share it')
+    queue.add_argument('--merge', action='store_true',
+                       help='assemble the score, c.wav and the index of the finished queue in path')
+    parser.add_argument('--lease', metavar='SECONDS', type=float, required=False, default=600.,
+                        help='the time after which the job of a worker that stopped responding is retried')
+    args = parser.parse_args()
+    if (args.worker or args.merge) and args.path is None:
+        parser.error('--worker and --merge need the path of the queue')
+    if (args.enqueue or args.worker or args.merge) and (args.format != 'wav' or args.prune is not None):
+        # the workers draw every setting and merge_sweep writes WAV files
+        parser.error('--format and --prune are not supported with --enqueue, --worker and --merge')
 
-path = args.path
-if path is None:
-    dir_name = dt.datetime.now().strftime('%Y%m%d-%H%M') + '_multiexport'
-    path = os.path.join(os.getcwd(), dir_name)
+    # Imported after parsing, so that --help and argument errors are instant.
+    from gpsynth.synthesizer import big_sweep, all_kernels
+    import gpsynth.metrics as metrics
 
-os.makedirs(path, exist_ok=True)
-big_sweep(all_kernels, path, args.lsdiv, args.wavetables)
+    if args.metrics:
+        metrics.enable()
+
+    path = args.path
+    if path is None:
+        dir_name = dt.datetime.now().strftime('%Y%m%d-%H%M') + '_multiexport'
+        path = os.path.join(os.getcwd(), dir_name)
+
+    os.makedirs(path, exist_ok=True)
+    if args.enqueue:
+        from gpsynth.jobqueue import enqueue_sweep
+        enqueue_sweep(path, all_kernels, args.lsdiv, args.wavetables, seed=args.seed, common_seeds=args.common_seeds)
+    elif args.worker:
+        from gpsynth.jobqueue import render_setting, run_worker
+        run_worker(path, render_setting, lease=args.lease)
+        if metrics.is_enabled():
+            metrics.to_json(os.path.join(path, f'metrics_{socket.gethostname()}-{os.getpid()}.json'))
+    elif args.merge:
+        from gpsynth.jobqueue import merge_sweep
+        merge_sweep(path)
+    else:
+        big_sweep(all_kernels, path, args.lsdiv, args.wavetables, seed=args.seed, common_seeds=args.common_seeds,
+                  export_format=args.format, prune=args.prune)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+import json
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+# Instrumentation of the synthesis pipeline. It is disabled by default, then
+# timers and counters cost next to nothing.
+
+_enabled = False
+_lock = threading.Lock()
+_counters = {}  # (name, labels) -> value
+_timers = {}  # (stage, labels) -> [count, total seconds, max seconds]
+
+
+def enable() -> None:
+    """Starts collecting metrics."""
+    global _enabled
+    _enabled = True
+
+
+def disable() -> None:
+    """Stops collecting metrics. The collected metrics are kept."""
+    global _enabled
+    _enabled = False
+
+
+def is_enabled() -> bool:
+    """Are metrics being collected?"""
+    return _enabled
+
+
+def reset() -> None:
+    """Discards the collected metrics."""
+    with _lock:
+        _counters.clear()
+        _timers.clear()
+
+
+def _labels(labels: Dict[str, str]) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def count(name: str, value: float = 1., **labels) -> None:
+    """Increments a counter.
+
+    :param name: The name of the counter, e.g. 'draws_total'.
+    :param value: The increment.
+    :param labels: Labels distinguishing the counter, e.g. kernel='RBF'.
+    """
+    if not _enabled:
+        return
+    key = (name, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0.) + value
+
+
+class timer:
+    """Context manager measuring the time spent in a stage of the pipeline."""
+
+    def __init__(self, stage: str, **labels):
+        """Prepares the timer.
+
+        :param stage: The name of the stage, e.g. 'cholesky'.
+        :param labels: Labels distinguishing the timer, e.g. kernel='RBF'.
+        """
+        self.stage = stage
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self) -> 'timer':
+        if _enabled:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        if self.start is None:
+            return
+        elapsed = time.perf_counter() - self.start
+        key = (self.stage, _labels(self.labels))
+        with _lock:
+            entry = _timers.setdefault(key, [0, 0., 0.])
+            entry[0] += 1
+            entry[1] += elapsed
+            entry[2] = max(entry[2], elapsed)
+
+
+def summary() -> dict:
+    """Summarizes the collected metrics.
+
+    :return: The timers, the counters and the rejection rate of the draws per kernel.
+    """
+    with _lock:
+        timers = [{'stage': stage, 'labels': dict(labels), 'count': c, 'seconds': total, 'max_seconds': longest}
+                  for (stage, labels), (c, total, longest) in sorted(_timers.items())]
+        counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(_counters.items())]
+        draws = {dict(labels).get('kernel', ''): value for (name, labels), value in _counters.items()
+                 if name == 'draws_total'}
+        rejected = {dict(labels).get('kernel', ''): value for (name, labels), value in _counters.items()
+                    if name == 'draws_rejected_total'}
+    rejection_rate = {kernel: rejected.get(kernel, 0.) / n for kernel, n in sorted(draws.items()) if n > 0}
+    return {'timers': timers, 'counters': counters, 'rejection_rate': rejection_rate}
+
+
+def to_json(path: Optional[str] = None) -> str:
+    """Exports the summary as JSON.
+
+    :param path: The summary is also written to this file if not None.
+    :return: The JSON text.
+    """
+    text = json.dumps(summary(), indent=4)
+    if path is not None:
+        with open(path, 'w') as f:
+            f.write(text)
+    return text
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"') for value in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
+
+
+def to_prometheus() -> str:
+    """Exports the metrics in the Prometheus text format.
+
+    :return: The text.
+    """
+    s = summary()
+    lines = ['# TYPE gpsynth_stage_seconds summary']
+    for t in s['timers']:
+        labels = _format_labels(dict(stage=t['stage'], **t['labels']))
+        lines.append(f'gpsynth_stage_seconds_sum{labels} {t["seconds"]}')
+        lines.append(f'gpsynth_stage_seconds_count{labels} {t["count"]}')
+    declared = set()
+    for c in s['counters']:
+        name = 'gpsynth_' + c['name']
+        if name not in declared:
+            lines.append(f'# TYPE {name} counter')
+            declared.add(name)
+        lines.append(f'{name}{_format_labels(c["labels"])} {c["value"]}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,88 @@
+from typing import List, Optional, Union
+
+import numpy as np
+
+import gpsynth.config as config
+from gpsynth.audio_output import RealtimeAudio, WavFile
+from gpsynth.gram import grid_choleskys
+from gpsynth.synthesizer import GPSynth, make_seeds, normalize_draws
+
+
+class LengthscaleMorph:
+    """Morphs between wavetables of one kernel at arbitrary length-scales.
+
+    The covariance is factorized only at a grid of length-scales. All grid
+    points are sampled with the same random seeds, so that the n-th table
+    changes gradually along the grid. Tables at intermediate length-scales are
+    interpolated between the spectra of the two neighbouring grid points.
+    """
+
+    def __init__(self, kernel_name: str, lengthscales: np.ndarray, n_wavetables: int = 17,
+                 waveshaping: bool = False, rng: Union[None, int, np.random.Generator] = None):
+        """Computes the wavetables at the grid length-scales.
+
+        :param kernel_name: The name of the kernel.
+        :param lengthscales: The grid of length-scales.
+        :param n_wavetables: The number of (randomized) wavetables per length-scale.
+        :param waveshaping: Should waveshaping be used?
+        :param rng: The random number generator or a seed.
+        """
+        self.kernel_name = kernel_name
+        self.lengthscales = np.sort(np.asarray(lengthscales, dtype=float))
+        self.n_wavetables = n_wavetables
+        self.waveshaping = waveshaping
+
+        seeds = make_seeds(n_wavetables, rng)  # shared by all grid points
+        spectra = []
+        for choleskys in grid_choleskys(kernel_name, self.lengthscales, waveshaping):
+            draws = np.matmul(choleskys, seeds[:choleskys.shape[1]])[:, :-1]
+            spectra.append(np.fft.rfft(draws, axis=1))
+        self.table_size = draws.shape[1]
+        self.spectra = np.concatenate(spectra)  # (grid, frequency, wavetable)
+
+    def wavetables(self, lengthscale: float) -> List[np.ndarray]:
+        """Interpolates the wavetables at a length-scale. Values outside the
+        grid are clamped to its boundaries.
+
+        :param lengthscale: The length-scale parameter.
+        :return: A list of wavetables.
+        """
+        log_grid = np.log(self.lengthscales)
+        position = np.clip(np.log(lengthscale), log_grid[0], log_grid[-1])
+        idx = min(np.searchsorted(log_grid, position, side='right') - 1, len(log_grid) - 2)
+        if idx < 0:  # a grid with a single length-scale
+            spectrum = self.spectra[0]
+        else:
+            weight = (position - log_grid[idx]) / (log_grid[idx + 1] - log_grid[idx])
+            spectrum = interpolate_spectra(self.spectra[idx], self.spectra[idx + 1], weight)
+
+        draws = normalize_draws(np.fft.irfft(spectrum, n=self.table_size, axis=0).astype(config.dtype))
+        return [draws[:, i] for i in range(self.n_wavetables)]
+
+    def synth(self, lengthscale: float, out_rt: Optional[RealtimeAudio], out_wav: Optional[WavFile]) -> GPSynth:
+        """Makes a synthesizer playing the interpolated wavetables.
+
+        :param lengthscale: The length-scale parameter.
+        :param out_rt: Is used for real-time audio output if not None.
+        :param out_wav: Is used for saving the output to a WAV file if not None.
+        :return: The synthesizer.
+        """
+        return GPSynth(None, out_rt, out_wav, wavetables=self.wavetables(lengthscale))
+
+
+def interpolate_spectra(spectrum_a: np.ndarray, spectrum_b: np.ndarray, weight: float) -> np.ndarray:
+    """Interpolates two complex spectra. The magnitudes are interpolated
+    geometrically, the phases along the shorter arc.
+
+    :param spectrum_a: The spectrum at weight 0.
+    :param spectrum_b: The spectrum at weight 1.
+    :param weight: The interpolation weight between 0 and 1.
+    :return: The interpolated spectrum.
+    """
+    eps = 1e-12
+    magnitude_a = np.abs(spectrum_a) + eps
+    magnitude_b = np.abs(spectrum_b) + eps
+    magnitude = np.exp((1. - weight) * np.log(magnitude_a) + weight * np.log(magnitude_b))
+    phase = (1. - weight) * spectrum_a / magnitude_a + weight * spectrum_b / magnitude_b
+    phase = phase / (np.abs(phase) + eps)
+    return magnitude * phase
@@ -0,0 +1,190 @@
+import argparse
+import glob
+import json
+import os
+from typing import Dict, List, NamedTuple, Optional, Union
+
+import numpy as np
+
+from gpsynth.audio_output import WavFile, read_wav
+from gpsynth.synthesizer import GPSynth, band_limit, kernel_for_score_entry, kernel_for_string, render_scan, \
+    render_unison, render_wavetable, wavetable_prefix
+
+
+class NoteEvent(NamedTuple):
+    """A note of a score."""
+    time: float
+    midi_note: Union[int, float]
+    duration: float
+    synth: GPSynth
+    velocity: float = 1.
+
+
+class _Voice(NamedTuple):
+    start: int
+    samples_total: int
+    wavetable: np.ndarray
+    midi_note: Union[int, float]
+    velocity: float
+    synth: GPSynth
+    frame_start: float = 0.  # the position of a scan at the onset
+
+
+def render_score(events: List[NoteEvent], out_wav: WavFile, block_size: int = 4096, gain: float = 1.) -> None:
+    """Renders a polyphonic score offline. The voices are mixed block by block,
+    so the memory does not grow with the length of the piece.
+
+    Every note takes the next wavetable of its synthesizer and is played
+    like GPSynth.note, also by detuned voices if the synthesizer has a unison.
+    A synthesizer in scan mode continues its scan through the frames instead.
+
+    :param events: The notes, in any order.
+    :param out_wav: The WAV file the mix is written to. The mix has as many
+        channels, mono notes are played on all of them.
+    :param block_size: The number of samples mixed at once.
+    :param gain: The gain applied to the mix. The result is clipped to [-1, 1].
+    """
+    fs = 44100
+    events = sorted(events, key=lambda e: e.time)
+    end = max((int(e.time * fs) + int(e.duration * fs) for e in events), default=0)
+    band_limited = {}
+
+    voices = []
+    next_event = 0
+    block_start = 0
+    while block_start < end:
+        block_stop = min(block_start + block_size, end)
+        while next_event < len(events) and int(events[next_event].time * fs) < block_stop:
+            event = events[next_event]
+            synth = event.synth
+            frame_start = 0.
+            if synth.frames is not None:
+                key = (id(synth), 'frames', event.midi_note)
+                if key not in band_limited:
+                    band_limited[key] = band_limit(synth.frames, event.midi_note)
+                wavetable = band_limited[key]
+                frame_start = synth.scan_position
+                synth.scan_position += event.duration * synth.scan_rate
+            else:
+                band_limit_note = event.midi_note
+                if synth.voices is not None:
+                    band_limit_note += np.max(synth.voices[0]) / 100.  # no voice may alias, like GPSynth.note
+                wavetable = _next_band_limited(synth, band_limit_note, band_limited)
+            voices.append(_Voice(int(event.time * fs), int(event.duration * fs), wavetable, event.midi_note,
+                                 event.velocity, synth, frame_start))
+            next_event += 1
+
+        mix = np.zeros((block_stop - block_start, out_wav.channels), dtype=np.float32)
+        for voice in voices:
+            start = max(block_start, voice.start)
+            stop = min(block_stop, voice.start + voice.samples_total)
+            if start < stop:
+                mix[start - block_start:stop - block_start] += voice.velocity * _render_voice(
+                    voice, start - voice.start, stop - voice.start, out_wav.channels)
+        voices = [voice for voice in voices if voice.start + voice.samples_total > block_stop]
+
+        out_wav.write_samples(np.clip(mix * gain, -1., 1.))
+        block_start = block_stop
+
+
+def _render_voice(voice: _Voice, start: int, stop: int, channels: int) -> np.ndarray:
+    # A segment of a note with shape (samples, channels) or (samples, 1) for mono notes.
+    if voice.synth.frames is not None:
+        return render_scan(voice.wavetable, voice.midi_note, start, stop, voice.samples_total, voice.frame_start,
+                           voice.synth.scan_rate)[:, None]
+    if voice.synth.voices is not None:
+        detunes, pans, phases = voice.synth.voices
+        return render_unison(voice.wavetable, voice.midi_note, start, stop, voice.samples_total, detunes, pans, phases,
+                             channels)
+    return render_wavetable(voice.wavetable, voice.midi_note, start, stop, voice.samples_total)[:, None]
+
+
+def _next_band_limited(synth: GPSynth, midi_note: Union[int, float], cache: Dict[tuple, np.ndarray]) -> np.ndarray:
+    # Same as GPSynth.next_wavetable, but filters every table only once per pitch.
+    if synth.pool is not None and synth.pool.fresh:  # never played twice
+        return synth.next_wavetable(midi_note)
+    key = (id(synth), synth.table_idx, midi_note)
+    if key not in cache:
+        cache[key] = band_limit(synth.wavetables[synth.table_idx], midi_note)
+    synth.table_idx = (synth.table_idx + 1) % len(synth.wavetables)
+    return cache[key]
+
+
+def events_from_score(score: List[dict], samples_dir: Optional[str] = None, n_wavetables: int = 7,
+                      midi_note: Union[int, float] = 60, duration: float = 1.) -> List[NoteEvent]:
+    """Makes the notes of a score written by big_sweep (score.json).
+
+    :param score: The entries of the score.
+    :param samples_dir: The directory with the saved wavetables. The
+        wavetables are generated again from the kernels if None.
+    :param n_wavetables: The number of wavetables per setting, if they are generated.
+    :param midi_note: The MIDI pitch of the notes.
+    :param duration: The duration of the notes.
+    :return: The notes.
+    """
+    synths = {}
+    events = []
+    for entry in score:
+        prefix = wavetable_prefix(entry)
+        if prefix not in synths:
+            if samples_dir is not None:
+                paths = sorted(glob.glob(os.path.join(glob.escape(samples_dir), glob.escape(prefix) + '*.wav')))
+                if not paths:
+                    raise FileNotFoundError(f'No wavetables {prefix}*.wav in {samples_dir}')
+                synths[prefix] = GPSynth(None, None, None, wavetables=[read_wav(path) for path in paths])
+            else:
+                synths[prefix] = GPSynth(kernel_for_score_entry(entry), None, None, n_wavetables=n_wavetables,
+                                         waveshaping=entry['waveshaping'])
+        events.append(NoteEvent(entry['time'], midi_note, duration, synths[prefix]))
+    return events
+
+
+def events_from_midi(path: str, synth: GPSynth) -> List[NoteEvent]:
+    """Makes the notes of a MIDI file. Requires the package mido.
+
+    :param path: Path of the MIDI file.
+    :param synth: The synthesizer playing all notes.
+    :return: The notes.
+    """
+    import mido
+
+    events = []
+    sounding = {}
+    time = 0.
+    for message in mido.MidiFile(path):  # message times are in seconds
+        time += message.time
+        if message.type == 'note_on' and message.velocity > 0:
+            sounding[(message.channel, message.note)] = (time, message.velocity)
+        elif message.type in ('note_on', 'note_off') and (message.channel, message.note) in sounding:
+            start, velocity = sounding.pop((message.channel, message.note))
+            events.append(NoteEvent(start, message.note, time - start, synth, velocity / 127.))
+    return events
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render a score or a MIDI file offline')
+    parser.add_argument('score', type=str, help='score.json written by make_wavetables or a MIDI file')
+    parser.add_argument('out', type=str, help='the WAV file to be written')
+    parser.add_argument('--samples', type=str, default=None,
+                        help='directory with the saved wavetables of the score (default: generate them again)')
+    parser.add_argument('--kernel', type=str, default='RBF', help='the kernel used for MIDI files')
+    parser.add_argument('--lengthscale', type=float, default=1., help='the length-scale used for MIDI files')
+    parser.add_argument('--block-size', type=int, default=4096, help='the number of samples mixed at once')
+    parser.add_argument('--gain', type=float, default=1., help='the gain applied to the mix')
+    parser.add_argument('--channels', type=int, default=1, help='the number of channels, e.g. 2 for stereo')
+    args = parser.parse_args()
+
+    if args.score.lower().endswith('.json'):
+        with open(args.score, 'r') as f:
+            events = events_from_score(json.load(f), args.samples)
+    else:
+        synth = GPSynth(kernel_for_string(args.kernel, args.lengthscale), None, None)
+        events = events_from_midi(args.score, synth)
+
+    out_wav = WavFile(args.out, channels=args.channels)
+    render_score(events, out_wav, args.block_size, args.gain)
+    out_wav.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+from typing import List, Optional, Union
+
+import numpy as np
+
+import gpsynth.config as config
+from gpsynth._lazy import LazyModule
+from gpsynth.synthesizer import midi_to_frequency, normalize_draws, note_envelope
+
+special = LazyModule('scipy.special')
+
+# Wavetables as random Fourier features: a draw is a sum of harmonics of the
+# phase, f(phase) = Re sum_k c_k exp(i k phase), with random complex
+# coefficients c_k. The wavetable loops seamlessly, it can be evaluated at
+# any resolution or directly at the phase of every audio sample, and it is
+# band-limited by dropping harmonics. No covariance is factorized.
+
+
+def _matern32(w: np.ndarray, l: float) -> np.ndarray:
+    lam = np.sqrt(3.) / l
+    return 4. * lam ** 3 / (lam ** 2 + w ** 2) ** 2
+
+
+def _matern52(w: np.ndarray, l: float) -> np.ndarray:
+    lam = np.sqrt(5.) / l
+    return 16. / 3. * lam ** 5 / (lam ** 2 + w ** 2) ** 3
+
+
+def _exponential(w: np.ndarray, l: float) -> np.ndarray:
+    return 2. * l / (1. + (w * l) ** 2)
+
+
+def _rbf(w: np.ndarray, l: float) -> np.ndarray:
+    return l * np.sqrt(2. * np.pi) * np.exp(-0.5 * (w * l) ** 2)
+
+
+def _ratquad(w: np.ndarray, l: float) -> np.ndarray:
+    c = np.sqrt(2.) * l  # GPy's RatQuad with power 2 is (1 + d^2 / c^2)^-2
+    return np.pi * c / 2. * (1. + c * np.abs(w)) * np.exp(-c * np.abs(w))
+
+
+# The spectral densities of the stationary kernels of kernel_for_string with
+# unit variance, as functions of (angular frequency, lengthscale). On the
+# circle, such a kernel becomes its periodic summation, whose harmonic k has
+# the weight density(k) / (2 pi). GPy's periodic Matern kernels are
+# approximated by the periodic summation of the Matern kernels.
+spectral_densities = {
+    'RBF': _rbf,
+    'ExpQuad': _rbf,
+    'Exponential': _exponential,
+    'OU': _exponential,
+    'Matern32': _matern32,
+    'Matern52': _matern52,
+    'RatQuad': _ratquad,
+    'PeriodicExponential': _exponential,
+    'PeriodicMatern32': _matern32,
+    'PeriodicMatern52': _matern52,
+}
+
+
+def harmonic_weights(kernel_name: str, lengthscale: float = 1., n_harmonics: int = 256) -> np.ndarray:
+    """The variances of the harmonics of draws from a kernel on the circle.
+
+    :param kernel_name: The name of the kernel, see kernel_for_string.
+    :param lengthscale: The length-scale parameter.
+    :param n_harmonics: The number of harmonics, without DC.
+    :return: The weights w_k of the harmonics k = 1 ... n_harmonics. The
+        kernel is sum_k 2 w_k cos(k d) (plus a constant).
+    """
+    k = np.arange(1, n_harmonics + 1)
+    if kernel_name == 'StdPeriodic':
+        # exp(-sin^2(d / 2) / (2 l^2)) = exp(-x) exp(x cos d) with x = 1 / (4 l^2),
+        # the Fourier series of exp(x cos d) has the coefficients I_k(x)
+        return special.ive(k, 1. / (4. * lengthscale ** 2))
+    if kernel_name not in spectral_densities:
+        raise LookupError(f'{kernel_name} has no random Fourier features.')
+    return spectral_densities[kernel_name](k.astype(float), lengthscale) / (2. * np.pi)
+
+
+def sample_coefficients(kernel_name: str, lengthscale: float = 1., n: int = 17, n_harmonics: int = 256,
+                        rng: Union[None, int, np.random.Generator] = None) -> np.ndarray:
+    """Draws wavetables as harmonic coefficients. Their loudness is
+    normalized like the one of make_wavetables.
+
+    :param kernel_name: The name of the kernel, see kernel_for_string.
+    :param lengthscale: The length-scale parameter.
+    :param n: The number of wavetables.
+    :param n_harmonics: The number of harmonics per wavetable.
+    :param rng: The random number generator or a seed.
+    :return: The complex coefficients of the harmonics 1 ... n_harmonics,
+        with shape (n, n_harmonics).
+    """
+    rng = np.random.default_rng(rng)
+    scale = np.sqrt(2. * harmonic_weights(kernel_name, lengthscale, n_harmonics))
+    coefficients = scale * (rng.standard_normal((n, n_harmonics)) - 1j * rng.standard_normal((n, n_harmonics)))
+
+    tables = evaluate(coefficients, 2205).astype(float)
+    normalized = normalize_draws(tables.T).T
+    gain = np.sum(normalized * tables, axis=1) / np.maximum(np.sum(tables * tables, axis=1), 1e-30)
+    return (coefficients * gain[:, None]).astype(np.complex64)
+
+
+def max_harmonic(midi_note: Union[int, float]) -> int:
+    """The highest harmonic of a wavetable that is kept at a pitch, with the
+    same cutoff as band_limit.
+
+    :param midi_note: The MIDI pitch of the note.
+    :return: The number of the harmonic.
+    """
+    return int(20000. / midi_to_frequency(midi_note))
+
+
+def evaluate(coefficients: np.ndarray, size: int = 2205, midi_note: Optional[Union[int, float]] = None) -> np.ndarray:
+    """Evaluates wavetables at any resolution.
+
+    :param coefficients: The coefficients from sample_coefficients, one
+        wavetable or several stacked along the first axis.
+    :param size: The number of samples per wavetable.
+    :param midi_note: If given, the harmonics above the cutoff of band_limit
+        at this pitch are dropped.
+    :return: The wavetables with shape (..., size).
+    """
+    n_harmonics = min(coefficients.shape[-1], size // 2 - 1)  # below the Nyquist frequency of the table
+    if midi_note is not None:
+        n_harmonics = min(n_harmonics, max_harmonic(midi_note))
+    spectrum = np.zeros(coefficients.shape[:-1] + (size // 2 + 1,), dtype=complex)
+    spectrum[..., 1:n_harmonics + 1] = coefficients[..., :n_harmonics] * (size / 2.)
+    return np.fft.irfft(spectrum, n=size, axis=-1).astype(config.dtype)
+
+
+def make_fourier_wavetables(kernel_name: str, lengthscale: float = 1., n: int = 17, size: int = 2205,
+                            rng: Union[None, int, np.random.Generator] = None) -> List[np.ndarray]:
+    """Draws wavetables with random Fourier features, e.g. for GPSynth.
+
+    :param kernel_name: The name of the kernel, see kernel_for_string.
+    :param lengthscale: The length-scale parameter.
+    :param n: The number of wavetables.
+    :param size: The number of samples per wavetable.
+    :param rng: The random number generator or a seed.
+    :return: A list of wavetables.
+    """
+    return list(evaluate(sample_coefficients(kernel_name, lengthscale, n, rng=rng), size))
+
+
+def render_fourier(coefficients: np.ndarray, midi_note: Union[int, float], start: int, stop: int,
+                   samples_total: int, chunk_size: int = 4096) -> np.ndarray:
+    """Renders a segment of a note, evaluating the harmonics at the exact
+    phase of every sample instead of looking up a table.
+
+    :param coefficients: The coefficients of one wavetable.
+    :param midi_note: The MIDI pitch of the note.
+    :param start: The first sample of the segment, relative to the note onset.
+    :param stop: The sample after the segment, relative to the note onset.
+    :param samples_total: The length of the note in samples.
+    :param chunk_size: The number of samples evaluated at once.
+    :return: The samples of the segment.
+    """
+    n_harmonics = min(coefficients.shape[-1], max_harmonic(midi_note))
+    k = np.arange(1, n_harmonics + 1)
+    c = coefficients[:n_harmonics].astype(np.complex128)
+    step = 2. * np.pi * midi_to_frequency(midi_note) / 44100.
+    samples = np.empty(stop - start, dtype=np.float32)
+    for chunk in range(start, stop, chunk_size):
+        phase = np.mod(np.arange(chunk, min(chunk + chunk_size, stop)) * step, 2. * np.pi)
+        samples[chunk - start:chunk - start + phase.size] = (np.exp(1j * phase[:, None] * k[None]) @ c).real
+    return samples * note_envelope(start, stop, samples_total).astype(np.float32)
@@ -0,0 +1,237 @@
+import os
+from typing import List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from gpsynth.audio_output import read_wav
+
+
+def spectral_features(wavetables: Union[np.ndarray, Sequence[np.ndarray]], n_harmonics: int = 64) -> np.ndarray:
+    """Describes the timbre of wavetables by the magnitudes of their
+    harmonics, independent of phase and loudness.
+
+    :param wavetables: The wavetables, one per row. They may differ in
+        length, e.g. wavetables and waveshaping functions.
+    :param n_harmonics: The number of harmonics (without DC) that are compared.
+    :return: The features with unit norm and shape (wavetables, n_harmonics),
+        the cosine similarity of two tables is the dot product of their features.
+    """
+    if not isinstance(wavetables, np.ndarray) and len({len(wavetable) for wavetable in wavetables}) > 1:
+        return np.concatenate([spectral_features(wavetable, n_harmonics) for wavetable in wavetables])
+    wavetables = np.atleast_2d(np.asarray(wavetables, dtype=np.float32))
+    magnitudes = np.abs(np.fft.rfft(wavetables, axis=1))[:, 1:n_harmonics + 1]
+    features = np.sqrt(magnitudes)  # compressed, so that the upper harmonics count too
+    norms = np.linalg.norm(features, axis=1, keepdims=True)
+    return (features / np.maximum(norms, 1e-12)).astype(np.float32)
+
+
+def expected_features(cholesky: np.ndarray, n_harmonics: int = 64) -> np.ndarray:
+    """The spectral features of the wavetables drawn from a covariance, from
+    their expected harmonic power instead of single draws, so that they do not
+    depend on the random numbers. The power is the squared magnitude of the
+    DFT of the Cholesky factor, computed with one batched FFT over its columns.
+
+    :param cholesky: The Cholesky decomposition, see cached_cholesky.
+    :param n_harmonics: The number of harmonics, see spectral_features.
+    :return: The features with unit norm, comparable to spectral_features.
+    """
+    spectra = np.fft.rfft(cholesky[:-1], axis=0)  # the wavetables drop the last point
+    power = np.sum(np.abs(spectra[1:n_harmonics + 1]) ** 2, axis=1)
+    features = power ** 0.25  # the square root of the magnitude, like spectral_features
+    return (features / max(np.linalg.norm(features), 1e-12)).astype(np.float32)
+
+
+class DuplicateFilter:
+    """Finds settings that draw practically the same wavetables as an earlier
+    setting, e.g. of a sweep, by a fingerprint of their features.
+
+    The fingerprint quantizes the features to one byte per harmonic. A setting
+    is a duplicate if its fingerprint equals the one of a representative,
+    which is looked up by hash, or if their cosine similarity reaches the
+    threshold.
+    """
+
+    def __init__(self, threshold: Optional[float] = 0.9995, n_harmonics: int = 64):
+        """Makes a filter without representatives.
+
+        :param threshold: The cosine similarity above which settings are
+            duplicates. Only equal fingerprints are duplicates if None.
+        :param n_harmonics: The number of harmonics of the features.
+        """
+        self.threshold = threshold
+        self.n_harmonics = n_harmonics
+        self.keys = []  # type: List
+        self.fingerprints = np.zeros((0, n_harmonics), dtype=np.uint8)
+        self.buckets = {}  # fingerprint bytes -> key
+
+    def check(self, key, features: np.ndarray):
+        """Checks whether a setting duplicates a representative. If not, it
+        becomes one.
+
+        :param key: Identifies the setting, e.g. its position in the score.
+        :param features: The features of the setting, see expected_features.
+        :return: The key of the representative, or None if the setting is new.
+        """
+        fingerprint = np.round(np.asarray(features) * 255.).astype(np.uint8)
+        bucket = fingerprint.tobytes()
+        if bucket in self.buckets:
+            return self.buckets[bucket]
+        if self.threshold is not None and self.keys:
+            representatives = self.fingerprints.astype(np.float32)
+            similarities = representatives @ fingerprint.astype(np.float32)
+            similarities /= np.linalg.norm(representatives, axis=1) * max(np.linalg.norm(fingerprint), 1.)
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.threshold:
+                return self.keys[best]
+        self.keys.append(key)
+        self.fingerprints = np.concatenate((self.fingerprints, fingerprint[None]))
+        self.buckets[bucket] = key
+        return None
+
+
+def extract_cycle(samples: np.ndarray, size: int = 2205, sample_rate: int = 44100,
+                  min_frequency: float = 20., max_frequency: float = 2000.) -> np.ndarray:
+    """Cuts a single cycle out of a recording of a pitched sound, so that it
+    can be compared to wavetables.
+
+    :param samples: The recording.
+    :param size: The length of the returned cycle.
+    :param sample_rate: The sampling rate of the recording.
+    :param min_frequency: The lowest fundamental frequency that is detected.
+    :param max_frequency: The highest fundamental frequency that is detected.
+    :return: One period, resampled to size samples.
+    """
+    samples = np.asarray(samples, dtype=float)
+    max_lag = int(sample_rate / min_frequency)
+    center = samples.size // 2
+    excerpt = samples[max(center - max_lag, 0):center + max_lag]
+    excerpt = excerpt - excerpt.mean()
+    spectrum = np.fft.rfft(excerpt, n=2 * excerpt.size)
+    autocorrelation = np.fft.irfft(np.abs(spectrum) ** 2)[:excerpt.size]
+    min_lag = int(sample_rate / max_frequency)
+    period = min_lag + int(np.argmax(autocorrelation[min_lag:min(max_lag, excerpt.size // 2)]))
+    cycle = excerpt[:period]
+    return np.interp(np.arange(size) * period / size, np.arange(period), cycle)
+
+
+class SimilarityIndex:
+    """Nearest neighbour index over wavetables, see spectral_features.
+
+    Queries compare the features with all wavetables in one matrix product.
+    With n_bits > 0, the features are also hashed by random projections and
+    approximate queries only compare the candidates with the closest hashes.
+    """
+
+    def __init__(self, n_harmonics: int = 64, n_bits: int = 0, seed: int = 0):
+        """Makes an empty index.
+
+        :param n_harmonics: The number of harmonics of the features.
+        :param n_bits: The length of the hashes for approximate queries, 0 disables them.
+        :param seed: The seed of the random projections.
+        """
+        self.n_harmonics = n_harmonics
+        self.names = []  # type: List[str]
+        self.features = np.zeros((0, n_harmonics), dtype=np.float32)
+        self.planes = np.random.default_rng(seed).standard_normal((n_harmonics, n_bits)).astype(np.float32)
+        self.codes = np.zeros((0, (n_bits + 7) // 8), dtype=np.uint8)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def _hash(self, features: np.ndarray) -> np.ndarray:
+        # all features are positive, the hyperplanes go through the features of a flat spectrum
+        return np.packbits((features - 1. / np.sqrt(self.n_harmonics)) @ self.planes > 0., axis=1)
+
+    def add(self, names: Sequence[str], wavetables: Union[np.ndarray, Sequence[np.ndarray]]) -> None:
+        """Adds wavetables to the index.
+
+        :param names: The names of the wavetables, e.g. their file names.
+        :param wavetables: The wavetables.
+        """
+        if len(names) == 0:
+            return
+        features = spectral_features(wavetables, self.n_harmonics)
+        self.names.extend(names)
+        self.features = np.concatenate((self.features, features))
+        self.codes = np.concatenate((self.codes, self._hash(features)))
+
+    def update_from_directory(self, path: str) -> int:
+        """Adds the WAV files of a directory that are not in the index yet.
+
+        :param path: The directory, e.g. the samples of big_sweep.
+        :return: The number of added wavetables.
+        """
+        known = set(self.names)
+        names = sorted(f for f in os.listdir(path) if f.endswith('.wav') and f not in known)
+        self.add(names, [read_wav(os.path.join(path, name)) for name in names])
+        return len(names)
+
+    def query(self, wavetable: np.ndarray, k: int = 10, approximate: bool = False,
+              exclude: Optional[str] = None) -> List[Tuple[str, float]]:
+        """Finds the most similar wavetables.
+
+        :param wavetable: The wavetable that is looked for.
+        :param k: The number of results.
+        :param approximate: Only compare the wavetables with similar hashes,
+            requires n_bits > 0.
+        :param exclude: A name that is not returned, e.g. of the wavetable itself.
+        :return: The names and the cosine similarities, most similar first.
+        """
+        return self.query_features(spectral_features(wavetable, self.n_harmonics)[0], k, approximate, exclude)
+
+    def query_name(self, name: str, k: int = 10, approximate: bool = False) -> List[Tuple[str, float]]:
+        """Finds the wavetables that are most similar to one in the index.
+
+        :param name: The name of the wavetable in the index.
+        :param k: The number of results.
+        :param approximate: See query.
+        :return: The names and the cosine similarities, most similar first.
+        """
+        return self.query_features(self.features[self.names.index(name)], k, approximate, exclude=name)
+
+    def query_features(self, features: np.ndarray, k: int = 10, approximate: bool = False,
+                       exclude: Optional[str] = None) -> List[Tuple[str, float]]:
+        """Finds the wavetables with the most similar features.
+
+        :param features: The features from spectral_features.
+        :param k: The number of results.
+        :param approximate: See query.
+        :param exclude: A name that is not returned.
+        :return: The names and the cosine similarities, most similar first.
+        """
+        candidates = np.arange(len(self.names))
+        if approximate:
+            if self.planes.shape[1] == 0:
+                raise ValueError('The index has no hashes, make it with n_bits > 0.')
+            code = self._hash(features[None])
+            distances = np.unpackbits(self.codes ^ code, axis=1).sum(axis=1)
+            n_candidates = min(max(10 * k, 100), len(candidates))
+            candidates = np.argpartition(distances, n_candidates - 1)[:n_candidates]
+
+        similarities = self.features[candidates] @ features
+        order = np.argsort(-similarities)
+        results = [(self.names[candidates[i]], float(similarities[i])) for i in order[:k + 1]]
+        return [r for r in results if r[0] != exclude][:k]
+
+    def save(self, path: str) -> None:
+        """Saves the index.
+
+        :param path: Path of the .npz file.
+        """
+        np.savez(path, names=np.array(self.names, dtype=str), features=self.features, planes=self.planes,
+                 codes=self.codes)
+
+    @classmethod
+    def load(cls, path: str) -> 'SimilarityIndex':
+        """Loads an index saved with save.
+
+        :param path: Path of the .npz file.
+        :return: The index.
+        """
+        with np.load(path) as data:
+            index = cls(n_harmonics=data['features'].shape[1])
+            index.names = data['names'].tolist()
+            index.features = data['features']
+            index.planes = data['planes']
+            index.codes = data['codes']
+        return index
@@ -1,16 +1,26 @@
+from __future__ import annotations
+
 import datetime
+import hashlib
 import json
 import os
 import random
-from typing import Union, List, Optional
+import re
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Union, List, Optional, Sequence, Tuple
 
-import GPy
 import numpy as np
-import matplotlib.pyplot as plt
-from scipy import signal
 
 import gpsynth.config as config
+import gpsynth.metrics as metrics
+from gpsynth._lazy import LazyModule
 from gpsynth.audio_output import WavFile, RealtimeAudio
+from gpsynth.similarity import DuplicateFilter, SimilarityIndex, expected_features
+
+GPy = LazyModule('GPy')
+signal = LazyModule('scipy.signal')
 
 
 def midi_to_frequency(midi_note: Union[float, int]) -> float:
@@ -34,9 +44,10 @@ def make_cov_cholesky_waveshaping(kernel: GPy.kern.Kern) -> np.ndarray:
     samples = 44100 / 20
     xs = np.arange(samples) * 2. * np.pi / samples
     xs = np.sin(xs)
-    cov = kernel.K(xs[:, None], xs[:, None])
-    chol = GPy.util.linalg.jitchol(cov)
-    return chol
+    with metrics.timer('covariance', kernel=kernel_label(kernel)):
+        cov = kernel.K(xs[:, None], xs[:, None])
+    chol = jitchol(cov, kernel_label(kernel))
+    return chol.astype(config.dtype)
 
 
 def make_cov_cholesky(kernel: GPy.kern.Kern) -> np.ndarray:
@@ -50,18 +61,71 @@ def make_cov_cholesky(kernel: GPy.kern.Kern) -> np.ndarray:
     #  good continuation.
     samples = 44100 / 20
     xs = np.arange(samples + 1) * 2. * np.pi / samples
-    if isinstance(kernel, GPy.kern.PeriodicExponential.__bases__[0]) or not config.good_continuation_regression:
+    if is_periodic(kernel) or not config.good_continuation_regression:
         # print('Is periodic')
         X = np.array([xs[0]])[:, None]
         Y = np.array([0.])[:, None]
     else:
         X = np.array([xs[0], xs[-1]])[:, None]
         Y = np.array([0., 0.])[:, None]
-    m = GPy.models.GPRegression(X, Y, kernel)
-    m.Gaussian_noise = 0.0
-    mean, cov = m.predict_noiseless(xs[:, None], full_cov=True)
-    chol = GPy.util.linalg.jitchol(cov)
-    return chol
+    with metrics.timer('gp_prediction', kernel=kernel_label(kernel)):
+        m = GPy.models.GPRegression(X, Y, kernel)
+        m.Gaussian_noise = 0.0
+        mean, cov = m.predict_noiseless(xs[:, None], full_cov=True)
+    chol = jitchol(cov, kernel_label(kernel))
+    return chol.astype(config.dtype)
+
+
+def is_periodic(kernel: GPy.kern.Kern) -> bool:
+    """Is the kernel one of GPy's periodic kernels, whose samples continue
+    well without regression?
+
+    :param kernel: The kernel.
+    :return: True if it is periodic.
+    """
+    return isinstance(kernel, GPy.kern.PeriodicExponential.__bases__[0])
+
+
+def jitchol(cov: np.ndarray, label: str = '', maxtries: int = 5) -> np.ndarray:
+    """Cholesky decomposition that adds increasing jitter to the diagonal
+    until the matrix is positive definite, like GPy.util.linalg.jitchol. The
+    retries are counted in the metrics.
+
+    :param cov: The covariance matrix.
+    :param label: The kernel, used as label of the metrics.
+    :param maxtries: The maximal number of retries with jitter.
+    :return: The lower triangular Cholesky decomposition.
+    """
+    with metrics.timer('cholesky', kernel=label):
+        try:
+            return np.linalg.cholesky(cov)
+        except np.linalg.LinAlgError:
+            pass
+
+        diag = np.diag(cov)
+        if np.any(diag <= 0.):
+            raise np.linalg.LinAlgError('not positive definite: non-positive diagonal elements')
+        jitter = diag.mean() * 1e-6
+        for _ in range(maxtries):
+            metrics.count('cholesky_jitter_retries_total', kernel=label)
+            try:
+                return np.linalg.cholesky(cov + np.eye(cov.shape[0]) * jitter)
+            except np.linalg.LinAlgError:
+                jitter *= 10
+        raise np.linalg.LinAlgError('not positive definite, even with jitter')
+
+
+def kernel_label(kernel: GPy.kern.Kern) -> str:
+    """A short description of a kernel, e.g. 'RBF + Matern32'.
+
+    :param kernel: The kernel.
+    :return: The description.
+    """
+    parts = getattr(kernel, 'parts', None)
+    if parts:
+        operator = ' * ' if type(kernel).__name__ == 'Prod' else ' + '
+        return operator.join(kernel_label(part) for part in parts)
+    return type(kernel).__name__
 
 
 def perceptual_amplitude_dbb(frequency: float) -> float:
@@ -77,35 +141,153 @@ def perceptual_amplitude_dbb(frequency: float) -> float:
     return num / den
 
 
-def fast_normal_from_cholesky(cholesky: np.ndarray) -> np.ndarray:
+def fast_normal_from_cholesky(cholesky: np.ndarray, rng: Optional[np.random.Generator] = None,
+                              label: str = '') -> np.ndarray:
     """Efficiently samples a multidimensional normal from the Cholesky
     decomposition of the covariance matrix.
 
     :param cholesky: The Cholesky decomposition.
+    :param rng: The random number generator. A new one is created if None.
+    :param label: The kernel, used as label of the metrics.
     :return: A sample of the mutidimensional normal distribution.
     """
+    return draw_normalized(cholesky, 1, rng, label)
+
+
+def draw_normalized(cholesky: np.ndarray, n_draws: int, rng: Optional[np.random.Generator] = None,
+                    label: str = '', max_attempts: Optional[int] = None) -> np.ndarray:
+    """Draws loudness normalized samples and rejects the ones that would clip.
+
+    The candidates are drawn in batches (one matrix product each) sized from
+    the acceptance rate observed so far, so kernels whose draws are often
+    rejected do not pay a matrix-vector product per attempt. The accepted
+    draws are the same as when drawing one candidate at a time. If no
+    candidate for a draw is accepted within max_attempts, the best candidate
+    is limited according to config.clipping_fallback.
+
+    :param cholesky: The Cholesky decomposition.
+    :param n_draws: The number of draws.
+    :param rng: The random number generator. A new one is created if None.
+    :param label: The kernel, used as label of the metrics.
+    :param max_attempts: The maximal number of candidates per draw, config.max_draw_attempts if None.
+    :return: The draws with shape (n_draws, n).
+    """
+    rng = np.random.default_rng(rng)
+    if max_attempts is None:
+        max_attempts = config.max_draw_attempts
     n = cholesky.shape[0]
-    means = np.zeros(n)
-    while True:
-        seeds = np.random.normal(0, 1, (1, n))
-        Ls = [cholesky]
-        result = means + np.einsum('nij,njk->nik', Ls, seeds[:, :, np.newaxis])[:, :, 0]
-        result = result - np.mean(result)
-        result = result / np.std(result) / 10.0
+    accepted = []
+    drawn = 0
+    attempts = 0  # candidates for the current draw
+    best, best_peak = None, np.inf  # the candidate used if all of them are rejected
+
+    with metrics.timer('sampling', kernel=label):
+        while len(accepted) < n_draws:
+            acceptance_rate = (len(accepted) + 1) / (drawn + 1)
+            needed = n_draws - len(accepted)
+            batch = int(min(np.ceil(needed / acceptance_rate), config.max_draw_batch))
+            seeds = rng.normal(0, 1, (batch, n)).astype(cholesky.dtype)
+            candidates = normalize_loudness(seeds @ cholesky.T)
+            peaks = np.max(np.abs(candidates), axis=1)
+
+            for candidate, peak in zip(candidates, peaks):
+                drawn += 1
+                attempts += 1
+                metrics.count('draws_total', kernel=label)
+                if peak < 0.9:
+                    accepted.append(candidate)
+                else:
+                    metrics.count('draws_rejected_total', kernel=label)
+                    if peak < best_peak:
+                        best, best_peak = candidate, peak
+                    if attempts < max_attempts:
+                        continue
+                    metrics.count('draws_limited_total', kernel=label)
+                    accepted.append(limit_peak(best, best_peak))
+                attempts = 0
+                best, best_peak = None, np.inf
+                if len(accepted) == n_draws:
+                    break
+
+    return np.stack(accepted)
+
+
+def limit_peak(draw: np.ndarray, peak: float) -> np.ndarray:
+    """Keeps a draw below the peak 0.9 according to config.clipping_fallback.
+
+    :param draw: The normalized draw.
+    :param peak: Its maximal absolute value.
+    :return: The limited draw.
+    """
+    if config.clipping_fallback == 'softclip':
+        return (0.9 * np.tanh(draw / 0.9)).astype(draw.dtype)
+    return draw / peak * 0.9
+
+
+def normalize_loudness(result: np.ndarray) -> np.ndarray:
+    """Removes the DC offset of draws and scales them to a common perceived
+    loudness.
+
+    :param result: The draws with shape (number of draws, n).
+    :return: The normalized draws with the same dtype. They may still exceed
+        the range [-1, 1].
+    """
+    dtype = result.dtype
+    result = result - np.mean(result, axis=-1, keepdims=True)
+    result = result / np.std(result, axis=-1, keepdims=True) / 10.0
+
+    good_loudness = 300.
+    actual_loudness = weighted_loudness(result, mult_freq=263. / 20.)
+    return (result / actual_loudness[..., None] * good_loudness).astype(dtype, copy=False)
+
+
+def normalize_draws(draws: np.ndarray) -> np.ndarray:
+    """Normalizes the loudness of draws made with fixed seeds. Draws that
+    would clip are scaled down instead of being rejected, so that the result
+    only depends on the seeds.
+
+    :param draws: The draws with shape (n, number of draws).
+    :return: The normalized draws with the same shape.
+    """
+    result = normalize_loudness(draws.T)
+    peaks = np.max(np.abs(result), axis=1)
+    clipping = peaks >= 0.9
+    result[clipping] = result[clipping] / peaks[clipping, None] * 0.9
+    return result.T
 
-        good_loudness = 300.
-        actual_loudness = weighted_loudness(result[0], mult_freq=263. / 20.)
-        result = result / actual_loudness * good_loudness
 
-        if np.max(np.abs(result)) < 0.9:
-            break
+def make_seeds(n_wavetables: int, rng: Union[None, int, np.random.Generator] = None) -> np.ndarray:
+    """Draws a seed matrix that can be shared by many settings (common random
+    numbers). It is large enough for wavetables and waveshaping functions.
 
-    return result
+    :param n_wavetables: The number of wavetables per setting.
+    :param rng: The random number generator or a seed.
+    :return: The standard normal seeds with shape (table points, n_wavetables).
+    """
+    samples = int(44100 / 20) + 1
+    return np.random.default_rng(rng).standard_normal((samples, n_wavetables)).astype(config.dtype)
+
+
+def sample_grid(choleskys: Union[np.ndarray, Sequence[np.ndarray]], seeds: np.ndarray) -> np.ndarray:
+    """Draws from many covariances at once against the same seeds.
+
+    :param choleskys: The Cholesky decompositions, stacked with shape (settings, n, n).
+    :param seeds: The seed matrix from make_seeds.
+    :return: The normalized draws with shape (settings, n, number of seeds).
+    """
+    choleskys = np.asarray(choleskys)
+    draws = np.matmul(choleskys, seeds[:choleskys.shape[1]])
+    return np.stack([normalize_draws(d) for d in draws])
 
 
 class GPSynth:
-    def __init__(self, kernel: GPy.kern.Kern, out_rt: Optional[RealtimeAudio], out_wav: Optional[WavFile],
-                 n_wavetables: int = 17, waveshaping: bool = False):
+    def __init__(self, kernel: Optional[GPy.kern.Kern], out_rt: Optional[RealtimeAudio], out_wav: Optional[WavFile],
+                 n_wavetables: int = 17, waveshaping: bool = False,
+                 wavetables: Optional[List[np.ndarray]] = None,
+                 rng: Union[None, int, np.random.Generator] = None, seeds: Optional[np.ndarray] = None,
+                 scan_frames: int = 0, scan_lengthscale: float = 8., scan_rate: float = 10.,
+                 unison: int = 1, detune: float = 10., spread: float = 1., lazy: bool = False,
+                 fresh: bool = False):
         """GPSynth creates wavetables based on a kernel of a Gaussian Process.
 
         :param kernel: The kernel.
@@ -113,11 +295,46 @@ class GPSynth:
         :param out_wav: Is used for saving the output to a WAV file if not None.
         :param n_wavetables: The number of (randomized) wavetables to be generated.
         :param waveshaping: Should waveshaping be used?
+        :param wavetables: Precomputed wavetables. If given, they are used
+            instead of drawing new ones from the kernel.
+        :param rng: The random number generator or a seed, see make_wavetables.
+        :param seeds: A shared seed matrix, see make_wavetables.
+        :param scan_frames: If not 0, a smoothly evolving sequence of this many
+            wavetables is drawn instead, see make_wavetable_sequence, and the
+            notes scan through it. The next note continues where the last
+            one stopped.
+        :param scan_lengthscale: The length-scale of the sequence over time, in frames.
+        :param scan_rate: The number of frames scanned per second.
+        :param unison: The number of detuned voices that play every note,
+            see render_unison. Not used when scanning.
+        :param detune: The detuning of the outermost voices in cents.
+        :param spread: The width of the panorama of the voices, between 0. and 1.
+        :param lazy: Draw the wavetables when they are needed (and ahead of
+            that in the background), see WavetablePool, instead of all of
+            them before the first note.
+        :param fresh: Play every wavetable only once and replace it by a new
+            draw, so the variation never repeats. Implies lazy.
         """
         self.table_idx = 0
-        self.wavetables = make_wavetables(kernel, n_wavetables, waveshaping)
+        self.frames = None
+        self.scan_rate = scan_rate
+        self.scan_position = 0.
+        if scan_frames > 0 and wavetables is None:
+            self.frames = make_wavetable_sequence(kernel, scan_frames, scan_lengthscale, waveshaping=waveshaping,
+                                                  rng=rng)
+            wavetables = list(self.frames)
+        self.pool = None
+        if wavetables is None and (lazy or fresh):
+            self.pool = WavetablePool(cached_cholesky(kernel, waveshaping), n_wavetables, rng, seeds,
+                                      kernel_label(kernel), fresh)
+        elif wavetables is None:
+            wavetables = make_wavetables(kernel, n_wavetables, waveshaping, rng=rng, seeds=seeds)
+        self._wavetables = None if wavetables is None else list(wavetables)
         self.out_rt = out_rt
         self.out_wav = out_wav
+        # the notes are rendered with as many channels as the outputs have
+        self.channels = max([out.channels for out in (out_rt, out_wav) if out is not None], default=1)
+        self.voices = unison_voices(unison, detune, spread) if unison > 1 else None
 
     def note(self, midi_note: Union[int, float], duration: float) -> None:
         """Plays a note.
@@ -126,56 +343,311 @@ class GPSynth:
         :param duration: The duration.
         """
 
-        wavetable = self.wavetables[self.table_idx]
-
-        size_wavetable = wavetable.size
-        w = np.concatenate((wavetable, wavetable, wavetable))
-
-        fs = 44100.
-        fc = 20000. * 20. / midi_to_frequency(midi_note)  # cutoff frequency
-        fc_norm = fc / (fs / 2)
-        b, a = signal.butter(5, fc_norm)
-        y = signal.filtfilt(b, a, w)
-
-        wavetable = y[size_wavetable:2 * size_wavetable]  # the middle part
-
-        pointer_idx = 0.0
-        step = midi_to_frequency(midi_note) / 44100.0 * wavetable.shape[0]
         samples_total = int(duration * 44100.)
-        pcm = np.zeros((samples_total), dtype=np.float32)
-        for i in range(samples_total):
-            pcm[i] = wavetable[int(pointer_idx)]
-            fade_in = 100
-            if i < fade_in:
-                pcm[i] *= i / fade_in
-
-            fade_out = 10000
-            if samples_total - i < fade_out:
-                pcm[i] *= (samples_total - i) / fade_out
-
-            pointer_idx += step
-            if pointer_idx >= wavetable.shape[0]:
-                pointer_idx -= wavetable.shape[0]
-
-        self.table_idx = (self.table_idx + 1) % len(self.wavetables)
+        if self.frames is not None:
+            pcm = render_scan(band_limit(self.frames, midi_note), midi_note, 0, samples_total, samples_total,
+                              self.scan_position, self.scan_rate)
+            self.scan_position += duration * self.scan_rate
+        elif self.voices is not None:
+            detunes, pans, phases = self.voices
+            wavetable = self.next_wavetable(midi_note + np.max(detunes) / 100.)  # no voice may alias
+            pcm = render_unison(wavetable, midi_note, 0, samples_total, samples_total, detunes, pans, phases,
+                                self.channels)
+        else:
+            wavetable = self.next_wavetable(midi_note)
+            pcm = render_wavetable(wavetable, midi_note, 0, samples_total, samples_total)
 
         if self.out_rt is not None:
             self.out_rt.write_samples(pcm)
         if self.out_wav is not None:
             self.out_wav.write_samples(pcm)
 
+    def next_wavetable(self, midi_note: Union[int, float]) -> np.ndarray:
+        """Returns the next wavetable, band-limited for the pitch. Successive
+        calls cycle through the wavetables.
+
+        :param midi_note: The MIDI pitch of the note.
+        :return: The band-limited wavetable.
+        """
+        if self.pool is not None and self.pool.fresh:
+            return band_limit(self.pool.next(), midi_note)
+        if self.pool is not None:
+            wavetable = band_limit(self.pool.get(self.table_idx), midi_note)
+            self.table_idx = (self.table_idx + 1) % self.pool.size
+            return wavetable
+        wavetable = band_limit(self._wavetables[self.table_idx], midi_note)
+        self.table_idx = (self.table_idx + 1) % len(self._wavetables)
+        return wavetable
+
+    @property
+    def wavetables(self) -> List[np.ndarray]:
+        """The wavetables. If they are drawn lazily, the missing ones are
+        drawn now; when playing fresh tables, these are the ones that have
+        not been played yet.
+        """
+        if self.pool is not None:
+            return self.pool.tables()
+        return self._wavetables
+
     def save_wavetables(self, path: str, filename_prefix: str = '') -> None:
         """Saves the generated wavetables.
 
         :param path: The path, the wavetables should be saved to.
         :param filename_prefix: The prefix of the filename.
         """
-        for i in range(len(self.wavetables)):
-            if not os.path.exists(path):
-                os.mkdir(path)
+        os.makedirs(path, exist_ok=True)  # several processes may save into the same directory
+        for i, wavetable in enumerate(self.wavetables):
             location = os.path.join(path, filename_prefix + f'{i:02d}.wav')
             wav_file = WavFile(location)
-            wav_file.write_samples(self.wavetables[i])
+            wav_file.write_samples(wavetable)
+            wav_file.close()
+
+
+class WavetablePool:
+    """Draws the wavetables of a GPSynth one at a time from a kept Cholesky
+    factor, when they are needed or ahead of that in a background thread.
+
+    Normally the pool draws size tables and keeps them, like
+    make_wavetables. When fresh, it keeps a ring of at most size tables that
+    have not been played yet, and replaces every played table by a new draw.
+    The draws of a pool are made one after the other, so they only depend on
+    rng, not on the timing.
+    """
+
+    _executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='wavetables')  # shared by all pools
+
+    def __init__(self, cholesky: np.ndarray, size: int, rng: Union[None, int, np.random.Generator] = None,
+                 seeds: Optional[np.ndarray] = None, label: str = '', fresh: bool = False):
+        """Prepares the pool and starts drawing in the background.
+
+        :param cholesky: The Cholesky decomposition, see cached_cholesky.
+        :param size: The number of wavetables, or of the ring if fresh.
+        :param rng: The random number generator or a seed.
+        :param seeds: A seed matrix from make_seeds, see make_wavetables.
+            Not possible if fresh, as it only has a fixed number of columns.
+        :param label: The kernel, used as label of the metrics.
+        :param fresh: Draw a new table for every note, see above.
+        """
+        if fresh and seeds is not None:
+            raise ValueError('Fresh wavetables cannot be drawn from a fixed seed matrix.')
+        self.cholesky = cholesky
+        self.size = size
+        self.rng = np.random.default_rng(rng)
+        self.seeds = seeds
+        self.label = label
+        self.fresh = fresh
+        self.n_drawn = 0
+        self._tables = deque() if fresh else []  # the ring of unplayed tables, or all tables
+        self._pending = None  # type: Optional[Future]
+        self._lock = threading.Lock()
+        with self._lock:
+            self._prefetch()
+
+    def _prefetch(self) -> None:
+        # called with the lock held, at most one draw of a pool is pending
+        more = len(self._tables) < self.size if self.fresh else self.n_drawn < self.size
+        if self._pending is None and more:
+            self._pending = self._executor.submit(self._fill)
+
+    def _fill(self) -> None:
+        seeds = None if self.seeds is None else self.seeds[:, self.n_drawn:self.n_drawn + 1]
+        table = wavetables_from_cholesky(self.cholesky, 1, self.rng, seeds, self.label)[0]
+        with self._lock:
+            self.n_drawn += 1
+            self._tables.append(table)
+            self._pending = None
+            self._prefetch()
+
+    def _wait(self) -> None:
+        with self._lock:
+            self._prefetch()
+            pending = self._pending
+        if pending is not None:
+            pending.result()
+
+    def get(self, index: int) -> np.ndarray:
+        """Returns a wavetable, waiting for it to be drawn if needed.
+
+        :param index: The number of the wavetable, below size.
+        :return: The wavetable.
+        """
+        while True:
+            with self._lock:
+                if index < len(self._tables):
+                    return self._tables[index]
+            self._wait()
+
+    def next(self) -> np.ndarray:
+        """Takes the next fresh wavetable out of the ring, waiting for it to
+        be drawn if needed.
+
+        :return: The wavetable.
+        """
+        while True:
+            with self._lock:
+                if self._tables:
+                    table = self._tables.popleft()
+                    self._prefetch()
+                    return table
+            self._wait()
+
+    def tables(self) -> List[np.ndarray]:
+        """The tables of the pool, see GPSynth.wavetables.
+
+        :return: The wavetables.
+        """
+        if not self.fresh:
+            self.get(self.size - 1)
+        with self._lock:
+            return list(self._tables)
+
+
+def band_limit(wavetable: np.ndarray, midi_note: Union[int, float]) -> np.ndarray:
+    """Low-pass filters a wavetable to avoid aliasing when it is played at
+    the pitch.
+
+    :param wavetable: The wavetable, or several stacked along the first axis.
+    :param midi_note: The MIDI pitch of the note.
+    :return: The filtered wavetable.
+    """
+    size_wavetable = wavetable.shape[-1]
+    w = np.concatenate((wavetable, wavetable, wavetable), axis=-1)
+
+    fs = 44100.
+    fc = 20000. * 20. / midi_to_frequency(midi_note)  # cutoff frequency
+    fc_norm = fc / (fs / 2)
+    with metrics.timer('filtfilt'):
+        b, a = signal.butter(5, fc_norm)
+        y = signal.filtfilt(b, a, w, axis=-1)
+
+    return y[..., size_wavetable:2 * size_wavetable].astype(wavetable.dtype)  # the middle part
+
+
+def render_wavetable(wavetable: np.ndarray, midi_note: Union[int, float], start: int, stop: int,
+                     samples_total: int) -> np.ndarray:
+    """Renders a segment of a note played with the wavetable, including the
+    fade in and fade out of the note.
+
+    :param wavetable: The (band-limited) wavetable.
+    :param midi_note: The MIDI pitch of the note.
+    :param start: The first sample of the segment, relative to the note onset.
+    :param stop: The sample after the segment, relative to the note onset.
+    :param samples_total: The length of the note in samples.
+    :return: The samples of the segment.
+    """
+    pointer_idx, envelope = _pointer_and_envelope(wavetable.shape[0], midi_note, start, stop, samples_total)
+    return (wavetable[pointer_idx] * envelope).astype(np.float32)
+
+
+def render_unison(wavetable: np.ndarray, midi_note: Union[int, float], start: int, stop: int, samples_total: int,
+                  detunes: np.ndarray, pans: np.ndarray, phases: np.ndarray, channels: int = 2) -> np.ndarray:
+    """Renders a segment of a note played by several detuned voices of the
+    wavetable. The read positions of all voices are computed as one 2-D
+    array and the voices are mixed to the channels with one matrix product.
+
+    :param wavetable: The (band-limited) wavetable.
+    :param midi_note: The MIDI pitch of the note.
+    :param start: The first sample of the segment, relative to the note onset.
+    :param stop: The sample after the segment, relative to the note onset.
+    :param samples_total: The length of the note in samples.
+    :param detunes: The detuning of every voice in cents.
+    :param pans: The position of every voice between -1. (left) and 1. (right).
+    :param phases: The phase offset of every voice, as a fraction of the cycle.
+    :param channels: 1 for mono or 2 for stereo.
+    :return: The samples of the segment with shape (samples, channels).
+    """
+    table_size = wavetable.shape[0]
+    cycles = midi_to_frequency(midi_note + np.asarray(detunes) / 100.) / 44100.0  # per sample
+    phase = np.asarray(phases, dtype=float)[:, None] + cycles[:, None] * np.arange(start, stop)[None]
+    phase -= np.floor(phase)  # much faster than np.mod
+    pointer_idx = (phase * table_size).astype(np.intp)
+    np.minimum(pointer_idx, table_size - 1, out=pointer_idx)
+    voices = wavetable.take(pointer_idx)  # (voices, samples)
+
+    pans = np.asarray(pans, dtype=float)
+    if channels == 1:
+        gains = np.ones((1, pans.size))
+    else:
+        gains = np.stack((np.minimum(1., 1. - pans), np.minimum(1., 1. + pans)))  # balance law
+    gains /= pans.size  # the voices never add up to more than one voice
+    envelope = note_envelope(start, stop, samples_total)
+    return ((gains.astype(voices.dtype) @ voices) * envelope).T.astype(np.float32)
+
+
+def unison_voices(n_voices: int, detune: float = 10., spread: float = 1.) -> Tuple[np.ndarray, np.ndarray,
+                                                                                  np.ndarray]:
+    """Spreads the voices of a unison evenly in pitch, panorama and phase.
+
+    :param n_voices: The number of voices.
+    :param detune: The detuning of the outermost voices in cents.
+    :param spread: The width of the panorama, between 0. (center) and 1.
+    :return: The detunes, pans and phases for render_unison.
+    """
+    positions = np.linspace(-1., 1., n_voices) if n_voices > 1 else np.zeros(1)
+    return detune * positions, spread * positions, np.arange(n_voices) / n_voices
+
+
+def render_scan(frames: np.ndarray, midi_note: Union[int, float], start: int, stop: int, samples_total: int,
+                frame_start: float = 0., frame_rate: float = 10.) -> np.ndarray:
+    """Renders a segment of a note that scans through a sequence of
+    wavetables, crossfading between neighbouring frames. At the end of the
+    sequence, the scan turns around.
+
+    :param frames: The (band-limited) wavetables with shape (frames, samples).
+    :param midi_note: The MIDI pitch of the note.
+    :param start: The first sample of the segment, relative to the note onset.
+    :param stop: The sample after the segment, relative to the note onset.
+    :param samples_total: The length of the note in samples.
+    :param frame_start: The position in the sequence at the note onset, in frames.
+    :param frame_rate: The number of frames scanned per second.
+    :return: The samples of the segment.
+    """
+    pointer_idx, envelope = _pointer_and_envelope(frames.shape[1], midi_note, start, stop, samples_total)
+    if frames.shape[0] == 1:
+        return (frames[0, pointer_idx] * envelope).astype(np.float32)
+    position = scan_position(frame_start + np.arange(start, stop) * frame_rate / 44100., frames.shape[0])
+    frame = np.minimum(position.astype(int), frames.shape[0] - 2)
+    weight = position - frame
+    samples = frames[frame, pointer_idx] * (1. - weight) + frames[frame + 1, pointer_idx] * weight
+    return (samples * envelope).astype(np.float32)
+
+
+def scan_position(position: Union[float, np.ndarray], n_frames: int) -> Union[float, np.ndarray]:
+    """Folds a position of a scan into the sequence of frames, so that the
+    scan goes back and forth.
+
+    :param position: The position, in frames.
+    :param n_frames: The number of frames.
+    :return: The position between 0 and n_frames - 1.
+    """
+    if n_frames < 2:
+        return np.zeros_like(position, dtype=float)
+    period = 2. * (n_frames - 1)
+    position = np.mod(position, period)
+    return np.where(position > n_frames - 1, period - position, position)
+
+
+def note_envelope(start: int, stop: int, samples_total: int) -> np.ndarray:
+    """The fade in and fade out of a note.
+
+    :param start: The first sample of the segment, relative to the note onset.
+    :param stop: The sample after the segment, relative to the note onset.
+    :param samples_total: The length of the note in samples.
+    :return: The envelope of the segment.
+    """
+    i = np.arange(start, stop)
+    fade_in = 100
+    fade_out = 10000
+    return np.minimum(1., i / fade_in) * np.minimum(1., (samples_total - i) / fade_out)
+
+
+def _pointer_and_envelope(table_size: int, midi_note: Union[int, float], start: int, stop: int,
+                          samples_total: int) -> Tuple[np.ndarray, np.ndarray]:
+    """The read positions in a wavetable and the envelope of a segment of a note."""
+    step = midi_to_frequency(midi_note) / 44100.0 * table_size
+    i = np.arange(start, stop)
+    pointer_idx = np.mod(i * step, table_size).astype(int) % table_size
+    return pointer_idx, note_envelope(start, stop, samples_total)
 
 
 def kernel_for_string(name: str, lengthscale: float = 1.) -> GPy.kern.Kern:
@@ -222,25 +694,188 @@ def kernel_for_string(name: str, lengthscale: float = 1.) -> GPy.kern.Kern:
     raise LookupError()
 
 
-def make_wavetables(kernel: GPy.kern.Kern, n: int = 17, waveshaping: bool = False) -> List[np.ndarray]:
+def kernel_for_expression(expression: str) -> GPy.kern.Kern:
+    """Makes a kernel from an expression like 'RBF(0.5) + Matern32(0.2) * StdPeriodic'.
+
+    The kernels are named as in kernel_for_string, the optional number in
+    parentheses is the length-scale. '*' binds stronger than '+'.
+
+    :param expression: The expression.
+    :return: The kernel.
+    """
+    terms = []
+    for term in re.split(r'\+(?![^(]*\))', expression):  # not within parentheses
+        factors = []
+        for factor in term.split('*'):
+            match = re.fullmatch(r'\s*(\w+)\s*(?:\(\s*([0-9.eE+-]+)\s*\))?\s*', factor)
+            if match is None:
+                raise ValueError(f'Invalid kernel expression: {expression}')
+            lengthscale = float(match.group(2)) if match.group(2) is not None else 1.
+            factors.append(kernel_for_string(match.group(1), lengthscale))
+        product = factors[0]
+        for factor in factors[1:]:
+            product = product * factor
+        terms.append(product)
+    kernel = terms[0]
+    for term in terms[1:]:
+        kernel = kernel + term
+    return kernel
+
+
+def make_wavetables(kernel: GPy.kern.Kern, n: int = 17, waveshaping: bool = False,
+                    rng: Union[None, int, np.random.Generator] = None,
+                    seeds: Optional[np.ndarray] = None) -> List[np.ndarray]:
     """Generates wavetables from kernel.
 
+    The result is reproducible if rng is an integer seed. It is then cached,
+    so identical requests are served without sampling again. The cached
+    tables are copied, so callers may modify the returned ones.
+
     :param kernel: The kernel.
     :param n: The number of wavetables to be generated.
     :param waveshaping: Should waveshaping be used.
+    :param rng: The random number generator or a seed.
+    :param seeds: A seed matrix from make_seeds shared across settings. If
+        given, the first n columns are used and rng is ignored.
     :return: A list of wavetables.
     """
-    wavetables = []
+    key = None
+    if seeds is None and isinstance(rng, (int, np.integer)):
+        # the tables also depend on the configuration of the covariance and the sampling
+        key = (kernel_key(kernel), n, waveshaping, int(rng), config.good_continuation_regression, config.dtype,
+               config.clipping_fallback, config.max_draw_attempts)
+        with _wavetable_cache_lock:
+            if key in _wavetable_cache:
+                _wavetable_cache.move_to_end(key)
+                return [wavetable.copy() for wavetable in _wavetable_cache[key]]
+
+    wavetables = wavetables_from_cholesky(cached_cholesky(kernel, waveshaping), n, rng, seeds, kernel_label(kernel))
+
+    if key is not None:
+        with _wavetable_cache_lock:
+            _wavetable_cache[key] = wavetables
+            while len(_wavetable_cache) > config.wavetable_cache_size:
+                _wavetable_cache.popitem(last=False)
+
+    return [wavetable.copy() for wavetable in wavetables] if key is not None else list(wavetables)
+
+
+_wavetable_cache = OrderedDict()
+_wavetable_cache_lock = threading.Lock()
+
+
+def make_wavetable_sequence(kernel: GPy.kern.Kern, n_frames: int = 200, time_lengthscale: float = 8.,
+                            time_kernel: str = 'RBF', waveshaping: bool = False,
+                            rng: Union[None, int, np.random.Generator] = None) -> np.ndarray:
+    """Draws a sequence of wavetables that evolves smoothly, from a GP over
+    phase and time with the separable covariance K_time (x) K_phase.
+
+    The sample is L_phase Z L_time^T, so only the two small Cholesky
+    decompositions are needed, never the one of the Kronecker product.
+
+    :param kernel: The kernel over the phase.
+    :param n_frames: The number of wavetables.
+    :param time_lengthscale: The length-scale over time, in frames.
+    :param time_kernel: The kernel over time, any stationary kernel of
+        gram.stationary_kernels, e.g. 'RBF' or 'Matern32'.
+    :param waveshaping: Should waveshaping be used?
+    :param rng: The random number generator or a seed.
+    :return: The wavetables with shape (n_frames, samples).
+    """
+    from gpsynth.gram import stationary_kernels
+
+    rng = np.random.default_rng(rng)
+    cholesky_phase = cached_cholesky(kernel, waveshaping)
+    frames = np.arange(n_frames, dtype=float)
+    cov_time = stationary_kernels[time_kernel](np.abs(frames[:, None] - frames[None, :]), time_lengthscale)
+    cholesky_time = jitchol(cov_time, time_kernel).astype(cholesky_phase.dtype)
+
+    z = rng.standard_normal((cholesky_phase.shape[0], n_frames)).astype(cholesky_phase.dtype)
+    with metrics.timer('kronecker_sample', kernel=kernel_label(kernel)):
+        draws = (cholesky_phase @ z) @ cholesky_time.T
+    return np.ascontiguousarray(normalize_draws(draws)[:-1].T)
 
-    if not waveshaping:
-        cholesky = make_cov_cholesky(kernel)
-    else:
-        cholesky = make_cov_cholesky_waveshaping(kernel)
-    for _ in range(n):
-        wavetable = fast_normal_from_cholesky(cholesky)[0]
-        wavetables.append(wavetable[:-1])
 
-    return wavetables
+def wavetables_from_cholesky(cholesky: np.ndarray, n: int, rng: Union[None, int, np.random.Generator] = None,
+                             seeds: Optional[np.ndarray] = None, label: str = '') -> List[np.ndarray]:
+    """Draws wavetables from the Cholesky decomposition of a covariance.
+
+    :param cholesky: The Cholesky decomposition, see make_cov_cholesky.
+    :param n: The number of wavetables to be generated.
+    :param rng: The random number generator or a seed.
+    :param seeds: A seed matrix from make_seeds, see make_wavetables.
+    :param label: The kernel, used as label of the metrics.
+    :return: A list of wavetables.
+    """
+    if seeds is not None:
+        draws = normalize_draws(cholesky @ seeds[:cholesky.shape[0], :n])
+        return [draws[:-1, i] for i in range(draws.shape[1])]
+    draws = draw_normalized(cholesky, n, rng, label)
+    return [draw[:-1] for draw in draws]
+
+
+def cached_cholesky(kernel: GPy.kern.Kern, waveshaping: bool = False) -> np.ndarray:
+    """Returns the Cholesky decomposition of make_cov_cholesky (or
+    make_cov_cholesky_waveshaping), factorizing the covariance only if it is
+    not cached yet.
+
+    The factors are kept in memory, see config.factor_cache_size. If
+    config.factor_cache_dir is set, they are also stored there and memory
+    mapped, so that processes sharing the directory factorize every kernel
+    only once.
+
+    :param kernel: The kernel.
+    :param waveshaping: Should waveshaping be used?
+    :return: The Cholesky decomposition, it must not be modified.
+    """
+    key = (kernel_key(kernel), waveshaping, config.good_continuation_regression, config.dtype)
+    with _factor_cache_lock:
+        if key in _factor_cache:
+            _factor_cache.move_to_end(key)
+            metrics.count('factor_cache_hits_total')
+            return _factor_cache[key]
+
+    path = None
+    cholesky = None
+    if config.factor_cache_dir is not None:
+        path = os.path.join(config.factor_cache_dir, hashlib.sha1(repr(key).encode()).hexdigest() + '.npy')
+        if os.path.exists(path):
+            cholesky = np.load(path, mmap_mode='r')
+            metrics.count('factor_cache_hits_total')
+    if cholesky is None:
+        metrics.count('factor_cache_misses_total')
+        if not waveshaping:
+            cholesky = make_cov_cholesky(kernel)
+        else:
+            cholesky = make_cov_cholesky_waveshaping(kernel)
+        if path is not None:
+            os.makedirs(config.factor_cache_dir, exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.save(f, cholesky)
+            os.replace(tmp_path, path)  # atomic, readers never see a partial file
+
+    with _factor_cache_lock:
+        _factor_cache[key] = cholesky
+        while len(_factor_cache) > config.factor_cache_size:
+            _factor_cache.popitem(last=False)
+    return cholesky
+
+
+_factor_cache = OrderedDict()
+_factor_cache_lock = threading.Lock()
+
+
+def kernel_key(kernel: GPy.kern.Kern) -> tuple:
+    """Makes a hashable description of a kernel and its parameters.
+
+    :param kernel: The kernel.
+    :return: A tuple that is equal for equal kernels.
+    """
+    parts = getattr(kernel, 'parts', None)
+    if parts:
+        return type(kernel).__name__, tuple(kernel_key(part) for part in parts)
+    return type(kernel).__name__, tuple(np.asarray(kernel.param_array).tolist())
 
 
 def plot_spectrum(wavetable: np.ndarray) -> None:
@@ -248,6 +883,8 @@ def plot_spectrum(wavetable: np.ndarray) -> None:
 
     :param wavetable: The wavetable.
     """
+    import matplotlib.pyplot as plt
+
     ps = np.abs(np.fft.fft(wavetable)) ** 2
 
     time_step = 1 / 44100
@@ -262,120 +899,204 @@ def weighted_loudness(wavetable: np.ndarray, mult_freq: float = 1.):
     """Calculates the perceived loudness according to db(B) of a note played
     with the wavetable.
 
-    :param wavetable: The wavetable.
+    :param wavetable: The wavetable, or many wavetables along the first axis.
     :param mult_freq: The frequency of the note as a multiple of 20 Hz.
-    :return: The perceived loudness.
+    :return: The perceived loudness (per wavetable).
     """
-    ps = np.abs(np.fft.fft(wavetable))
+    ps = np.abs(np.fft.fft(wavetable, axis=-1))
 
     time_step = 1 / 44100
-    freqs = np.fft.fftfreq(wavetable.size, time_step)
-    idx = np.argsort(freqs)
+    freqs = np.fft.fftfreq(wavetable.shape[-1], time_step)
+    positive = freqs > 0
 
-    weighted_sum = 0
-    for i in idx:
-        freq = freqs[i]
-        if freq > 0:
-            weighted_sum += perceptual_amplitude_dbb(freq * mult_freq) * ps[i]
+    return np.sum(perceptual_amplitude_dbb(freqs[positive] * mult_freq) * ps[..., positive], axis=-1)
 
-    return weighted_sum
 
-
-def big_sweep(all_kernels: List[GPy.kern.Kern], path: str, ls_subdivisions: int = 16, n_wavetables: int = 7) -> None:
+def big_sweep(all_kernels: List[GPy.kern.Kern], path: str, ls_subdivisions: int = 16, n_wavetables: int = 7,
+              seed: Optional[int] = None, common_seeds: bool = False, n_combinations: int = 1000,
+              export_format: str = 'wav', prune: Optional[float] = None) -> None:
     """Creates wavetables for all kernels with different length scales with
     multiplicative and additive combinations. The result can be used for sound
     synthesis (for example in pureData, SuperCollider or Max/MSP.
 
+    The wavetables are added to a SimilarityIndex saved as similarity.npz.
+    A note of every setting is written to c.wav. The score records where, as
+    sample_offset and sample_count, so single notes can be read without
+    loading the whole file.
+
     :param all_kernels: The list of all kernels.
     :param path: The path where the wavetables are stored.
     :param ls_subdivisions: Number of length-scale subdivisions.
     :param n_wavetables: The number of (randomized) wavetables per setting.
+    :param seed: Makes the sweep reproducible if not None.
+    :param common_seeds: Should all settings share the same seed matrix? The
+        n-th table of every setting is then drawn with the same random numbers.
+    :param n_combinations: The number of random combinations of two kernels.
+    :param export_format: How the wavetables are saved, 'wav', or 'flac' or
+        'bank' to save space, see gpsynth.export. They are encoded in a
+        thread pool while the sweep goes on.
+    :param prune: If not None, settings that draw practically the same
+        wavetables as an earlier setting (see DuplicateFilter, with this
+        threshold) are not saved. They are listed as aliases of that setting
+        in the score.
     """
+    from gpsynth.export import WavetableExporter
+
+    rng = np.random.default_rng(seed)
+    seeds = make_seeds(n_wavetables, rng) if common_seeds else None
+
     out_long = WavFile(os.path.join(path, 'c.wav'))
+    index = SimilarityIndex()
+    exporter = WavetableExporter(path, export_format)
+
+    duplicates = DuplicateFilter(prune) if prune is not None else None
 
     delta_t = 1.
-    ls_start = 0.01
-    ls_end = np.pi
 
     score = []
     time = 0.
-    l_vals = np.geomspace(ls_start, ls_end, ls_subdivisions).tolist()
-
-    n_combinations = 1000
-    for _ in range(n_combinations):
-        k1_str = random.choice(all_kernels)
-        while True:
-            k2_str = random.choice(all_kernels)
-            if k2_str != k1_str:
-                break
-        l1 = random.choice(l_vals)
-        l2 = random.choice(l_vals)
-        l1_idx = l_vals.index(l1)
-        l2_idx = l_vals.index(l2)
-
-        k1 = kernel_for_string(k1_str, lengthscale=l1)
-        k2 = kernel_for_string(k2_str, lengthscale=l2)
-        operator = random.choice(['plus', 'times'])
-        if operator == 'plus':
-            kernel = k1 + k2
-        else:
-            kernel = k1 * k2
-
-        waveshaping = random.choice([True, False])
 
-        synth = GPSynth(kernel, out_rt=None, out_wav=out_long, n_wavetables=n_wavetables, waveshaping=waveshaping)
-        print(f'waveshaping={waveshaping}', k1_str, l1, operator, k2_str, l2)
+    def add_setting(setting: dict, synth: GPSynth, cholesky: np.ndarray) -> None:
+        nonlocal time
+        if duplicates is not None:
+            original = duplicates.check(len(score), expected_features(cholesky))
+            if original is not None:
+                print('duplicate of', wavetable_prefix(score[original]))
+                score[original].setdefault('aliases', []).append(setting)
+                return
         for n_idx in range(1):  # only one note to c.wav otherwise the file becomes too big for the web.
-            score.append({
-                'kernel_1': k1_str,
-                'operator': 'plus',
-                'kernel_2': k2_str,
-                'lengthscale_1': l1,
-                'lengthscale_1_idx': l1_idx,
-                'lengthscale_2': l2,
-                'lengthscale_2_idx': l2_idx,
-                'waveshaping': waveshaping,
-                'time': time,
-                'note': n_idx
-            })
+            score.append(dict(setting, time=time, note=n_idx, sample_offset=out_long.samples_written))
             synth.note(60, delta_t)
+            score[-1]['sample_count'] = out_long.samples_written - score[-1]['sample_offset']
             time += delta_t
 
-        waveshaping_str = 'waveshaping_' if waveshaping else ''
-        prefix = waveshaping_str + k1_str + f'_l{l1_idx:03d}(plus)' + k2_str + f'_l{l2_idx:03d}_n'
-        synth.save_wavetables(os.path.join(path, 'samples'), prefix)
+        exporter.save(wavetable_prefix(score[-1]), synth.wavetables)
+        index.add([wavetable_prefix(score[-1]) + f'{i:02d}.wav' for i in range(len(synth.wavetables))],
+                  synth.wavetables)
+
+    for setting in sweep_settings(all_kernels, ls_subdivisions, seed, n_combinations)[:n_combinations]:
+        kernel = kernel_for_score_entry(setting)
+        synth = GPSynth(kernel, out_rt=None, out_wav=out_long, n_wavetables=n_wavetables,
+                        waveshaping=setting['waveshaping'], rng=rng, seeds=seeds)
+        print(f'waveshaping={setting["waveshaping"]}', setting['kernel_1'], setting['lengthscale_1'],
+              setting['operator'], setting['kernel_2'], setting['lengthscale_2'])
+        add_setting(setting, synth, cached_cholesky(kernel, setting['waveshaping']))
+
+    from gpsynth.gram import grid_choleskys
 
     for waveshaping in [False, True]:
         for kernel_str in all_kernels:
             ls_start = 0.01
             ls_end = np.pi
             l_vals = np.geomspace(ls_start, ls_end, ls_subdivisions)
-            for l_idx, lengthscale in enumerate(l_vals):
-                k = kernel_for_string(kernel_str, lengthscale=lengthscale)
-                synth = GPSynth(k, out_rt=None, out_wav=out_long, n_wavetables=n_wavetables, waveshaping=waveshaping)
+            # the covariances of all length-scales of the kernel are built together
+            choleskys = (cholesky for batch in grid_choleskys(kernel_str, l_vals, waveshaping) for cholesky in batch)
+            for l_idx, (lengthscale, cholesky) in enumerate(zip(l_vals, choleskys)):
+                wavetables = wavetables_from_cholesky(cholesky, n_wavetables, rng, seeds, kernel_str)
+                synth = GPSynth(None, out_rt=None, out_wav=out_long, wavetables=wavetables)
                 print(f'waveshaping={waveshaping}', kernel_str, lengthscale, f'waveshaping = {waveshaping}')
-                for n_idx in range(1):  # only one note to c.wav otherwise the file becomes too big for the web.
-                    score.append({
-                        'kernel_1': kernel_str,
-                        'operator': '',
-                        'kernel_2': '',
-                        'lengthscale_1': lengthscale,
-                        'lengthscale_1_idx': l_idx,
-                        'lengthscale_2': -1,
-                        'lengthscale_2_idx': -1,
-                        'waveshaping': waveshaping,
-                        'time': time,
-                        'note': n_idx
-                    })
-                    synth.note(60, delta_t)
-                    time += delta_t
-
-                waveshaping_str = 'waveshaping_' if waveshaping else ''
-                prefix = waveshaping_str + kernel_str + f'_l{l_idx:03d}_n'
-                synth.save_wavetables(os.path.join(path, 'samples'), prefix)
-
+                add_setting({
+                    'kernel_1': kernel_str,
+                    'operator': '',
+                    'kernel_2': '',
+                    'lengthscale_1': lengthscale,
+                    'lengthscale_1_idx': l_idx,
+                    'lengthscale_2': -1,
+                    'lengthscale_2_idx': -1,
+                    'waveshaping': waveshaping,
+                }, synth, cholesky)
+
+    out_long.close()
+    exporter.close()
     with open(os.path.join(path, 'score.json'), 'w') as f:
         json.dump(score, f, indent=4)
+    index.save(os.path.join(path, 'similarity.npz'))
+
+    if metrics.is_enabled():
+        metrics.to_json(os.path.join(path, 'metrics.json'))
+        with open(os.path.join(path, 'metrics.prom'), 'w') as f:
+            f.write(metrics.to_prometheus())
+
+
+def sweep_settings(all_kernels: List[str], ls_subdivisions: int = 16, seed: Optional[int] = None,
+                   n_combinations: int = 1000) -> List[dict]:
+    """The settings of big_sweep in its order: the random combinations of two
+    kernels, then every kernel with every length-scale, without and with
+    waveshaping.
+
+    :param all_kernels: The names of the kernels.
+    :param ls_subdivisions: Number of length-scale subdivisions.
+    :param seed: Makes the combinations reproducible if not None.
+    :param n_combinations: The number of random combinations of two kernels.
+    :return: The settings as entries of the score, without the timing.
+    """
+    chooser = random.Random(seed)
+    l_vals = np.geomspace(0.01, np.pi, ls_subdivisions).tolist()
+    settings = []
+
+    for _ in range(n_combinations):
+        k1_str = chooser.choice(all_kernels)
+        while True:
+            k2_str = chooser.choice(all_kernels)
+            if k2_str != k1_str:
+                break
+        l1 = chooser.choice(l_vals)
+        l2 = chooser.choice(l_vals)
+        operator = chooser.choice(['plus', 'times'])
+        waveshaping = chooser.choice([True, False])
+        settings.append({
+            'kernel_1': k1_str,
+            'operator': operator,
+            'kernel_2': k2_str,
+            'lengthscale_1': l1,
+            'lengthscale_1_idx': l_vals.index(l1),
+            'lengthscale_2': l2,
+            'lengthscale_2_idx': l_vals.index(l2),
+            'waveshaping': waveshaping,
+        })
+
+    for waveshaping in [False, True]:
+        for kernel_str in all_kernels:
+            for l_idx, lengthscale in enumerate(l_vals):
+                settings.append({
+                    'kernel_1': kernel_str,
+                    'operator': '',
+                    'kernel_2': '',
+                    'lengthscale_1': lengthscale,
+                    'lengthscale_1_idx': l_idx,
+                    'lengthscale_2': -1,
+                    'lengthscale_2_idx': -1,
+                    'waveshaping': waveshaping,
+                })
+    return settings
+
+
+def wavetable_prefix(entry: dict) -> str:
+    """The filename prefix of the wavetables of a setting of big_sweep.
+
+    :param entry: The entry of the setting in the score.
+    :return: The prefix, it is followed by the number of the wavetable.
+    """
+    waveshaping_str = 'waveshaping_' if entry['waveshaping'] else ''
+    if entry['operator'] == '':
+        return waveshaping_str + entry['kernel_1'] + f'_l{entry["lengthscale_1_idx"]:03d}_n'
+    return waveshaping_str + entry['kernel_1'] + f'_l{entry["lengthscale_1_idx"]:03d}({entry["operator"]})' + \
+        entry['kernel_2'] + f'_l{entry["lengthscale_2_idx"]:03d}_n'
+
+
+def kernel_for_score_entry(entry: dict) -> GPy.kern.Kern:
+    """Makes the kernel of a setting of big_sweep.
+
+    :param entry: The entry of the setting in the score.
+    :return: The kernel.
+    """
+    kernel = kernel_for_string(entry['kernel_1'], lengthscale=entry['lengthscale_1'])
+    if entry['operator'] == '':
+        return kernel
+    kernel_2 = kernel_for_string(entry['kernel_2'], lengthscale=entry['lengthscale_2'])
+    if entry['operator'] == 'plus':
+        return kernel + kernel_2
+    return kernel * kernel_2
 
 
 all_kernels = [
@@ -1,14 +1,34 @@
-from evaluate import speed_test, make_continuous_discontinuous
+import os
+
+import pytest
+
+from benchmark import run_benchmarks, save_results, compare
+from evaluate import make_continuous_discontinuous
 import plots
 
 
-def test_speed_test():
-    speed_test(n_wavetables=1)
+def test_benchmarks(tmp_path: str):
+    results = run_benchmarks(['covariance', 'sampling', 'weighted_loudness', 'note', 'wav_writing'], repeats=1,
+                             quick=True)
+    assert 'note/0.1s' in results
+    path = os.path.join(tmp_path, 'benchmark.json')
+    save_results(results, path)
+    assert compare(path, results) == []
+
+
+@pytest.fixture(scope='module')
+def results_dir(tmp_path_factory) -> str:
+    return str(tmp_path_factory.mktemp('results'))  # shared, so the plots reuse the WAV files
 
 
-def test_make_continuous_discontinuous(tmp_path: str):
-    make_continuous_discontinuous(tmp_path)
+def test_make_continuous_discontinuous(results_dir: str):
+    make_continuous_discontinuous(results_dir)
+    assert os.path.exists(os.path.join(results_dir, 'good_continuation=False.wav'))
 
 
-def test_plots(tmp_path: str):
-    plots.main(tmp_path)
+def test_plots(results_dir: str):
+    rendered = plots.main(results_dir)
+    assert len(rendered) == 9
+    assert all(os.path.exists(path) for path in rendered)
+    assert plots.main(results_dir, processes=1) == []  # unchanged figures are skipped
+    assert len(plots.main(results_dir, processes=1, seed=1)) == 7  # the spectrograms do not depend on the seed
@@ -1,11 +1,29 @@
+import asyncio
+
 import pytest
-import datetime
+import json
 import os
+import subprocess
+import sys
 
 import numpy as np
 
-from gpsynth.audio_output import WavFile, RealtimeAudio
-from gpsynth.synthesizer import GPSynth, kernel_for_string, all_kernels
+import gpsynth.config as config
+import gpsynth.metrics as metrics
+from gpsynth.anchors import AnchoredSampler
+from gpsynth.audio_output import WavFile, RealtimeAudio, read_wav, wav_segment_bytes
+from gpsynth.export import WavetableBank, WavetableExporter, to_wav
+from gpsynth.fit import fit_kernel, fit_kernels, load_target
+from gpsynth.gram import grid_choleskys
+from gpsynth.jobqueue import enqueue, enqueue_sweep, failures, merge_sweep, results, run_worker
+from gpsynth.morph import LengthscaleMorph
+from gpsynth.render import NoteEvent, render_score
+from gpsynth.rff import evaluate, harmonic_weights, render_fourier, sample_coefficients
+from gpsynth.similarity import DuplicateFilter, SimilarityIndex, expected_features, extract_cycle, \
+    spectral_features
+from gpsynth.synthesizer import GPSynth, kernel_for_string, all_kernels, big_sweep, draw_normalized, \
+    cached_cholesky, fast_normal_from_cholesky, make_cov_cholesky, make_seeds, make_wavetable_sequence, \
+    make_wavetables, render_unison, render_wavetable, sample_grid, unison_voices
 
 
 def test_audio_output(tmp_path: str):
@@ -35,3 +53,520 @@ def test_synthesizer(tmp_path: str):
             synth = GPSynth(kernel, rta, wav, 3, waveshaping)
             synth.note(60., 0.1)
             synth.save_wavetables(tmp_path, f'{idx}{waveshaping}.wav')
+
+
+def test_lengthscale_morph():
+    morph = LengthscaleMorph('RBF', np.geomspace(0.1, 1., 3), n_wavetables=2)
+    for lengthscale in [0.05, 0.1, 0.3, 1., 2.]:
+        wavetables = morph.wavetables(lengthscale)
+        assert len(wavetables) == 2
+        for wavetable in wavetables:
+            assert wavetable.size == morph.table_size
+            assert np.max(np.abs(wavetable)) < 0.9 + 1e-9
+
+
+def test_seeded_wavetables_are_reproducible():
+    kernel = kernel_for_string('Matern32', lengthscale=0.5)
+    first = make_wavetables(kernel, 3, rng=np.random.default_rng(1))
+    second = make_wavetables(kernel, 3, rng=np.random.default_rng(1))
+    for a, b in zip(first, second):
+        np.testing.assert_array_equal(a, b)
+
+    cached = make_wavetables(kernel, 3, rng=7)
+    expected = [wavetable.copy() for wavetable in cached]
+    cached[0][:] = 0.  # must not change the cache
+    for a, b in zip(expected, make_wavetables(kernel, 3, rng=7)):
+        np.testing.assert_array_equal(a, b)
+
+    previous = config.good_continuation_regression
+    try:
+        config.good_continuation_regression = not previous
+        assert not np.array_equal(expected[0], make_wavetables(kernel, 3, rng=7)[0])
+    finally:
+        config.good_continuation_regression = previous
+
+    previous = config.dtype
+    try:
+        config.dtype = 'float64' if previous == 'float32' else 'float32'
+        assert make_wavetables(kernel, 3, rng=7)[0].dtype == np.dtype(config.dtype)
+    finally:
+        config.dtype = previous
+
+
+def test_common_seeds():
+    seeds = make_seeds(2, rng=3)
+    kernels = [kernel_for_string('RBF', lengthscale=l) for l in [0.5, 0.6]]
+    tables = [make_wavetables(k, 2, seeds=seeds) for k in kernels]
+    choleskys = [make_cov_cholesky(k) for k in kernels]
+    grid = sample_grid(choleskys, seeds)
+    assert grid.shape == (2, choleskys[0].shape[0], 2)
+    for setting in range(2):
+        for i in range(2):
+            np.testing.assert_allclose(tables[setting][i], grid[setting, :-1, i])
+    # neighbouring length-scales drawn from the same seeds are similar
+    assert np.corrcoef(tables[0][0], tables[1][0])[0, 1] > 0.5
+
+
+def test_render_score(tmp_path: str):
+    synth = GPSynth(kernel_for_string('RBF', lengthscale=0.5), None, None, 2)
+    events = [NoteEvent(0., 60, 0.5, synth), NoteEvent(0.25, 64, 0.5, synth), NoteEvent(0.3, 67, 0.2, synth, 0.5)]
+    path = os.path.join(tmp_path, 'render.wav')
+    wav = WavFile(path)
+    render_score(events, wav, block_size=1000, gain=0.5)
+    wav.close()
+
+    samples = read_wav(path)
+    assert samples.size == int(0.25 * 44100) + int(0.5 * 44100)
+    assert np.max(np.abs(samples)) <= 1.
+
+
+def test_render_score_unison(tmp_path: str):
+    wavetables = make_wavetables(kernel_for_string('Matern52', lengthscale=0.3), 2, rng=0)
+    paths = [os.path.join(tmp_path, name) for name in ['note.wav', 'render.wav']]
+    wavs = [WavFile(path, channels=2) for path in paths]
+    synth = GPSynth(None, None, wavs[0], wavetables=wavetables, unison=3, detune=12.)
+    synth.note(60, 0.5)
+    synth.note(64, 0.5)
+    synth = GPSynth(None, None, None, wavetables=wavetables, unison=3, detune=12.)
+    render_score([NoteEvent(0., 60, 0.5, synth), NoteEvent(0.5, 64, 0.5, synth)], wavs[1], block_size=1000)
+    for wav in wavs:
+        wav.close()
+    expected, rendered = [read_wav(path) for path in paths]
+    assert rendered.shape == (44100, 2)
+    np.testing.assert_array_equal(rendered, expected)
+
+
+def test_render_score_scan(tmp_path: str):
+    kernel = kernel_for_string('RBF', lengthscale=0.5)
+    paths = [os.path.join(tmp_path, name) for name in ['note.wav', 'render.wav']]
+    wavs = [WavFile(path) for path in paths]
+    synths = [GPSynth(kernel, None, wav, scan_frames=8, scan_rate=20., rng=3) for wav in [wavs[0], None]]
+    synths[0].note(60, 0.3)
+    synths[0].note(62, 0.3)
+    render_score([NoteEvent(0., 60, 0.3, synths[1]), NoteEvent(0.3, 62, 0.3, synths[1])], wavs[1], block_size=1000)
+    for wav in wavs:
+        wav.close()
+    expected, rendered = [read_wav(path) for path in paths]
+    np.testing.assert_array_equal(rendered, expected)
+    assert synths[1].scan_position == synths[0].scan_position
+
+
+def test_import_time():
+    code = 'import sys, time; start = time.perf_counter(); ' \
+           'import gpsynth, gpsynth.synthesizer, gpsynth.audio_output, gpsynth.render, gpsynth.morph; ' \
+           'print(time.perf_counter() - start); ' \
+           'print(" ".join(m for m in ["GPy", "matplotlib", "pyaudio", "scipy.signal"] if m in sys.modules))'
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, universal_newlines=True, check=True,
+                            cwd=root)
+    elapsed, loaded = (result.stdout.splitlines() + [''])[:2]
+    assert loaded == ''
+    assert float(elapsed) < 2., f'Importing gpsynth took {elapsed} s'
+
+
+def test_metrics(tmp_path: str):
+    metrics.reset()
+    metrics.enable()
+    try:
+        synth = GPSynth(kernel_for_string('OU', lengthscale=0.05), None, WavFile(os.path.join(tmp_path, 'm.wav')), 3)
+        synth.note(60, 0.1)
+    finally:
+        metrics.disable()
+
+    summary = metrics.summary()
+    stages = {t['stage'] for t in summary['timers']}
+    assert {'gp_prediction', 'cholesky', 'sampling', 'filtfilt', 'wav_write'} <= stages
+    assert 0. <= summary['rejection_rate']['OU'] < 1.
+    counters = {c['name']: c['value'] for c in summary['counters']}
+    assert counters['wav_bytes_written_total'] == 2 * int(0.1 * 44100)
+    assert 'gpsynth_draws_total{kernel="OU"}' in metrics.to_prometheus()
+    metrics.reset()
+
+
+@pytest.mark.parametrize('waveshaping', [False, True])
+def test_float32_audio_error(waveshaping: bool, monkeypatch):
+    kernel = kernel_for_string('Matern52', lengthscale=0.3)
+    rendered = {}
+    for dtype in ['float64', 'float32']:
+        monkeypatch.setattr(config, 'dtype', dtype)
+        seeds = make_seeds(2, rng=5)
+        wavetables = make_wavetables(kernel, 2, waveshaping, seeds=seeds)
+        assert all(w.dtype == np.dtype(dtype) for w in wavetables)
+        synth = GPSynth(None, None, None, wavetables=wavetables)
+        wavetable = synth.next_wavetable(60)
+        assert wavetable.dtype == np.dtype(dtype)
+        rendered[dtype] = render_wavetable(wavetable, 60, 0, 44100, 44100)
+
+    assert np.max(np.abs(rendered['float64'] - rendered['float32'])) < 2. ** -12
+
+
+def test_batched_rejection_sampling():
+    cholesky = make_cov_cholesky(kernel_for_string('Exponential', lengthscale=0.01))
+    batched = draw_normalized(cholesky, 4, np.random.default_rng(2))
+    rng = np.random.default_rng(2)
+    sequential = [fast_normal_from_cholesky(cholesky, rng)[0] for _ in range(4)]
+    np.testing.assert_allclose(batched, sequential, rtol=1e-4, atol=1e-6)
+
+
+@pytest.mark.parametrize('fallback', ['rescale', 'softclip'])
+def test_bounded_rejection_sampling(fallback: str, monkeypatch):
+    monkeypatch.setattr(config, 'clipping_fallback', fallback)
+    cholesky = make_cov_cholesky(kernel_for_string('White'))
+    metrics.reset()
+    metrics.enable()
+    try:
+        draws = draw_normalized(cholesky, 3, np.random.default_rng(0), label='White', max_attempts=1)
+    finally:
+        metrics.disable()
+    assert draws.shape == (3, cholesky.shape[0])
+    assert np.max(np.abs(draws)) <= 0.9 + 1e-6
+    counters = {c['name']: c['value'] for c in metrics.summary()['counters']}
+    assert counters['draws_total'] == 3
+    metrics.reset()
+
+
+def test_anchored_sampler():
+    kernel = kernel_for_string('Matern52', lengthscale=0.5)
+    sampler = AnchoredSampler(kernel)
+    cholesky = make_cov_cholesky(kernel).astype(float)
+    np.testing.assert_allclose(sampler.upper.T @ sampler.upper, cholesky @ cholesky.T, atol=1e-5)
+
+    idx = 700
+    sampler.add_anchor(sampler.xs[idx], 0.5)
+    for wavetable in sampler.sample(3, rng=0):  # the anchors are exact by default
+        assert abs(wavetable[idx] - 0.5) < 0.01
+        assert abs(wavetable[0]) < 0.01
+
+    with pytest.raises(ValueError):
+        sampler.add_anchor(sampler.xs[idx], 0.2)
+
+    # draws beyond the peak are drawn again instead of being scaled
+    for wavetable in sampler.sample(5, rng=0, peak=2.5):
+        assert np.max(np.abs(wavetable)) <= 2.5
+        assert abs(wavetable[idx] - 0.5) < 0.01
+
+
+@pytest.mark.parametrize('kernel_name', ['Matern52', 'Exponential'])
+def test_anchored_sampler_several_anchors(kernel_name: str):
+    kernel = kernel_for_string(kernel_name, lengthscale=0.5)
+    sampler = AnchoredSampler(kernel)
+    anchors = [(300, 0.4), (900, -0.3), (2200, 0.2)]  # the last one next to the anchor at the end of the table
+    for i, y in anchors:
+        sampler.add_anchor(sampler.xs[i], y)
+
+    xs = sampler.xs[:, None]
+    x_anchors = np.array(sampler.anchors)[:, :1]
+    k_grid_anchors = kernel.K(xs, x_anchors)
+    posterior = kernel.K(xs, xs) - k_grid_anchors @ np.linalg.solve(kernel.K(x_anchors, x_anchors), k_grid_anchors.T)
+    np.testing.assert_allclose(sampler.upper.T @ sampler.upper, posterior, atol=1e-5)
+
+    draws = np.array(sampler.sample(4, rng=1))
+    assert np.all(np.isfinite(draws))
+    for i, y in anchors:
+        np.testing.assert_allclose(draws[:, i], y, atol=1e-3)
+
+
+def test_fit_kernels():
+    target = make_wavetables(kernel_for_string('RBF', lengthscale=0.5), n=1, rng=0)[0]
+    results = fit_kernels(target, ['RBF', 'Exponential'], n_points=64, processes=1)
+    assert [r['kernel'] for r in results][0] == 'RBF'
+    assert 0.2 < results[0]['lengthscale'] < 1.
+    assert results[0]['log_likelihood'] > results[1]['log_likelihood']
+
+
+@pytest.mark.parametrize('kernel_name', ['RatQuad', 'PeriodicMatern32'])
+def test_fit_kernel_reproducible(kernel_name: str):
+    import GPy  # not at the top, see test_import_time
+    y = load_target(make_wavetables(kernel_for_string('Matern32', lengthscale=0.5), n=1, rng=0)[0], 64)
+    result = fit_kernel(kernel_name, y)
+    kernel = kernel_for_string(kernel_name, result['lengthscale'])
+    kernel.variance = result['variance']
+    xs = (np.arange(y.size) * 2. * np.pi / y.size)[:, None]
+    model = GPy.models.GPRegression(xs, y[:, None], kernel, noise_var=1e-6)
+    assert model.log_likelihood() == pytest.approx(result['log_likelihood'], rel=1e-6)
+
+
+def test_synth_service(tmp_path: str):
+    aiohttp = pytest.importorskip('aiohttp')
+    from aiohttp.test_utils import TestClient, TestServer
+    from ui.synth_service import SynthService, _http_error, make_app
+
+    async def run():
+        service = SynthService(processes=1, factor_cache_dir=str(tmp_path))
+        async with TestClient(TestServer(make_app(service))) as client:
+            query = {'kernel': 'RBF(0.5) + Matern32(0.3)', 'n': '2', 'seed': '3'}
+            metrics.reset()
+            metrics.enable()
+            try:
+                responses = await asyncio.gather(*(client.get('/wavetables', params=query) for _ in range(3)))
+                tables = [(await r.json())['wavetables'] for r in responses]
+                counters = {c['name']: c['value'] for c in metrics.summary()['counters']}
+            finally:
+                metrics.disable()
+                metrics.reset()
+            assert tables[0] == tables[1] == tables[2]
+            assert np.array(tables[0]).shape == (2, 2205)
+            assert counters['service_requests_coalesced_total'] == 2
+
+            response = await client.get('/note', params={'kernel': 'RBF(0.5)', 'duration': '0.1', 'seed': '0'})
+            assert len(await response.read()) == 44 + 2 * 4410
+            assert (await client.get('/wavetables', params={'kernel': 'Unknown'})).status == 400
+            assert (await client.get('/wavetables', params={'kernel': 'RBF', 'n': '1000000'})).status == 400
+            assert (await client.get('/note', params={'kernel': 'RBF', 'duration': '1e6'})).status == 400
+
+            async with client.ws_connect('/ws') as ws:
+                await ws.send_json({'type': 'note', 'kernel': 'RBF(0.5)', 'duration': 0.1, 'seed': 0})
+                assert (await ws.receive_json())['samples'] == 4410
+                received = 0
+                while True:
+                    msg = await ws.receive()
+                    if msg.type != aiohttp.WSMsgType.BINARY:
+                        break
+                    received += len(msg.data)
+                assert received == 2 * 4410
+
+            # a worker that dies is reported, and the next request gets a new pool
+            service.executor.submit(os._exit, 1)
+            await asyncio.sleep(0.5)  # the pool notices it is broken
+            query = {'kernel': 'Matern32(0.3)', 'seed': '1'}
+            assert (await client.get('/wavetables', params=query)).status == 503
+            assert (await client.get('/wavetables', params=query)).status == 200
+        assert _http_error(np.linalg.LinAlgError('not positive definite')).status == 422
+
+    asyncio.run(run())
+
+
+def test_features_of_short_file(tmp_path: str):
+    pytest.importorskip('librosa')
+    from ui.analyze_sound import extract_features_stream
+
+    path = os.path.join(tmp_path, 'short.wav')
+    wav = WavFile(path)
+    wav.write_samples(0.5 * np.sin(np.arange(441) * 0.1))  # shorter than one frame
+    wav.close()
+    features, n_hops, valid_indices = extract_features_stream(path)
+    assert n_hops == 0 and valid_indices.size == 0
+    assert features['mfcc'].shape[0] == 0 and features['all'].ndim == 2
+
+
+@pytest.mark.parametrize('kernel_name', ['Matern32', 'StdPeriodic', 'Poly'])
+def test_grid_choleskys(kernel_name: str):
+    lengthscales = [0.1, 1.]
+    choleskys = np.concatenate(list(grid_choleskys(kernel_name, lengthscales, batch_size=1)))
+    assert choleskys.shape == (2, 2206, 2206)
+    for lengthscale, cholesky in zip(lengthscales, choleskys):
+        expected = make_cov_cholesky(kernel_for_string(kernel_name, lengthscale)).astype(float)
+        cholesky = cholesky.astype(float)
+        np.testing.assert_allclose(cholesky @ cholesky.T, expected @ expected.T, atol=1e-5)
+
+
+def test_preview_index(tmp_path: str):
+    big_sweep(['Matern32'], tmp_path, ls_subdivisions=1, n_wavetables=1, seed=0, n_combinations=0)
+    with open(os.path.join(tmp_path, 'score.json'), 'r') as f:
+        score = json.load(f)
+    c_wav = os.path.join(tmp_path, 'c.wav')
+    samples = read_wav(c_wav)
+    assert samples.size == sum(entry['sample_count'] for entry in score)
+
+    entry = score[1]
+    segment = wav_segment_bytes(c_wav, entry['sample_offset'], entry['sample_count'])
+    path = os.path.join(tmp_path, 'segment.wav')
+    with open(path, 'wb') as f:
+        f.write(segment)
+    np.testing.assert_array_equal(read_wav(path), samples[entry['sample_offset']:])
+    assert wav_segment_bytes(c_wav, entry['sample_offset'], entry['sample_count'], 43, 101) == segment[43:101]
+
+
+def test_similarity_index(tmp_path: str):
+    index = SimilarityIndex(n_bits=32)
+    smooth = make_wavetables(kernel_for_string('RBF', lengthscale=1.), 3, rng=0)
+    rough = make_wavetables(kernel_for_string('Exponential', lengthscale=0.1), 3, rng=0)
+    index.add(['smooth0', 'smooth1', 'smooth2'], smooth)
+    index.add(['rough0', 'rough1', 'rough2'], rough)
+
+    assert {name for name, _ in index.query_name('smooth0', k=2)} == {'smooth1', 'smooth2'}
+    assert index.query(rough[1], k=1)[0][0] == 'rough1'
+    assert index.query(rough[1], k=1, approximate=True)[0][0] == 'rough1'
+
+    path = os.path.join(tmp_path, 'similarity.npz')
+    index.save(path)
+    loaded = SimilarityIndex.load(path)
+    assert loaded.query_name('smooth0', k=2) == index.query_name('smooth0', k=2)
+
+    synth = GPSynth(None, None, None, wavetables=smooth)
+    synth.save_wavetables(os.path.join(tmp_path, 'samples'), 'RBF_')
+    assert loaded.update_from_directory(os.path.join(tmp_path, 'samples')) == 3
+    assert loaded.update_from_directory(os.path.join(tmp_path, 'samples')) == 0
+    assert loaded.query(smooth[2], k=2)[1][0] in ('smooth2', 'RBF_02.wav')
+
+    cycle = extract_cycle(np.sin(np.arange(44100) * 2. * np.pi * 441. / 44100.))
+    assert np.corrcoef(np.abs(np.fft.rfft(cycle))[1:10], [1, 0, 0, 0, 0, 0, 0, 0, 0])[0, 1] > 0.99
+
+
+def test_wavetable_sequence(tmp_path: str):
+    kernel = kernel_for_string('Matern52', lengthscale=0.5)
+    frames = make_wavetable_sequence(kernel, n_frames=50, time_lengthscale=8., rng=0)
+    assert frames.shape == (50, 2205)
+    assert np.max(np.abs(frames)) <= 0.9
+    assert np.corrcoef(frames[0], frames[1])[0, 1] > 0.9
+    assert np.corrcoef(frames[0], frames[1])[0, 1] > abs(np.corrcoef(frames[0], frames[30])[0, 1])
+
+    path = os.path.join(tmp_path, 'scan.wav')
+    wav = WavFile(path)
+    synth = GPSynth(kernel, None, wav, scan_frames=50, rng=0, scan_rate=20.)
+    synth.note(60, 0.5)
+    synth.note(64, 0.5)
+    wav.close()
+    assert synth.scan_position == 20.
+    assert read_wav(path).size == 2 * 22050
+
+
+def test_fourier_wavetables():
+    from gpsynth.gram import stationary_kernels
+    d = np.linspace(0., np.pi, 20)
+    weights = harmonic_weights('StdPeriodic', 0.5, 64)
+    k = np.arange(1, 65)[:, None]
+    approx = np.sum(2. * weights[:, None] * np.cos(k * d), axis=0)
+    exact = stationary_kernels['StdPeriodic'](d, 0.5)
+    assert np.allclose(approx - approx[0], exact - exact[0], atol=1e-8)
+
+    coefficients = sample_coefficients('Matern32', 0.3, n=3, rng=0)
+    assert coefficients.shape == (3, 256)
+    tables = evaluate(coefficients)
+    assert tables.shape == (3, 2205)
+    assert np.allclose(evaluate(coefficients, 4410)[:, ::2], tables, atol=1e-6)
+
+    high = evaluate(coefficients[0], midi_note=100)
+    assert np.max(np.abs(np.fft.rfft(high)[int(20000. / 2637.02) + 1:])) < 1e-3
+
+    samples = render_fourier(coefficients[0], 60, 0, 5000, 5000)
+    assert samples.shape == (5000,)
+    assert np.max(np.abs(samples)) <= 1.
+    with pytest.raises(LookupError):
+        harmonic_weights('Poly')
+
+
+def test_job_queue(tmp_path: str):
+    job_dir = os.path.join(tmp_path, 'queue')
+    enqueue(job_dir, [{'x': x} for x in range(5)])
+    os.rename(os.path.join(job_dir, 'pending', '000002.json'), os.path.join(job_dir, 'claimed', '000002.json'))
+    os.utime(os.path.join(job_dir, 'claimed', '000002.json'), (0, 0))  # claimed by a worker that died
+    assert run_worker(job_dir, lambda job, _: job['x'] ** 2, lease=60., max_jobs=3) == 3
+    with pytest.raises(RuntimeError):
+        results(job_dir)
+    assert run_worker(job_dir, lambda job, _: job['x'] ** 2, lease=60.) == 2
+    assert results(job_dir) == [0, 1, 4, 9, 16]
+
+    def fail_on_3(job, _):
+        if job['x'] == 3:
+            raise np.linalg.LinAlgError('not positive definite')
+        return job['x']
+
+    failing_dir = os.path.join(tmp_path, 'failing')
+    enqueue(failing_dir, [{'x': x} for x in range(5)])
+    assert run_worker(failing_dir, fail_on_3, lease=60.) == 5  # the worker survives the failed job
+    with pytest.raises(RuntimeError, match='LinAlgError'):
+        results(failing_dir)
+    assert results(failing_dir, skip_failed=True) == [0, 1, 2, None, 4]
+    assert failures(failing_dir) == {3: 'LinAlgError: not positive definite'}
+
+    sweep_dir = os.path.join(tmp_path, 'sweep')
+    enqueue_sweep(sweep_dir, ['Matern32', 'RBF'], ls_subdivisions=1, n_wavetables=2, seed=0, n_combinations=1)
+    workers = [subprocess.Popen([sys.executable, '-m', 'gpsynth.make_wavetables', sweep_dir, '--worker'])
+               for _ in range(3)]
+    assert all(worker.wait() == 0 for worker in workers)
+    assert len(os.listdir(os.path.join(sweep_dir, 'done'))) == 5
+    assert not os.listdir(os.path.join(sweep_dir, 'claimed'))
+
+    score = merge_sweep(sweep_dir)
+    assert len(score) == 5 and score[1]['operator'] == '' and score[4]['waveshaping']
+    assert score[-1]['sample_offset'] + score[-1]['sample_count'] == read_wav(os.path.join(sweep_dir, 'c.wav')).size
+    assert len(SimilarityIndex.load(os.path.join(sweep_dir, 'similarity.npz'))) == 10
+
+
+def test_unison(tmp_path: str):
+    wavetables = make_wavetables(kernel_for_string('Matern52', lengthscale=0.3), 2, rng=0)
+    path = os.path.join(tmp_path, 'unison.wav')
+    wav = WavFile(path, channels=2)
+    synth = GPSynth(None, None, wav, wavetables=wavetables, unison=5, detune=15., spread=1.)
+    synth.note(60, 0.5)
+    synth.note(64, 0.5)
+    wav.close()
+    stereo = read_wav(path)
+    assert stereo.shape == (44100, 2) and wav.samples_written == 44100
+    assert np.max(np.abs(stereo)) <= 1.
+    assert not np.allclose(stereo[:, 0], stereo[:, 1], atol=1e-3)
+
+    mono = render_wavetable(wavetables[0], 60, 0, 1000, 1000)
+    detunes, pans, phases = unison_voices(1)
+    assert np.array_equal(render_unison(wavetables[0], 60, 0, 1000, 1000, detunes, pans, phases, 1)[:, 0], mono)
+
+
+def test_lazy_wavetables():
+    kernel = kernel_for_string('Matern52', lengthscale=0.3)
+    lazy = GPSynth(kernel, None, None, 5, rng=0, lazy=True)
+    first = lazy.next_wavetable(60)
+    assert first.shape == (2205,)
+    tables = lazy.wavetables
+    assert len(tables) == 5 and lazy.pool.n_drawn == 5
+    again = GPSynth(kernel, None, None, 5, rng=0, lazy=True).wavetables
+    assert all(np.array_equal(a, b) for a, b in zip(tables, again))
+
+    fresh = GPSynth(kernel, None, None, 3, rng=0, fresh=True)
+    played = [fresh.pool.next() for _ in range(8)]
+    assert len({table.tobytes() for table in played}) == 8
+    assert len(fresh.wavetables) <= 3
+
+
+@pytest.mark.parametrize('export_format', ['bank', 'flac'])
+def test_compressed_export(tmp_path: str, export_format: str):
+    if export_format == 'flac':
+        pytest.importorskip('soundfile')
+    smooth = make_wavetables(kernel_for_string('Matern52', lengthscale=0.3), 3, rng=0)
+    rough = make_wavetables(kernel_for_string('Exponential', lengthscale=0.05), 3, True, rng=0)
+    for path, fmt in [(os.path.join(tmp_path, 'wav'), 'wav'), (os.path.join(tmp_path, export_format), export_format)]:
+        os.makedirs(path)
+        wav = WavFile(os.path.join(path, 'c.wav'))
+        wav.write_samples(render_wavetable(smooth[0], 60, 0, 10000, 10000))
+        wav.close()
+        exporter = WavetableExporter(path, fmt)
+        exporter.save('smooth_', smooth)
+        exporter.save('rough_', rough)
+        exporter.close()
+
+    compressed = os.path.join(tmp_path, export_format)
+    assert not os.path.exists(os.path.join(compressed, 'c.wav'))
+    if export_format == 'bank':
+        bank = WavetableBank(compressed)
+        assert len(bank) == 6 and bank['rough_02.wav'].shape == (2204,)
+        saved = read_wav(os.path.join(tmp_path, 'wav', 'samples', 'smooth_01.wav'))
+        assert np.array_equal(bank['smooth_01.wav'], saved)
+    assert to_wav(compressed) == 6
+    for name in os.listdir(os.path.join(tmp_path, 'wav', 'samples')):
+        with open(os.path.join(tmp_path, 'wav', 'samples', name), 'rb') as a, \
+                open(os.path.join(compressed, 'samples', name), 'rb') as b:
+            assert a.read() == b.read()
+    assert np.array_equal(read_wav(os.path.join(compressed, 'c.wav')), read_wav(os.path.join(tmp_path, 'wav', 'c.wav')))
+
+
+def test_prune_duplicates(tmp_path: str):
+    features = expected_features(cached_cholesky(kernel_for_string('RBF', lengthscale=0.5)))
+    tables = make_wavetables(kernel_for_string('RBF', lengthscale=0.5), 7, rng=0)
+    drawn = spectral_features(tables).mean(axis=0)
+    assert features @ drawn / np.linalg.norm(drawn) > 0.99
+
+    duplicates = DuplicateFilter()
+    assert duplicates.check('a', features) is None
+    assert duplicates.check('b', features) == 'a'
+    other = expected_features(cached_cholesky(kernel_for_string('RBF', lengthscale=0.1)))
+    assert duplicates.check('c', other) is None
+
+    big_sweep(['Poly', 'Matern32'], tmp_path, ls_subdivisions=2, n_wavetables=1, seed=0, n_combinations=0,
+              prune=0.9995)
+    with open(os.path.join(tmp_path, 'score.json'), 'r') as f:
+        score = json.load(f)
+    names = [(entry['kernel_1'], entry['lengthscale_1_idx'], entry['waveshaping']) for entry in score]
+    assert ('Poly', 1, False) not in names and ('Matern32', 1, False) in names
+    aliases = score[names.index(('Poly', 0, False))]['aliases']
+    assert [(alias['kernel_1'], alias['lengthscale_1_idx']) for alias in aliases] == [('Poly', 1)]
+    assert len(os.listdir(os.path.join(tmp_path, 'samples'))) == len(score)
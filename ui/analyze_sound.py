@@ -6,8 +6,6 @@ import sys
 
 import librosa
 import numpy as np
-from sklearn.manifold import TSNE
-import umap
 
 def main():
     parser = argparse.ArgumentParser(description='generates a 2D mapping of timbre')
@@ -25,42 +23,35 @@ def main():
         assert False
 
 
-def process(path, method='tsne'):
-    directory = 'results'
-    if not os.path.exists(directory):
-        os.mkdir(directory)
-    filename, file_extension = os.path.splitext(path)
-    split = os.path.split(filename)
-    filename = split[1] + f'_{method}'
-    result_path = os.path.join(directory, filename) + '.json'
-    if os.path.exists(result_path):
-       return result_path
+def extract_features(y, hop_length, sr=22050, n_fft=2048):
+    """Computes the timbre features of every hop of the audio.
 
-    hop_length = 22050  # output length = (seconds) * (sample rate) / (hop_length)
-    print(f'Snippet length = {hop_length / 22050:.2f}s')
-    print('Loading WAV')
-    y, sr = librosa.load(path)
-    print('Computing MFCC features')
-    mfcc = librosa.feature.mfcc(y, hop_length=hop_length, center=False)
-    melspectrogram = librosa.feature.melspectrogram(y, hop_length=hop_length, center=False)
-    rmse = librosa.feature.rms(y, hop_length=hop_length, center=False)
-    spectral_centroid = librosa.feature.spectral_centroid(y, hop_length=hop_length, center=False)
-    spectral_bandwidth = librosa.feature.spectral_bandwidth(y, hop_length=hop_length, center=False)
-    spectral_contrast = librosa.feature.spectral_contrast(y, hop_length=hop_length, center=False)
-    spectral_flattness = librosa.feature.spectral_flatness(y, hop_length=hop_length, center=False)
-    spectral_rolloff = librosa.feature.spectral_rolloff(y, hop_length=hop_length, center=False)
-    zero_crossing_rate = librosa.feature.zero_crossing_rate(y, hop_length=hop_length, center=False)
+    :param y: The audio.
+    :param hop_length: The number of samples between successive features.
+    :param sr: The sampling rate of the audio.
+    :param n_fft: The length of the analyzed frames.
+    :return: The features of the hops that are loud enough, the total number
+        of hops and the mask of the hops that are loud enough.
+    """
+    kwargs = dict(hop_length=hop_length, n_fft=n_fft, center=False)
+    # without top_db, every frame is independent of the others, also across blocks
+    mel = librosa.power_to_db(librosa.feature.melspectrogram(y=y, sr=sr, **kwargs), top_db=None)
+    mfcc = librosa.feature.mfcc(S=mel, sr=sr)
+    rmse = librosa.feature.rms(y=y, hop_length=hop_length, frame_length=n_fft, center=False)
+    spectral_centroid = librosa.feature.spectral_centroid(y=y, sr=sr, **kwargs)
+    spectral_bandwidth = librosa.feature.spectral_bandwidth(y=y, sr=sr, **kwargs)
+    spectral_contrast = librosa.feature.spectral_contrast(y=y, sr=sr, **kwargs)
+    spectral_flattness = librosa.feature.spectral_flatness(y=y, **kwargs)
+    spectral_rolloff = librosa.feature.spectral_rolloff(y=y, sr=sr, **kwargs)
 
     mfcc = mfcc.T
     n_hops = mfcc.shape[0]
-    melspectrogram = melspectrogram.T
-    rmse = np.squeeze(rmse)
-    spectral_centroid = np.squeeze(spectral_centroid)
-    spectral_bandwidth = np.squeeze(spectral_bandwidth)
+    rmse = rmse[0]
+    spectral_centroid = spectral_centroid[0]
+    spectral_bandwidth = spectral_bandwidth[0]
     spectral_contrast = spectral_contrast.T
-    spectral_flattness = np.squeeze(spectral_flattness)
-    spectral_rolloff = np.squeeze(spectral_rolloff)
-    zero_crossing_rate = np.squeeze(zero_crossing_rate)
+    spectral_flattness = spectral_flattness[0]
+    spectral_rolloff = spectral_rolloff[0]
 
     valid_indices = (rmse > 0.01)
 
@@ -73,8 +64,62 @@ def process(path, method='tsne'):
              spectral_rolloff[valid_indices][:, np.newaxis], rmse[valid_indices][:, np.newaxis]])
     }
     all_features['all'] = np.hstack((all_features['mfcc'], all_features['spectral']))
+    return all_features, n_hops, valid_indices
+
+
+def extract_features_stream(path, hop_seconds=1., block_length=64):
+    """Computes the timbre features of every hop of a WAV file, reading it
+    block by block, so the memory does not grow with the length of the file.
+
+    :param path: Path of the WAV file.
+    :param hop_seconds: The time between successive features.
+    :param block_length: The number of hops per block.
+    :return: The same as extract_features. A file shorter than one frame has
+        no hops.
+    """
+    sr = librosa.get_samplerate(path)
+    hop_length = int(round(hop_seconds * sr))
+    n_fft = int(2048 * sr / 22050)  # the frame length of librosa.load at 22050 Hz
+    blocks = []
+    # librosa.stream expects overlapping frames, with sparser frames the blocks just tile the file
+    stream = librosa.stream(path, block_length=block_length, frame_length=max(n_fft, hop_length),
+                            hop_length=hop_length)
+    for y in stream:
+        if y.size < n_fft:  # the rest after the last complete frame
+            break
+        blocks.append(extract_features(y, hop_length, sr, n_fft))
+    if not blocks:
+        # the features of a silent frame are all dropped, which leaves them empty with the right shapes
+        features, _, _ = extract_features(np.zeros(n_fft, dtype=np.float32), hop_length, sr, n_fft)
+        return features, 0, np.zeros(0, dtype=bool)
+
+    all_features = {key: np.concatenate([features[key] for features, _, _ in blocks]) for key in blocks[0][0]}
+    n_hops = sum(n for _, n, _ in blocks)
+    valid_indices = np.concatenate([valid for _, _, valid in blocks])
+    return all_features, n_hops, valid_indices
+
+
+def process(path, method='tsne'):
+    directory = 'results'
+    if not os.path.exists(directory):
+        os.mkdir(directory)
+    filename, file_extension = os.path.splitext(path)
+    split = os.path.split(filename)
+    filename = split[1] + f'_{method}'
+    result_path = os.path.join(directory, filename) + '.json'
+    if os.path.exists(result_path):
+       return result_path
+
+    hop_seconds = 1.  # output length = (seconds) / (hop_seconds)
+    print(f'Snippet length = {hop_seconds:.2f}s')
+    print('Computing MFCC features')
+    all_features, n_hops, valid_indices = extract_features_stream(path, hop_seconds)
+    if not np.any(valid_indices):
+        raise ValueError(f'{path} has no snippets that are loud enough, it may be too short or silent.')
 
     if method == 'tsne':
+        from sklearn.manifold import TSNE
+
         print('Computing t-SNE')
         time_start = time.time()
         tsne = TSNE()
@@ -83,18 +128,20 @@ def process(path, method='tsne'):
         result = {
             "x": Y[:, 0].tolist(),
             "y": Y[:, 1].tolist(),
-            "t": ((np.arange(n_hops) * hop_length / 22050.0)[valid_indices]).tolist(),
+            "t": ((np.arange(n_hops) * hop_seconds)[valid_indices]).tolist(),
             "filename": path
         }
         print(len(result['x']), 'elements')
     elif method == 'umap':
+        import umap
+
         print('Computing UMAP')
         time_start = time.time()
         Y = umap.UMAP(metric='correlation').fit_transform(all_features['mfcc'])
         result = {
             "x": Y[:, 0].tolist(),
             "y": Y[:, 1].tolist(),
-            "t": ((np.arange(n_hops) * hop_length / 22050.0)[valid_indices]).tolist(),
+            "t": ((np.arange(n_hops) * hop_seconds)[valid_indices]).tolist(),
             "filename": path
         }
         print('UMAP done! Time elapsed: {} seconds'.format(time.time() - time_start))
@@ -1,4 +1,9 @@
 import sys
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Optional
+
+import numpy as np
 from PyQt5.QtCore import Qt
 from PyQt5.QtWidgets import *
 from PyQt5.QtGui import *
@@ -6,6 +11,86 @@ from PyQt5.QtCore import pyqtSlot
 
 from gpsynth.synthesizer import GPSynth, kernel_for_string, all_kernels
 from gpsynth.audio_output import RealtimeAudio
+from gpsynth.morph import LengthscaleMorph
+
+
+class SynthCache:
+    """Bounded cache of synthesizers that are generated in background threads."""
+
+    def __init__(self, audio_output: Optional[RealtimeAudio], max_size: int = 32, max_workers: int = 2):
+        """Prepares the cache.
+
+        :param audio_output: Real-time audio output handed to every synthesizer.
+        :param max_size: The maximal number of settings that are kept.
+        :param max_workers: The number of background threads computing wavetables.
+        """
+        self.audio_output = audio_output
+        self.max_size = max_size
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.futures = OrderedDict()
+
+    def request(self, kernel_name: str, lengthscale: float) -> Future:
+        """Returns a future of the synthesizer for the setting. The
+        computation is started in the background unless it is cached already.
+
+        :param kernel_name: The name of the kernel.
+        :param lengthscale: The length-scale parameter.
+        :return: A future resolving to a GPSynth.
+        """
+        key = (kernel_name, round(lengthscale, 6))
+        return self._submit(key, self._make_synth, kernel_name, lengthscale)
+
+    def prefetch(self, kernel_name: str, lengthscales: list) -> None:
+        """Speculatively computes the given settings. Queued computations of
+        other settings that have not started yet are dropped, so that dragging
+        the slider does not pile up stale work.
+
+        :param kernel_name: The name of the kernel.
+        :param lengthscales: The length-scales, most important first.
+        """
+        wanted = {(kernel_name, round(lengthscale, 6)) for lengthscale in lengthscales}
+        for key, future in list(self.futures.items()):
+            if key not in wanted and future.cancel():
+                del self.futures[key]
+        for lengthscale in lengthscales:
+            self.request(kernel_name, lengthscale)
+
+    def request_morph(self, kernel_name: str, left: float, right: float) -> Future:
+        """Returns a future of the morphing engine for the kernel and the
+        length-scale range. Once it is computed, every length-scale in the range
+        is available without factorizing a covariance matrix.
+
+        :param kernel_name: The name of the kernel.
+        :param left: The smallest length-scale.
+        :param right: The largest length-scale.
+        :return: A future resolving to a LengthscaleMorph.
+        """
+        key = ('morph', kernel_name, left, right)
+        lengthscales = np.geomspace(max(left, 1e-3), max(right, 1e-3), morph_subdivisions)
+        return self._submit(key, LengthscaleMorph, kernel_name, lengthscales)
+
+    def shutdown(self) -> None:
+        """Stops the background threads."""
+        for future in self.futures.values():
+            future.cancel()
+        self.executor.shutdown(wait=False)
+
+    def _submit(self, key: tuple, fn, *args) -> Future:
+        future = self.futures.get(key)
+        if future is not None and not future.cancelled():
+            self.futures.move_to_end(key)
+            return future
+
+        future = self.executor.submit(fn, *args)
+        self.futures[key] = future
+        while len(self.futures) > self.max_size:
+            _, evicted = self.futures.popitem(last=False)
+            evicted.cancel()
+        return future
+
+    def _make_synth(self, kernel_name: str, lengthscale: float) -> GPSynth:
+        kernel = kernel_for_string(kernel_name, lengthscale)
+        return GPSynth(kernel, out_rt=self.audio_output, out_wav=None)
 
 
 class Window(QWidget):
@@ -16,6 +101,10 @@ class Window(QWidget):
 
         self.cb = QComboBox()
         self.cb.addItems(all_kernels)
+        self.cb.currentTextChanged.connect(self.prefetch)
+
+        self.morph_checkbox = QCheckBox('Morph')
+        self.morph_checkbox.stateChanged.connect(self.prefetch)
 
         button = QPushButton('Play')
         button.clicked.connect(self.on_click)
@@ -48,32 +137,88 @@ class Window(QWidget):
         self.label_lengthscale.setAlignment(Qt.AlignCenter)
         grid.addWidget(self.label_lengthscale, 2, 2)
         grid.addWidget(button, 3, 2)
+        grid.addWidget(self.morph_checkbox, 3, 3)
 
         self.setLayout(grid)
 
         self.setWindowTitle("GPSynth Simple GUI")
-        self.slider_changed()
 
         self.audio_output = RealtimeAudio()
+        self.synth_cache = SynthCache(self.audio_output)
+        self.player = ThreadPoolExecutor(max_workers=1)  # plays the jingles without blocking the GUI
+
+        self.slider_changed()
 
     @pyqtSlot()
     def on_click(self):
-        left = float(self.line_edit_left.text())
-        right = float(self.line_edit_right.text())
-        lengthscale = left + (right - left) * self.slider.value() / 1000.0
-        kernel = kernel_for_string(self.cb.currentText(), lengthscale)
-        gpsynth = GPSynth(kernel, out_rt=self.audio_output, out_wav=None)
-        play_jingle(gpsynth)
-
-    def lengthscale_input(self):
+        if self.morph_checkbox.isChecked():
+            future = self.synth_cache.request_morph(self.cb.currentText(), *self.lengthscale_range())
+            self.player.submit(play_morph_when_ready, future, self.lengthscale_input(), self.audio_output)
+        else:
+            future = self.synth_cache.request(self.cb.currentText(), self.lengthscale_input())
+            self.player.submit(play_jingle_when_ready, future)
+
+    def lengthscale_range(self):
+        return float(self.line_edit_left.text()), float(self.line_edit_right.text())
+
+    def lengthscale_input(self, slider_value: Optional[int] = None):
+        if slider_value is None:
+            slider_value = self.slider.value()
         left = float(self.line_edit_left.text())
         right = float(self.line_edit_right.text())
         max_slider = 1000
-        return left + self.slider.value() / max_slider * (right - left)
+        return left + slider_value / max_slider * (right - left)
 
     @pyqtSlot()
     def slider_changed(self):
         self.label_lengthscale.setText(f'{self.lengthscale_input():.2f}')
+        self.prefetch()
+
+    @pyqtSlot()
+    def prefetch(self):
+        """Precomputes the current setting and its neighbours on the slider."""
+        if self.morph_checkbox.isChecked():
+            self.synth_cache.request_morph(self.cb.currentText(), *self.lengthscale_range())
+            return
+
+        value = self.slider.value()
+        positions = [value + offset for offset in prefetch_offsets
+                     if self.slider.minimum() <= value + offset <= self.slider.maximum()]
+        lengthscales = [self.lengthscale_input(position) for position in positions]
+        self.synth_cache.prefetch(self.cb.currentText(), lengthscales)
+
+    def closeEvent(self, event):
+        self.synth_cache.shutdown()
+        self.player.shutdown(wait=False)
+        super(Window, self).closeEvent(event)
+
+
+# Slider positions relative to the current one that are computed in advance,
+# most important first.
+prefetch_offsets = [0, 1, -1, 2, -2, 5, -5, 10, -10]
+
+# Number of length-scales at which the covariance is factorized in morph mode.
+morph_subdivisions = 16
+
+
+def play_jingle_when_ready(future: Future) -> None:
+    """Waits for the synthesizer (which returns immediately if the setting is
+    cached) and plays the jingle.
+
+    :param future: A future resolving to a GPSynth.
+    """
+    play_jingle(future.result())
+
+
+def play_morph_when_ready(future: Future, lengthscale: float, audio_output: RealtimeAudio) -> None:
+    """Waits for the morphing engine and plays the jingle with the wavetables
+    interpolated at the length-scale.
+
+    :param future: A future resolving to a LengthscaleMorph.
+    :param lengthscale: The length-scale parameter.
+    :param audio_output: The real-time audio output.
+    """
+    play_jingle(future.result().synth(lengthscale, out_rt=audio_output, out_wav=None))
 
 
 def play_jingle(gpsynth):
@@ -0,0 +1,262 @@
+"""
+Asynchronous synthesis service for other programs:
+
+GET /wavetables?kernel=RBF(0.5)&n=4&seed=0   the wavetables as JSON (or raw float32 with &format=f32)
+GET /note?kernel=RBF(0.5)&midi_note=60&duration=1&seed=0   a note, streamed as WAV file
+GET /ws   WebSocket, send {"type": "note", ...} or {"type": "wavetables", ...} with the same parameters
+
+The kernel is an expression like 'RBF(0.5) + Matern32(0.2) * StdPeriodic', see
+kernel_for_expression. Without a seed, fresh wavetables are drawn and the seed
+is reported, so that the result can be requested again.
+"""
+
+import argparse
+import asyncio
+import json
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+import numpy as np
+from aiohttp import web, WSMsgType
+
+import gpsynth.config as config
+import gpsynth.metrics as metrics
+from gpsynth.audio_output import wav_header
+from gpsynth.synthesizer import band_limit, kernel_for_expression, make_wavetables, render_wavetable
+
+
+def generate_wavetables(expression: str, n: int, waveshaping: bool, seed: int,
+                        factor_cache_dir: Optional[str]) -> np.ndarray:
+    """Generates wavetables in a worker process.
+
+    :param expression: The kernel expression.
+    :param n: The number of wavetables.
+    :param waveshaping: Should waveshaping be used?
+    :param seed: The seed of the random number generator.
+    :param factor_cache_dir: The directory of the factor cache shared by the workers.
+    :return: The wavetables with shape (n, samples).
+    """
+    config.factor_cache_dir = factor_cache_dir
+    return np.stack(make_wavetables(kernel_for_expression(expression), n, waveshaping, rng=seed))
+
+
+class SynthService:
+    """Generates wavetables in a process pool. Identical requests that are in
+    flight at the same time share one computation, and the workers share the
+    Cholesky factors through a directory, see cached_cholesky."""
+
+    def __init__(self, processes: Optional[int] = None, factor_cache_dir: Optional[str] = None,
+                 chunk_size: int = 4096):
+        """Starts the process pool.
+
+        :param processes: The number of worker processes, the number of CPUs if None.
+        :param factor_cache_dir: The directory of the factor cache, a
+            temporary directory if None.
+        :param chunk_size: The number of samples per streamed chunk.
+        """
+        self.processes = processes
+        self.executor = ProcessPoolExecutor(max_workers=processes)
+        self.temporary_dir = None
+        if factor_cache_dir is None:
+            self.temporary_dir = tempfile.TemporaryDirectory(prefix='gpsynth_factors_')
+            factor_cache_dir = self.temporary_dir.name
+        self.factor_cache_dir = factor_cache_dir
+        self.chunk_size = chunk_size
+        self.in_flight = {}  # type: Dict[Tuple, asyncio.Future]
+
+    async def wavetables(self, expression: str, n: int = 1, waveshaping: bool = False,
+                         seed: Optional[int] = None) -> Tuple[np.ndarray, int]:
+        """Generates wavetables.
+
+        :param expression: The kernel expression.
+        :param n: The number of wavetables.
+        :param waveshaping: Should waveshaping be used?
+        :param seed: The seed, a random one if None.
+        :return: The wavetables with shape (n, samples) and the seed.
+        """
+        loop = asyncio.get_running_loop()
+        # raises for invalid expressions before anything is queued, in a thread, as the first call imports GPy
+        await loop.run_in_executor(None, kernel_for_expression, expression)
+        if seed is None:
+            seed = int(np.random.default_rng().integers(2 ** 31))
+        key = (expression.replace(' ', ''), n, waveshaping, seed)
+        future = self.in_flight.get(key)
+        executor = None  # the pool of the computation, if this request started it
+        try:
+            if future is not None:
+                metrics.count('service_requests_coalesced_total')
+            else:
+                executor = self.executor
+                future = loop.run_in_executor(executor, generate_wavetables, expression, n, waveshaping, seed,
+                                              self.factor_cache_dir)
+                self.in_flight[key] = future
+                future.add_done_callback(lambda _: self.in_flight.pop(key, None))
+            # a cancelled request must not cancel the computation other requests wait for
+            return await asyncio.shield(future), seed
+        except BrokenProcessPool:
+            if executor is not None and executor is self.executor:  # a worker died, later requests get a new pool
+                metrics.count('service_pool_restarts_total')
+                self.executor = ProcessPoolExecutor(max_workers=self.processes)
+                executor.shutdown(wait=False)
+            raise
+
+    async def note(self, expression: str, midi_note: float = 60., duration: float = 1., waveshaping: bool = False,
+                   seed: Optional[int] = None) -> Tuple[int, int, AsyncIterator[bytes]]:
+        """Renders a note with the first wavetable.
+
+        :param expression: The kernel expression.
+        :param midi_note: The MIDI pitch of the note.
+        :param duration: The duration in seconds.
+        :param waveshaping: Should waveshaping be used?
+        :param seed: The seed, a random one if None.
+        :return: The number of samples, the seed and the chunks of 16 bit PCM.
+        """
+        wavetables, seed = await self.wavetables(expression, 1, waveshaping, seed)
+        wavetable = await asyncio.get_running_loop().run_in_executor(None, band_limit, wavetables[0], midi_note)
+        samples_total = int(duration * 44100.)
+
+        async def chunks() -> AsyncIterator[bytes]:
+            for start in range(0, samples_total, self.chunk_size):
+                stop = min(start + self.chunk_size, samples_total)
+                pcm = render_wavetable(wavetable, midi_note, start, stop, samples_total)
+                yield (np.clip(pcm, -1., 1.) * (2 ** 15 - 1)).astype('<i2').tobytes()
+                await asyncio.sleep(0)  # let other requests proceed between chunks
+
+        return samples_total, seed, chunks()
+
+    def close(self) -> None:
+        """Stops the workers and removes the temporary factor cache."""
+        self.executor.shutdown(wait=True)
+        if self.temporary_dir is not None:
+            self.temporary_dir.cleanup()
+
+
+# Requests beyond these limits are rejected, so that no single one ties up the workers or their memory.
+MAX_WAVETABLES = 64  # per request
+MAX_DURATION = 60.  # of a note in seconds
+
+
+def _parameters(params, kind: str) -> dict:
+    """Parses the parameters of a request, from the query or a WebSocket message.
+
+    :param params: The query or the message.
+    :param kind: 'wavetables' or 'note'.
+    :return: The keyword arguments of SynthService.wavetables or SynthService.note.
+    """
+    try:
+        parameters = {
+            'expression': str(params['kernel']),
+            'waveshaping': str(params.get('waveshaping', '0')).lower() in ('1', 'true'),
+            'seed': int(params['seed']) if params.get('seed') is not None else None,
+        }
+        if kind == 'wavetables':
+            parameters['n'] = int(params.get('n', 1))
+        else:
+            parameters['midi_note'] = float(params.get('midi_note', 60.))
+            parameters['duration'] = float(params.get('duration', 1.))
+    except (KeyError, ValueError) as e:
+        raise ValueError(f'Invalid parameters: {e}')
+    if not 1 <= parameters.get('n', 1) <= MAX_WAVETABLES:
+        raise ValueError(f'n must be between 1 and {MAX_WAVETABLES}.')
+    if not 0. < parameters.get('duration', 1.) <= MAX_DURATION:  # also rejects nan
+        raise ValueError(f'duration must be positive and at most {MAX_DURATION} seconds.')
+    if not 0. <= parameters.get('midi_note', 60.) <= 127.:
+        raise ValueError('midi_note must be between 0 and 127.')
+    return parameters
+
+
+def _http_error(e: Exception) -> web.HTTPException:
+    """Maps the error of a request to an HTTP error."""
+    if isinstance(e, np.linalg.LinAlgError):  # before ValueError, its base class
+        return web.HTTPUnprocessableEntity(text=f'The covariance of the kernel cannot be factorized: {e}')
+    if isinstance(e, BrokenProcessPool):
+        return web.HTTPServiceUnavailable(text='A worker process stopped unexpectedly, please retry.')
+    return web.HTTPBadRequest(text=str(e))
+
+
+def make_app(service: SynthService) -> web.Application:
+    """Makes the web application.
+
+    :param service: The service that does the work. It is closed with the application.
+    :return: The application.
+    """
+    routes = web.RouteTableDef()
+
+    @routes.get('/wavetables')
+    async def wavetables(request: web.Request) -> web.StreamResponse:
+        try:
+            tables, seed = await service.wavetables(**_parameters(request.query, 'wavetables'))
+        except (ValueError, LookupError, BrokenProcessPool) as e:
+            raise _http_error(e)
+        headers = {'X-Seed': str(seed)}
+        if request.query.get('format') == 'f32':
+            headers['X-Shape'] = f'{tables.shape[0]},{tables.shape[1]}'
+            return web.Response(body=tables.astype('<f4').tobytes(), content_type='application/octet-stream',
+                                headers=headers)
+        return web.json_response({'seed': seed, 'wavetables': tables.tolist()}, headers=headers)
+
+    @routes.get('/note')
+    async def note(request: web.Request) -> web.StreamResponse:
+        try:
+            samples_total, seed, chunks = await service.note(**_parameters(request.query, 'note'))
+        except (ValueError, LookupError, BrokenProcessPool) as e:
+            raise _http_error(e)
+        response = web.StreamResponse(headers={'Content-Type': 'audio/wav', 'X-Seed': str(seed)})
+        response.content_length = 44 + 2 * samples_total
+        await response.prepare(request)
+        await response.write(wav_header(samples_total))
+        async for chunk in chunks:
+            await response.write(chunk)
+        await response.write_eof()
+        return response
+
+    @routes.get('/ws')
+    async def websocket(request: web.Request) -> web.WebSocketResponse:
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        async for msg in ws:
+            if msg.type != WSMsgType.TEXT:
+                continue
+            try:
+                message = json.loads(msg.data)
+                if message.get('type') == 'wavetables':
+                    tables, seed = await service.wavetables(**_parameters(message, 'wavetables'))
+                    await ws.send_json({'type': 'wavetables', 'seed': seed, 'wavetables': tables.tolist()})
+                elif message.get('type') == 'note':
+                    samples_total, seed, chunks = await service.note(**_parameters(message, 'note'))
+                    await ws.send_json({'type': 'note', 'seed': seed, 'samples': samples_total})
+                    async for chunk in chunks:
+                        await ws.send_bytes(chunk)
+                    await ws.send_json({'type': 'end'})
+                else:
+                    raise ValueError(f'Unknown message type: {message.get("type")}')
+            except (ValueError, LookupError, BrokenProcessPool) as e:
+                await ws.send_json({'type': 'error', 'message': _http_error(e).text})
+        return ws
+
+    @routes.get('/metrics')
+    async def send_metrics(request: web.Request) -> web.Response:
+        if request.query.get('format') == 'json':
+            return web.Response(text=metrics.to_json(), content_type='application/json')
+        return web.Response(text=metrics.to_prometheus(), content_type='text/plain')
+
+    async def close_service(app: web.Application) -> None:
+        await asyncio.get_running_loop().run_in_executor(None, service.close)  # waits for the workers
+
+    app = web.Application()
+    app.add_routes(routes)
+    app.on_cleanup.append(close_service)
+    return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve wavetables and notes of Gaussian Process Synthesis')
+    parser.add_argument('--port', type=int, default=4556)
+    parser.add_argument('--processes', type=int, default=None, help='the number of worker processes')
+    parser.add_argument('--factor-cache', type=str, default=None,
+                        help='directory of the Cholesky factors shared by the workers, kept between runs')
+    args = parser.parse_args()
+    metrics.enable()
+    web.run_app(make_app(SynthService(args.processes, args.factor_cache)), port=args.port)
@@ -8,9 +8,14 @@ import os
 import shutil
 import json
 
-from flask import Flask, render_template, request, send_from_directory
+from flask import Flask, Response, abort, render_template, request, send_from_directory
 import hashlib
+import numpy as np
 import analyze_sound
+import gpsynth.metrics as metrics
+from gpsynth.audio_output import wav_segment_bytes
+from gpsynth.similarity import SimilarityIndex, extract_cycle
+from gpsynth.synthesizer import wavetable_prefix
 
 app = Flask(__name__)
 
@@ -55,6 +60,71 @@ def md5(f):
     return hash_md5.hexdigest()
 
 
+@app.route('/metrics')
+def send_metrics():
+    if request.args.get('format') == 'json':
+        return Response(metrics.to_json(), mimetype='application/json')
+    return Response(metrics.to_prometheus(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/preview/<int:index>')
+def send_preview(index):
+    """Serves the note of a setting of the score as WAV file, cut out of c.wav.
+    Range requests are supported, so players can seek without loading it."""
+    score = getattr(fixed, 'score', None)
+    if score is None or not 0 <= index < len(score) or 'sample_offset' not in score[index]:
+        abort(404)
+    entry = score[index]
+    size = 44 + 2 * entry['sample_count']
+    byte_range = request.range.range_for_length(size) if request.range is not None else None
+    if request.range is not None and byte_range is None:
+        response = Response(status=416)
+        response.headers['Content-Range'] = f'bytes */{size}'
+        return response
+    start, stop = byte_range if byte_range is not None else (0, size)
+    data = wav_segment_bytes(fixed.wav_path, entry['sample_offset'], entry['sample_count'], start, stop)
+    response = Response(data, status=206 if byte_range is not None else 200, mimetype='audio/wav')
+    response.headers['Accept-Ranges'] = 'bytes'
+    if byte_range is not None:
+        response.headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+    return response
+
+
+def similar_settings(results):
+    """Adds the index of the setting in the score to the results of a query."""
+    settings = {wavetable_prefix(entry): i for i, entry in enumerate(getattr(fixed, 'score', []))}
+    return [{'name': name, 'similarity': similarity, 'setting': settings.get(name[:-len('00.wav')])}
+            for name, similarity in results]
+
+
+@app.route('/similar/<int:index>')
+def send_similar(index):
+    """The wavetables most similar to the first one of a setting of the score."""
+    score = getattr(fixed, 'score', None)
+    if score is None or not 0 <= index < len(score):
+        abort(404)
+    name = wavetable_prefix(score[index]) + '00.wav'
+    if name not in fixed.index.names:
+        abort(404)
+    results = fixed.index.query_name(name, request.args.get('k', 10, type=int))
+    return Response(json.dumps(similar_settings(results)), mimetype='application/json')
+
+
+@app.route('/similar', methods=['POST'])
+def send_similar_to_upload():
+    """The wavetables most similar to an uploaded sound, either a single
+    cycle or a recording of a pitched sound."""
+    import librosa
+
+    y, _ = librosa.load(request.files['file'], sr=44100, mono=True)
+    if y.size <= 2 * 2205:  # a single cycle
+        cycle = np.interp(np.arange(2205) * y.size / 2205, np.arange(y.size), y)
+    else:
+        cycle = extract_cycle(y)
+    results = fixed.index.query(cycle, request.args.get('k', 10, type=int))
+    return Response(json.dumps(similar_settings(results)), mimetype='application/json')
+
+
 @app.route('/fixed')
 def fixed():
     return render_template("visualization.html", json_file=fixed.result_path.replace('\\','/'))
@@ -64,7 +134,14 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--dir', required=False)
     args = parser.parse_args()
+    metrics.enable()
+    fixed.index = SimilarityIndex()
     if args.dir is not None:
+        index_path = os.path.join(args.dir, 'similarity.npz')
+        if os.path.exists(index_path):
+            fixed.index = SimilarityIndex.load(index_path)
+        if fixed.index.update_from_directory(os.path.join(args.dir, 'samples')) > 0:
+            fixed.index.save(index_path)
         for file in os.listdir(args.dir):
             if file.endswith(".wav"):
                 wav_path = os.path.join(args.dir, file)
@@ -82,6 +159,8 @@ if __name__ == "__main__":
 
                 with open(os.path.join(args.dir, 'score.json'), 'r') as score_json:
                     score = json.load(score_json)
+                    fixed.score = score
+                    fixed.wav_path = wav_path
                     descriptions = []
                     for note in score:
                         waveshaping = 'waveshaping' if note['waveshaping'] else 'no waveshaping'